@@ -1,5 +1,6 @@
-import os, glob, random
-from typing import List, Tuple, Dict, Optional
+import os, glob, random, time, hashlib, json, gc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Tuple, Dict, Optional
 import numpy as np
 import torch
 from PIL import Image
@@ -7,6 +8,10 @@ import cv2
 from .classes.Sam2Model import Sam2Model
 from .classes.GDinoModel import GdinoModel
 from .classes.NmsProcessor import NmsProcessor
+from .classes.MaskCodec import MaskCodec
+from .classes.Precision import check_precision
+from .classes.ModelStore import ModelStore
+from .classes.StageTimer import StageTimer
 
 # base consts
 # _BETA = 0.9
@@ -30,12 +35,28 @@ class ImageSegmentator:
                 _SAM2_ID="facebook/sam2.1-hiera-large", # модель SAM2
                 _sam2_load_now : bool = True, # если True, то SAM подгрузит все сразу, а не при первом использовании
                 use_sam : bool = True, # используется ли SAM2. Если нет, то маски будут None 
+                _mask_on_demand : bool = False, # SAM2 не участвует в predict_*, маски — только через predict_masks
+                _mask_format : str = "array", # формат масок на выходе: "array" | "rle" | "bitpacked"
                 _iou_thr: float = 0.40, # порог для нмс 
                 _beta : float = 0.9, # порог для обработки после нмс
                 _alpha_all_classes : float = 0.8, # порог для нмс всех классов
+                _nms_backend : str = "numpy", # реализация нмс: "numpy" или "torch" (torchvision)
                 _box_thr : float = 0.20, # боксовый порог для гдино
                 _text_thr : float = 0.20, # классовый порог для гдино 
                 size= {"shortest_edge": 1200, "longest_edge": 1900},
+                _gdino_single_pass : bool = False, # если True, то все метки ищутся за один прогон GDINO
+                _gdino_batch_size : int = 4, # сколько изображений за раз в predict_batch
+                _tiling : bool = False, # тайловая детекция для изображений больше size
+                _tile_size : int = 1024, # сторона тайла, px
+                _tile_overlap : float = 0.25, # перекрытие тайлов (доля стороны)
+                _runtime : str = "torch", # "torch" — eager PyTorch, "onnx" — ONNX Runtime на CPU
+                _onnx_dir : str = "models/onnx", # каталог с графами из app/ML/export.py
+                _ort_threads : int = 0, # intra-op потоков ONNX Runtime (0 — по умолчанию ORT)
+                _quantize : bool = False, # int8 dynamic quantization nn.Linear GDINO и SAM2 (только cpu)
+                _precision : str = "fp32", # точность прямых проходов: "fp32" | "bf16" | "fp16" (autocast)
+                _model_store_dir : Optional[str] = None, # локальное хранилище весов (offline-first)
+                _offline : bool = False, # не ходить в HF Hub: только хранилище и кэш HF
+                _parallel_load : bool = True, # GDINO, процессор GDINO и SAM2 грузятся параллельно
             ) -> None:
         
         """
@@ -57,33 +78,114 @@ class ImageSegmentator:
                 Если True — SAM2 загружается сразу, иначе при первом использовании.
             use_sam (bool): 
                 Использовать ли SAM2. Если False — маски будут None.
+            _mask_on_demand (bool):
+                Если True и use_sam=False — SAM2 создаётся, но веса грузятся лениво при первом
+                вызове predict_masks; predict_with_array / predict_batch масок не считают.
+            _mask_format (str):
+                "array" — маски как np.ndarray (H, W), "rle" — COCO RLE {"size", "counts"},
+                "bitpacked" — {"size", "bits"} (np.packbits в base64). См. MaskCodec.
             _iou_thr (float): 
                 Порог IoU для NMS (внутри класса).
             _beta (float): 
                 Порог вложенности боксов после NMS.
             _alpha_all_classes (float): 
                 Порог межклассового NMS.
+            _nms_backend (str):
+                "numpy" — матричный NMS на NumPy, "torch" — torchvision.ops.batched_nms
+                (правило вложенности beta при этом считается на NumPy).
             _box_thr (float): 
                 Порог по уверенности для боксов (GDINO).
             _text_thr (float): 
                 Порог по уверенности для текстовых классов (GDINO).
+            _gdino_single_pass (bool):
+                Если True — фразы всех меток склеиваются в одну подпись и GDINO
+                прогоняется один раз на изображение, иначе по разу на каждую метку.
+            _gdino_batch_size (int):
+                Максимальный размер батча GDINO в predict_batch.
+            _tiling (bool):
+                Если True — изображения, которые не помещаются в size, детектируются
+                скользящим окном (GdinoModel.detect_boxes_tiled) без потери разрешения;
+                дубликаты между тайлами сливаются общим NMS.
+            _tile_size (int):
+                Сторона тайла в пикселях.
+            _tile_overlap (float):
+                Перекрытие соседних тайлов, доля от _tile_size.
+            _runtime (str):
+                "torch" — модели из from_pretrained (eager PyTorch), "onnx" — графы GDINO и
+                SAM2 (encoder/decoder) из _onnx_dir через ONNX Runtime с графовыми оптимизациями;
+                устройство при этом всегда cpu. Графы готовит `python -m app.ML.export`.
+            _onnx_dir (str):
+                Каталог экспорта ONNX.
+            _ort_threads (int):
+                Число intra-op потоков ONNX Runtime, 0 — решает ORT.
+            _quantize (bool):
+                Если True и модели работают на cpu через torch — все nn.Linear GDINO и SAM2
+                квантуются в int8 (torch.ao.quantization.quantize_dynamic). На GPU и с runtime="onnx"
+                игнорируется. Расхождение с fp32 — `python -m app.ML.benchmark --variants fp32 int8`.
+            _precision (str):
+                "fp32", "bf16" или "fp16": прямые проходы GDINO и SAM2 идут под torch.autocast
+                (cuda и cpu; на mps — fp32). Веса остаются fp32; logits, боксы и маски
+                постобрабатываются в fp32. Несовместимо с _quantize и runtime="onnx" — там fp32.
+                Выигрыш по скорости и памяти — `python -m app.ML.benchmark --variants fp32 bf16 fp16`.
+            _model_store_dir (str, optional):
+                Каталог ModelStore: веса GDINO (save_pretrained) и SAM2 (safetensors) читаются
+                оттуда через mmap; при первом запуске скачиваются с HF Hub и сохраняются туда.
+                None — как раньше, только HF Hub / кэш HF.
+            _offline (bool):
+                Если True — HF Hub не используется (local_files_only), модели берутся из хранилища
+                или кэша HF.
+            _parallel_load (bool):
+                Если True — модели, которые грузятся сразу (_gdino_load_now / _sam2_load_now),
+                загружаются параллельно в потоках. Время стадий — в self.load_timings.
         """
         
 
+        if _mask_format not in MaskCodec.FORMATS:
+            raise ValueError(f"Unsupported mask format: {_mask_format}. Use one of {MaskCodec.FORMATS}.")
         self.use_sam = use_sam
-        self.device = _DEVICE if _DEVICE is not None else self.pick_device()
+        self.mask_format = _mask_format
+        self.tiling = _tiling
+        self.tile_size = _tile_size
+        self.tile_overlap = _tile_overlap
+        if _runtime not in ("torch", "onnx"):
+            raise ValueError(f"Unsupported runtime: {_runtime}. Use 'torch' or 'onnx'.")
+        self.runtime = _runtime
+        if _runtime == "onnx":
+            self.device = "cpu"  # ONNX Runtime — CPUExecutionProvider
+        else:
+            self.device = _DEVICE if _DEVICE is not None else self.pick_device()
+
+        self.quantize = _quantize and self.device == "cpu" and _runtime == "torch"
+        if _quantize and not self.quantize:
+            print(f"int8 quantization is CPU/torch only (device: {self.device}, runtime: {_runtime}); using fp32")
+        if _precision != "fp32" and (self.quantize or _runtime != "torch"):
+            # квантованные слои и графы ONNX считаются в своей точности
+            print(f"{_precision} autocast is ignored with int8 quantization or runtime={_runtime}; using fp32")
+            _precision = "fp32"
+        self.precision = check_precision(_precision, self.device)
+
+        store = ModelStore(_model_store_dir, offline=_offline)
+        # замеры стадий (gdino по группам промптов, nms, sam2) — см. predict_batch_timed
+        self.timer = StageTimer()
 
         self.nms = NmsProcessor(
             iou_thr = _iou_thr,
             beta = _beta,
             alpha_all_classes = _alpha_all_classes,
+            backend = _nms_backend,
         )
 
         self.sam2 = Sam2Model(
             _DEVICE=self.device,
             SAM2_ID=_SAM2_ID,
-            load_now=_sam2_load_now,
-        ) if use_sam else None
+            load_now=False,
+            runtime=_runtime,
+            onnx_dir=_onnx_dir,
+            ort_threads=_ort_threads,
+            quantize=self.quantize,
+            precision=self.precision,
+            store=store,
+        ) if (use_sam or _mask_on_demand) else None
         basePrompts = {
                     "tree":        ["single tree", "dead tree", "one tree"],
                     "bush":        ["bush"],
@@ -94,11 +196,79 @@ class ImageSegmentator:
             _DEVICE = self.device,
             prompts=self.prompts,
             GDINO_ID=_GDINO_ID,
-            load_now=_gdino_load_now,
+            load_now=False,
             box_threshold=_box_thr,
             text_threshold=_text_thr,
             size=size,
+            single_pass=_gdino_single_pass,
+            batch_size=_gdino_batch_size,
+            runtime=_runtime,
+            onnx_dir=_onnx_dir,
+            ort_threads=_ort_threads,
+            quantize=self.quantize,
+            precision=self.precision,
+            store=store,
+            timer=self.timer,
         )
+
+        # Версия моделей, порогов и формата выхода — часть ключа кэша результатов (ResultCache)
+        self.version = hashlib.sha256(json.dumps({
+            "gdino": _GDINO_ID, "sam2": _SAM2_ID if use_sam else None, "prompts": self.prompts,
+            "box_thr": _box_thr, "text_thr": _text_thr, "iou_thr": _iou_thr, "beta": _beta,
+            "alpha_all_classes": _alpha_all_classes, "nms": _nms_backend, "size": size,
+            "single_pass": _gdino_single_pass, "tiling": [_tiling, _tile_size, _tile_overlap],
+            "runtime": _runtime, "quantize": self.quantize, "precision": self.precision,
+            "mask_format": _mask_format,
+        }, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+        # веса грузятся здесь, а не в конструкторах моделей — чтобы параллельно
+        self.parallel_load = _parallel_load
+        self.load_timings: Dict[str, float] = {}
+        self.load(gdino=_gdino_load_now, sam2=_sam2_load_now)
+
+    def load(self, gdino: bool = True, sam2: bool = True) -> Dict[str, float]:
+        """
+        Загружает GDINO (с процессором) и SAM2 (если use_sam); SAM2 режима «маски по запросу»
+        грузится при первом вызове. Возвращает время стадий загрузки (self.load_timings), с.
+        """
+        stages: Dict[str, Callable] = {}
+        if gdino:
+            stages["gdino"] = lambda: self.gdino.GDINO
+            stages["gdino_processor"] = lambda: self.gdino.GPROC
+        if self.sam2 is not None and sam2 and self.use_sam:
+            stages["sam2"] = self.sam2.load
+        if stages:
+            self._load_models(stages, parallel=self.parallel_load)
+        return self.load_timings
+
+    def release(self) -> None:
+        """
+        Выгружает веса из этого процесса (конфигурация, версия и decode_limits остаются).
+        Родитель пула процессов: load() заполняет хранилище моделей, release() — чтобы
+        модели держали только воркеры. Следующее обращение к моделям загрузит их снова.
+        """
+        self.gdino.__dict__.pop("GDINO", None)
+        if self.sam2 is not None:
+            for name in ("sam2", "ort", "_transforms"):
+                self.sam2.__dict__.pop(name, None)
+        gc.collect()
+
+    def _load_models(self, stages: Dict[str, Callable], parallel: bool) -> None:
+        """Загружает модели по стадиям (в потоках, если parallel); время стадий — в self.load_timings."""
+        def timed(name: str, load: Callable) -> None:
+            start = time.perf_counter()
+            load()
+            self.load_timings[name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if parallel and len(stages) > 1:
+            with ThreadPoolExecutor(max_workers=len(stages), thread_name_prefix="model-load") as pool:
+                for future in [pool.submit(timed, name, load) for name, load in stages.items()]:
+                    future.result()
+        else:
+            for name, load in stages.items():
+                timed(name, load)
+        self.load_timings["total"] = time.perf_counter() - start
     
     def predict_with_array(
         self,
@@ -106,19 +276,121 @@ class ImageSegmentator:
     ):
         # image_rgb = np.array(Image.open(image_path).convert("RGB"))
         with torch.inference_mode():    
-            boxes, labels, scores = self.gdino.detect_boxes_hf(image_rgb)
+            boxes, labels, scores = self._detect(image_rgb)
+        return self._postprocess(image_rgb, boxes, labels, scores)
+
+    def predict_batch(
+        self,
+        images_rgb: List[np.ndarray]
+    ) -> List[Tuple[list, list, list, list]]:
+        """
+        Батчевый вариант predict_with_array: GDINO прогоняется батчами,
+        NMS и SAM2 — по каждому изображению отдельно.
+        Возвращает список (masks, boxes, labels, scores) в порядке входных изображений.
+        """
+        if not images_rgb:
+            return []
+        with torch.inference_mode():
+            tiled = [self._use_tiling(img) for img in images_rgb]
+            # обычные изображения — одним батчем, большие — тайлами по одному
+            plain = [img for img, t in zip(images_rgb, tiled) if not t]
+            plain_det = iter(self.gdino.detect_boxes_batch(plain) if plain else [])
+            detections = [
+                self._detect(img) if t else next(plain_det)
+                for img, t in zip(images_rgb, tiled)
+            ]
+        return [
+            self._postprocess(image_rgb, boxes, labels, scores)
+            for image_rgb, (boxes, labels, scores) in zip(images_rgb, detections)
+        ]
+
+    def predict_batch_timed(self, images_rgb: List[np.ndarray]):
+        """predict_batch и замеры стадий этого вызова: (outputs, [(stage, group, seconds), ...])."""
+        with self.timer.collect() as timings:
+            outputs = self.predict_batch(images_rgb)
+        return outputs, timings
+
+    def predict_masks_timed(self, image_rgb: np.ndarray, boxes: List[List[float]]):
+        """predict_masks и замеры стадий этого вызова: (masks, [(stage, group, seconds), ...])."""
+        with self.timer.collect() as timings:
+            masks = self.predict_masks(image_rgb, boxes)
+        return masks, timings
+
+    def warmup(self, shapes: List[Tuple[int, int]], batch_size: int = 1) -> Dict[str, float]:
+        """
+        Прогрев на изображениях форм shapes (H, W) — тех, что реально приходят после декодирования:
+        - детекция через predict_batch отдельно для каждой формы, батчами из 1 и batch_size
+          изображений этой формы: в общем батче _collate допаддил бы все формы до одного холста,
+          и реальные формы GDINO (и тайлы) остались бы непрогретыми;
+        - NMS и SAM2 на синтетических боксах: на шумовом изображении GDINO обычно ничего
+          не находит, а прогреть нужно и подавление, и декодер масок на пачке боксов.
+        Возвращает время стадий прогрева, с.
+        """
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8) for h, w in shapes]
+        timings: Dict[str, float] = {}
+
+        for (h, w), image in zip(shapes, images):
+            start = time.perf_counter()
+            for n in sorted({1, max(1, batch_size)}):
+                self.predict_batch([image] * n)
+            timings[f"detect.{h}x{w}"] = time.perf_counter() - start
+
+        for (h, w), image in zip(shapes, images):
+            start = time.perf_counter()
+            boxes, labels, scores = self._synthetic_boxes(h, w, list(self.prompts.keys()))
+            self._postprocess(image, boxes, labels, scores)
+            timings[f"postprocess.{h}x{w}"] = time.perf_counter() - start
+        return timings
+
+    @staticmethod
+    def _synthetic_boxes(h: int, w: int, labels: List[str], n: int = 8):
+        """n боксов сеткой 4×2 и почти совпадающий дубль каждого — его подавит NMS."""
+        boxes, box_labels, scores = [], [], []
+        for k in range(n):
+            x1, y1 = (k % 4) * w / 4, (k // 4 % 2) * h / 2
+            box = [x1, y1, x1 + 0.9 * w / 4, y1 + 0.9 * h / 2]
+            label = labels[k % len(labels)]
+            boxes += [box, [v + 2.0 for v in box]]
+            box_labels += [label, label]
+            scores += [0.9 - 0.05 * k, 0.5 - 0.02 * k]
+        return boxes, box_labels, scores
+
+    def decode_limits(self) -> Tuple[Optional[int], Optional[int]]:
+        """
+        (shortest_edge, longest_edge), до которых имеет смысл уменьшать изображение уже при декодировании:
+        GDINO всё равно ресайзит до этих рамок. При тайлинге нужно полное разрешение — (None, None).
+        """
+        if self.tiling:
+            return None, None
+        return self.gdino._limits_from_size()
+
+    def _use_tiling(self, image_rgb: np.ndarray) -> bool:
+        return self.tiling and self.gdino.needs_tiling(image_rgb)
+
+    def _detect(self, image_rgb: np.ndarray):
+        """GDINO по одному изображению: тайлами, если изображение больше рамок и включён tiling."""
+        if self._use_tiling(image_rgb):
+            return self.gdino.detect_boxes_tiled(image_rgb, self.tile_size, self.tile_overlap)
+        return self.gdino.detect_boxes_hf(image_rgb)
+
+    def _postprocess(self, image_rgb: np.ndarray, boxes, labels, scores):
+        """NMS + (опц.) маски SAM2 для детекций одного изображения."""
         if not boxes:
             return [], [], [], []
 
-        keep = self.nms.nms_two_stage(boxes, scores, labels)
+        with self.timer.stage("nms"):
+            keep = self.nms.nms_two_stage(boxes, scores, labels)
         boxes_k = [boxes[i] for i in keep]
         labels_k= [labels[i] for i in keep]
         scores_k= [scores[i] for i in keep]
 
         if self.use_sam and self.sam2 is not None:
-            with torch.inference_mode():
+            with torch.inference_mode(), self.timer.stage("sam2"):
                 out = self.sam2.predict_mask(image_rgb, boxes_k)
             masks, ok_idx = out.masks, out.indices
+            # сразу сжимаем маски: дальше по пайплайну идёт компактное представление
+            masks = [MaskCodec.encode(m, self.mask_format) for m in masks]
             # синхронизируем метаданные с реально полученными масками
             boxes_final  = [boxes_k[i]  for i in ok_idx]
             labels_final = [labels_k[i] for i in ok_idx]
@@ -129,6 +401,27 @@ class ImageSegmentator:
 
         return masks, boxes_final, labels_final, scores_final
     
+    def predict_masks(
+        self,
+        image_rgb: np.ndarray,
+        boxes: List[List[float]],
+    ) -> list:
+        """
+        Маски SAM2 для уже известных боксов (режим «маски по запросу»).
+        Возвращает по элементу на бокс, в порядке boxes: маска в формате self.mask_format
+        или None, если SAM2 отбросил бокс (как out.indices в predict_mask).
+        """
+        if self.sam2 is None:
+            raise RuntimeError("SAM2 is disabled: create ImageSegmentator with use_sam=True or _mask_on_demand=True")
+        if not boxes:
+            return []
+        with torch.inference_mode(), self.timer.stage("sam2"):
+            out = self.sam2.predict_mask(image_rgb, boxes)
+        masks: list = [None] * len(boxes)
+        for i, m in zip(out.indices, out.masks):
+            masks[i] = MaskCodec.encode(m, self.mask_format)
+        return masks
+
     def predict_with_text(
         self,
         image_path: str
@@ -0,0 +1,213 @@
+"""
+Сравнение вариантов инференса ImageSegmentator с fp32-базой на валидационном наборе.
+
+    python -m app.ML.benchmark --images data/val --variants fp32 int8
+    python -m app.ML.benchmark --images data/val --variants fp32 bf16 fp16 --device cuda --json report.json
+    python -m app.ML.benchmark --images data/val --variants fp32 single_pass --no-sam
+    python -m app.ML.benchmark --images data/val --variants fp32 onnx --single-pass --device cpu
+
+Разметка не нужна: эталон — выход fp32 на тех же изображениях (GDINO — по прогону на метку,
+как в сервисе по умолчанию; --single-pass — и эталон, и варианты в single-pass). Вариант onnx —
+графы app/ML/export.py в ONNX Runtime против того же single-pass в PyTorch, поэтому только с --single-pass.
+Для каждого варианта:
+- время на изображение (среднее и p95) и ускорение относительно fp32;
+- пиковая память за прогон: на cuda — max_memory_allocated, иначе — пиковый RSS процесса
+  (вместе с весами модели) и отношение к fp32;
+- recall / precision боксов относительно fp32 (совпадение — та же метка и IoU >= --iou);
+- средний |Δscore| и IoU масок по совпавшим боксам.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import numpy as np
+import psutil
+import torch
+
+from .ImageSegmentatator import ImageSegmentator
+from .classes.ImageLoader import decode_image  # без стека сервиса (aio_pika, prometheus, httpx)
+
+# Отличия варианта от fp32-базы (аргументы ImageSegmentator)
+VARIANTS: Dict[str, dict] = {
+    "fp32": {},
+    "int8": {"_quantize": True},
+    "bf16": {"_precision": "bf16"},
+    "fp16": {"_precision": "fp16"},
+    "single_pass": {"_gdino_single_pass": True},  # паритет боксов с прогоном на метку при тех же порогах
+    "onnx": {"_runtime": "onnx", "_gdino_single_pass": True},  # паритет ONNX Runtime с PyTorch (cpu)
+}
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp", ".tif", ".tiff")
+
+
+def load_images(path: str, limit: int, max_short: int, max_long: int) -> List[Tuple[str, np.ndarray]]:
+    """Изображения каталога, декодированные так же, как в сервисе (decode_image)."""
+    names = sorted(n for n in os.listdir(path) if n.lower().endswith(IMAGE_EXTENSIONS))
+    if limit > 0:
+        names = names[:limit]
+    return [(n, decode_image(os.path.join(path, n), max_short, max_long).array) for n in names]
+
+
+def box_iou(a: List[float], b: List[float]) -> float:
+    iw = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    ih = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = iw * ih
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.logical_or(a, b).sum()
+    return 1.0 if union == 0 else float(np.logical_and(a, b).sum() / union)
+
+
+def match(base, other, iou_thr: float) -> List[Tuple[int, int]]:
+    """Жадное сопоставление боксов (по убыванию score базы): пары (i_base, j_other)."""
+    _, base_boxes, base_labels, base_scores = base
+    _, boxes, labels, _ = other
+    used, pairs = set(), []
+    for i in np.argsort(-np.asarray(base_scores, dtype=float)):
+        best_j, best_iou = -1, iou_thr
+        for j, (box, label) in enumerate(zip(boxes, labels)):
+            if j in used or label != base_labels[i]:
+                continue
+            iou = box_iou(base_boxes[i], box)
+            if iou >= best_iou:
+                best_j, best_iou = j, iou
+        if best_j >= 0:
+            used.add(best_j)
+            pairs.append((int(i), best_j))
+    return pairs
+
+
+@contextmanager
+def peak_memory(device: str, interval_s: float = 0.01):
+    """Пиковая память внутри контекста, МБ: result["peak_mb"]."""
+    result = {}
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        yield result
+        torch.cuda.synchronize()
+        result["peak_mb"] = torch.cuda.max_memory_allocated() / 2**20
+        return
+
+    # RSS опрашивается фоновым потоком: ru_maxrss не сбрасывается между вариантами
+    process = psutil.Process()
+    peak = [process.memory_info().rss]
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval_s):
+            peak[0] = max(peak[0], process.memory_info().rss)
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        sampler.join()
+        result["peak_mb"] = peak[0] / 2**20
+
+
+def run(segmentator: ImageSegmentator, images: List[Tuple[str, np.ndarray]]):
+    """Прогон по изображениям: выходы predict_with_array, время на каждое изображение и пиковая память."""
+    outputs, seconds = [], []
+    with peak_memory(segmentator.device) as memory:
+        for _, image in images:
+            start = time.perf_counter()
+            outputs.append(segmentator.predict_with_array(image))
+            seconds.append(time.perf_counter() - start)
+    return outputs, seconds, memory["peak_mb"]
+
+
+def compare(base_outputs, outputs, iou_thr: float) -> dict:
+    n_base = n_other = n_matched = 0
+    score_deltas, mask_ious = [], []
+    for base, other in zip(base_outputs, outputs):
+        pairs = match(base, other, iou_thr)
+        n_base += len(base[1])
+        n_other += len(other[1])
+        n_matched += len(pairs)
+        for i, j in pairs:
+            score_deltas.append(abs(base[3][i] - other[3][j]))
+            if base[0] and other[0]:
+                mask_ious.append(mask_iou(base[0][i], other[0][j]))
+    return {
+        "recall_vs_fp32": n_matched / n_base if n_base else 1.0,
+        "precision_vs_fp32": n_matched / n_other if n_other else 1.0,
+        "mean_abs_score_delta": float(np.mean(score_deltas)) if score_deltas else 0.0,
+        "mean_mask_iou": float(np.mean(mask_ious)) if mask_ious else None,
+        "boxes_fp32": n_base,
+        "boxes": n_other,
+    }
+
+
+def timing(seconds: List[float]) -> dict:
+    # первое изображение — прогрев, в статистику не входит
+    s = np.asarray(seconds[1:] if len(seconds) > 1 else seconds)
+    return {"mean_s": float(s.mean()), "p95_s": float(np.percentile(s, 95))}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Accuracy / latency / memory of ImageSegmentator variants against fp32")
+    parser.add_argument("--images", required=True, help="каталог валидационных изображений")
+    parser.add_argument("--variants", nargs="+", choices=list(VARIANTS), default=["fp32", "int8"])
+    parser.add_argument("--device", default=None, help="cuda | mps | cpu (по умолчанию — pick_device)")
+    parser.add_argument("--limit", type=int, default=0, help="не больше N изображений (0 — все)")
+    parser.add_argument("--iou", type=float, default=0.5, help="IoU совпадения боксов")
+    parser.add_argument("--no-sam", action="store_true", help="без SAM2 (только боксы)")
+    parser.add_argument("--single-pass", action="store_true", help="GDINO single-pass для всех вариантов")
+    parser.add_argument("--onnx-dir", default="models/onnx", help="графы для варианта onnx (python -m app.ML.export)")
+    parser.add_argument("--json", default=None, help="сохранить отчёт в JSON")
+    args = parser.parse_args(argv)
+    if "onnx" in args.variants and not args.single_pass:
+        # иначе в расхождение попадёт и разница single-pass / прогон на метку
+        parser.error("вариант onnx сравнивается с single-pass эталоном: добавьте --single-pass")
+
+    def build(variant: str) -> ImageSegmentator:
+        return ImageSegmentator(
+            _DEVICE=args.device,
+            use_sam=not args.no_sam,
+            _onnx_dir=args.onnx_dir,
+            **{"_gdino_single_pass": args.single_pass, **VARIANTS[variant]},
+        )
+
+    report = {}
+    segmentator = build("fp32")
+    images = load_images(args.images, args.limit, *segmentator.decode_limits())
+    print(f"{len(images)} images, device: {segmentator.device}")
+    base_outputs, seconds, peak_mb = run(segmentator, images)
+    report["fp32"] = {**timing(seconds), "peak_mem_mb": peak_mb}
+
+    for variant in args.variants:
+        if variant == "fp32":
+            continue
+        # одна модель в памяти за раз
+        del segmentator
+        gc.collect()
+        segmentator = build(variant)
+        outputs, seconds, peak_mb = run(segmentator, images)
+        row = timing(seconds)
+        row["speedup_vs_fp32"] = report["fp32"]["mean_s"] / row["mean_s"]
+        row["peak_mem_mb"] = peak_mb
+        row["mem_ratio_vs_fp32"] = peak_mb / report["fp32"]["peak_mem_mb"]
+        report[variant] = {**row, **compare(base_outputs, outputs, args.iou)}
+
+    for variant, row in report.items():
+        print(f"{variant:>6}: " + ", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}" for k, v in row.items()))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,16 @@
 from transformers import GroundingDinoProcessor, GroundingDinoForObjectDetection
 from functools import cached_property
+from contextlib import contextmanager
+import threading
 import torch
 import numpy as np
-from typing import List
+from typing import List, Tuple
 from PIL import Image
+from .OrtModels import OrtGdino
+from .Quantization import quantize_linear_int8
+from .Precision import autocast, check_precision
+from .ModelStore import ModelStore
+from .StageTimer import StageTimer
 
 
 class GdinoModel:
@@ -15,14 +22,39 @@ class GdinoModel:
             load_now : bool = True,
             box_threshold: float = 0.20, 
             text_threshold: float = 0.20,
-            size = {"shortest_edge": 1200, "longest_edge": 1900}
+            size = {"shortest_edge": 1200, "longest_edge": 1900},
+            single_pass: bool = False, # все метки одной подписью за один прогон GDINO
+            batch_size: int = 4, # сколько изображений прогонять через GDINO за раз
+            runtime: str = "torch", # "torch" | "onnx" (граф из app/ML/export.py, ONNX Runtime на CPU)
+            onnx_dir: str = "models/onnx",
+            ort_threads: int = 0,
+            quantize: bool = False, # int8 dynamic quantization nn.Linear (только cpu + torch)
+            precision: str = "fp32", # "fp32" | "bf16" | "fp16" — autocast прямых проходов GDINO
+            store: ModelStore = None, # локальное хранилище весов; None — только HF Hub
+            timer: StageTimer = None, # замеры стадий: gdino / группа промптов
             ) -> None:
+        if runtime not in ("torch", "onnx"):
+            raise ValueError("Unsupported GDINO runtime. Use 'torch' or 'onnx'.")
+        if runtime == "onnx" and not single_pass:
+            # в ONNX-граф запечена одна подпись — single-pass подпись всех промптов
+            raise ValueError("GDINO ONNX runtime requires single_pass=True.")
         self.size = size
         self.device = _DEVICE
         self.GDINO_ID = GDINO_ID
         self.prompts = prompts
         self.box_threshold = box_threshold
         self.text_threshold = text_threshold
+        self.single_pass = single_pass
+        self.batch_size = max(1, int(batch_size))
+        self.runtime = runtime
+        self.onnx_dir = onnx_dir
+        self.ort_threads = ort_threads
+        self.quantize = quantize
+        self.precision = check_precision(precision, _DEVICE)
+        self.store = store if store is not None else ModelStore()
+        self.timer = timer if timer is not None else StageTimer()
+        self._text_cache = {}  # подпись -> токенизированный текст на self.device
+        self._features = threading.local()  # признаки бэкбона текущего изображения (на поток)
 
         if load_now:
              _, _ = self.GDINO, self.GPROC
@@ -34,25 +66,213 @@ class GdinoModel:
     @cached_property
     def GPROC(self):
         print('GDINO processor is loading...')
-        proc = GroundingDinoProcessor.from_pretrained(self.GDINO_ID)
-        proc.image_processor.size = self.size
+        source = self.store.gdino_source(self.GDINO_ID, "preprocessor_config.json")
+        proc = GroundingDinoProcessor.from_pretrained(source, local_files_only=self.store.offline)
         if proc is None:
             raise RuntimeError("GDINO processor is not loaded!")
         else:
             print("GDINO processor is loaded!")
+        self.store.persist_pretrained(self.GDINO_ID, proc, "preprocessor_config.json")
+        proc.image_processor.size = self.size
         return proc
     
     @cached_property
     def GDINO(self):
+        if self.runtime == "onnx":
+            # тот же интерфейс вызова и выхода, что у GroundingDinoForObjectDetection
+            print('GDINO ONNX graph is loading...')
+            model = OrtGdino(self.onnx_dir, self.ort_threads)
+            print("GDINO ONNX graph is loaded!")
+            return model
         print('GDINO weights are loading...')
-        model = GroundingDinoForObjectDetection.from_pretrained(self.GDINO_ID).to(self.device).eval()
+        source = self.store.gdino_source(self.GDINO_ID, "config.json", "model.safetensors")
+        model = GroundingDinoForObjectDetection.from_pretrained(source, local_files_only=self.store.offline)
         if model is None:
             raise RuntimeError("GDINO weights not loaded!")
         else:
             print("GDINO weights are loaded!")
+        self.store.persist_pretrained(self.GDINO_ID, model, "config.json", "model.safetensors")
+        model = model.to(self.device).eval()
+        if self.device == "cpu" and not self.quantize:
+            # веса — страницы mmap файла хранилища, одни на все процессы-воркеры пула;
+            # quantize_dynamic копирует модель целиком, там делить нечего
+            self.store.map_weights(self.GDINO_ID, model, "model.safetensors")
+        if self.quantize:
+            model = quantize_linear_int8(model)
+            print("GDINO linear layers are quantized to int8!")
+        self._install_backbone_hook(model)
         return model
 
-    
+    @cached_property
+    def _single_pass_plan(self):
+        """
+        Одна общая подпись для всех меток из self.prompts.
+        Возвращает (caption, token_masks, labels), где token_masks — bool-тензор
+        (num_labels, max_text_len): какие токены подписи принадлежат фразам метки.
+        """
+        labels = list(self.prompts.keys())
+        parts, spans, pos = [], [], 0
+        for label, phrases in self.prompts.items():
+            for p in phrases:
+                t = self.preprocess_caption(p)
+                # спан фразы без завершающей точки
+                spans.append((labels.index(label), pos, pos + len(t) - 1))
+                parts.append(t)
+                pos += len(t) + 1  # + пробел-разделитель
+        caption = " ".join(parts)
+
+        max_text_len = self.GDINO.config.max_text_len
+        enc = self.GPROC.tokenizer(caption, return_offsets_mapping=True)
+        if len(enc["input_ids"]) > max_text_len:
+            raise ValueError(
+                f"Caption is too long for single-pass GDINO: {len(enc['input_ids'])} tokens > {max_text_len}"
+            )
+
+        token_masks = torch.zeros((len(labels), max_text_len), dtype=torch.bool)
+        for k, (s, e) in enumerate(enc["offset_mapping"]):
+            if s == e:  # спецтокены [CLS]/[SEP]
+                continue
+            for li, start, end in spans:
+                if s >= start and e <= end:
+                    token_masks[li, k] = True
+                    break
+        return caption, token_masks.to(self.device), labels
+
+    def _encode_text(self, caption: str):
+        """Токенизирует подпись один раз и держит результат на устройстве — промпты не меняются между запросами."""
+        enc = self._text_cache.get(caption)
+        if enc is None:
+            enc = self.GPROC(text=caption, return_tensors="pt").to(self.device)
+            self._text_cache[caption] = enc
+        return enc
+
+    def _preprocess_image(self, pil_img: Image.Image, proc_kwargs: dict):
+        """pixel_values / pixel_mask одного изображения (ресайз и нормализация один раз на изображение)."""
+        return self.GPROC.image_processor(
+            images=pil_img,
+            return_tensors="pt",
+            **proc_kwargs,
+        ).to(self.device)
+
+    def _collate(self, image_inputs: List[dict]) -> dict:
+        """
+        Собирает изображения разного размера в один батч: паддинг нулями вправо/вниз
+        до максимальных H, W, pixel_mask=0 на паддинге (так же, как это делает GPROC для батча).
+        """
+        if len(image_inputs) == 1:
+            return image_inputs[0]
+        h = max(x["pixel_values"].shape[-2] for x in image_inputs)
+        w = max(x["pixel_values"].shape[-1] for x in image_inputs)
+        ref = image_inputs[0]
+        pixel_values = ref["pixel_values"].new_zeros((len(image_inputs), ref["pixel_values"].shape[1], h, w))
+        pixel_mask = ref["pixel_mask"].new_zeros((len(image_inputs), h, w))
+        for i, x in enumerate(image_inputs):
+            hi, wi = x["pixel_values"].shape[-2:]
+            pixel_values[i, :, :hi, :wi] = x["pixel_values"][0]
+            pixel_mask[i, :hi, :wi] = x["pixel_mask"][0]
+        return {"pixel_values": pixel_values, "pixel_mask": pixel_mask}
+
+    @staticmethod
+    def _repeat_text(text_inputs, n: int) -> dict:
+        """Одна и та же подпись для n изображений батча."""
+        return {k: v.repeat(n, 1) for k, v in text_inputs.items()}
+
+    def _install_backbone_hook(self, model) -> None:
+        """
+        Подменяет forward бэкбона GDINO один раз при загрузке: если для текущего потока уже посчитаны
+        признаки изображения (см. _shared_backbone), возвращает их вместо повторного прогона.
+        Между вызовами меняется только thread-local состояние, сама подмена общая для всех потоков.
+        """
+        backbone = model.model.backbone
+        orig_forward = backbone.forward
+
+        def forward(pixel_values, pixel_mask):
+            cached = getattr(self._features, "value", None)
+            if cached is None:
+                return orig_forward(pixel_values, pixel_mask)
+            features, pos = cached
+            # GDINO дописывает в список позиционных эмбеддингов — отдаём копии
+            return list(features), list(pos)
+
+        backbone.forward = forward
+
+    @contextmanager
+    def _shared_backbone(self, image_inputs):
+        """Внутри контекста все прогоны GDINO переиспользуют признаки бэкбона для image_inputs."""
+        with self.timer.stage("gdino", "backbone"), autocast(self.device, self.precision):
+            self._features.value = self.GDINO.model.backbone(
+                image_inputs["pixel_values"], image_inputs["pixel_mask"]
+            )
+        try:
+            yield
+        finally:
+            self._features.value = None
+
+    def _forward(self, image_inputs: dict, text_inputs: dict):
+        """
+        Прямой проход GDINO в точности self.precision; logits и pred_boxes
+        возвращаются в fp32, чтобы пороги и координаты боксов считались в полной точности.
+        """
+        with autocast(self.device, self.precision):
+            outputs = self.GDINO(**image_inputs, **text_inputs)
+        outputs.logits = outputs.logits.float()
+        outputs.pred_boxes = outputs.pred_boxes.float()
+        return outputs
+
+    def _boxes_to_xyxy(self, pred_boxes: torch.Tensor, H: int, W: int) -> torch.Tensor:
+        """(cx, cy, w, h) в долях -> (x1, y1, x2, y2) в пикселях исходного изображения."""
+        cx, cy, w, h = pred_boxes.float().unbind(-1)
+        boxes = torch.stack([cx - 0.5 * w, cy - 0.5 * h, cx + 0.5 * w, cy + 0.5 * h], dim=-1)
+        scale = torch.tensor([W, H, W, H], dtype=boxes.dtype, device=boxes.device)
+        return boxes * scale
+
+    def _decode_by_labels(self, logits, pred_boxes, token_masks, labels, H, W):
+        """
+        Разбирает выход GDINO одного изображения по меткам.
+        Score бокса для метки — максимум вероятности по токенам её фраз;
+        бокс попадает в метку, если score > box_threshold (как при отдельном прогоне на метку).
+        """
+        probs = logits.float().sigmoid()  # (num_queries, max_text_len)
+        # (num_queries, num_labels): probs >= 0, поэтому маскирование умножением корректно
+        label_scores = (probs.unsqueeze(1) * token_masks.unsqueeze(0)).amax(dim=-1)
+        boxes = self._boxes_to_xyxy(pred_boxes, H, W)
+
+        boxes_all, labels_all, scores_all = [], [], []
+        for li, label in enumerate(labels):
+            scores = label_scores[:, li]
+            keep = scores > self.box_threshold
+            boxes_all.extend(boxes[keep].cpu().numpy().tolist())
+            scores_all.extend(scores[keep].cpu().numpy().tolist())
+            labels_all.extend([label] * int(keep.sum()))
+        return boxes_all, labels_all, scores_all
+
+    def _processor_kwargs(self, H: int, W: int) -> dict:
+        """
+        Аргументы ресайза для GPROC:
+        - если обе стороны изображения <= рамок (shortest_edge/longest_edge), то do_resize=False (оставляем родное разрешение);
+        - иначе ресайзим до self.size.
+        """
+        short, long_ = (H, W) if H < W else (W, H)
+
+        target_short, target_long = self._limits_from_size()
+
+        # признак «картинка уже в рамках»
+        within_short = (target_short is None) or (short <= target_short)
+        within_long = (target_long is None) or (long_ <= target_long)
+        if within_short and within_long:
+            # не ресайзим вовсе
+            return {"do_resize": False}
+
+        # ресайзим вниз до заданных рамок
+        # поддержка обоих вариантов ключей
+        size_arg = {}
+        if target_short is not None:
+            size_arg["shortest_edge"] = target_short
+        if target_long is not None:
+            # одновременно передавать оба безопасно: лишний игнорируется
+            size_arg["longest_edge"] = target_long
+        return {"do_resize": True, "size": size_arg if size_arg else None}
+
     def _limits_from_size(self):
         """
         Возвращает (target_short, target_long_or_max) из self.size.
@@ -71,67 +291,137 @@ class GdinoModel:
     def detect_boxes_hf(self, image_rgb):
         """
         Возвращает: boxes_xyxy (List[List[float]]), labels (List[str]), scores (List[float])
-        Логика ресайза:
-        - если обе стороны изображения <= рамок (shortest_edge/longest_edge), то do_resize=False (оставляем родное разрешение);
-        - иначе ресайзим до self.size.
+        Логика ресайза — см. _processor_kwargs.
+        Если single_pass=True — один прогон на все метки, иначе отдельный прогон на каждую метку.
         """
-        H, W = image_rgb.shape[:2]
-        short, long_ = (H, W) if H < W else (W, H)
+        return self.detect_boxes_batch([image_rgb])[0]
 
-        target_short, target_long = self._limits_from_size()
+    @torch.no_grad()
+    def detect_boxes_batch(self, images_rgb: List[np.ndarray]) -> List[Tuple[List[List[float]], List[str], List[float]]]:
+        """
+        Батчевая детекция: для каждого изображения возвращает (boxes_xyxy, labels, scores),
+        как detect_boxes_hf. Изображения группируются по ориентации и площади,
+        чтобы в один батч GDINO попадали близкие по размеру картинки (меньше паддинга).
+        """
+        results: List = [None] * len(images_rgb)
+        order = sorted(
+            range(len(images_rgb)),
+            key=lambda i: (images_rgb[i].shape[0] > images_rgb[i].shape[1],
+                           images_rgb[i].shape[0] * images_rgb[i].shape[1]),
+        )
+        for start in range(0, len(order), self.batch_size):
+            chunk = order[start:start + self.batch_size]
+            for i, res in zip(chunk, self._detect_chunk([images_rgb[i] for i in chunk])):
+                results[i] = res
+        return results
 
-        # признак «картинка уже в рамках»
-        within_short = (target_short is None) or (short <= target_short)
-        within_long = (target_long is None) or (long_ <= target_long)
-        within_limits = within_short and within_long
+    @staticmethod
+    def _tile_starts(length: int, tile: int, step: int) -> List[int]:
+        """
+        Начала тайлов вдоль одной оси: тайлы равномерно покрывают [0, length)
+        с шагом не больше step (перекрытие не меньше заданного), крайние прижаты к краям.
+        """
+        if length <= tile:
+            return [0]
+        n = -(-(length - tile) // step) + 1  # ceil((length - tile) / step) + 1
+        return [round(i * (length - tile) / (n - 1)) for i in range(n)]
 
-        boxes_all, labels_all, scores_all = [], [], []
+    def needs_tiling(self, image_rgb: np.ndarray) -> bool:
+        """Картинка больше рамок self.size — при обычной детекции её пришлось бы уменьшать."""
+        return self._processor_kwargs(*image_rgb.shape[:2])["do_resize"]
 
-        pil_img = Image.fromarray(image_rgb)
+    @torch.no_grad()
+    def detect_boxes_tiled(
+        self,
+        image_rgb: np.ndarray,
+        tile_size: int = 1024,
+        overlap: float = 0.25,
+    ) -> Tuple[List[List[float]], List[str], List[float]]:
+        """
+        Детекция на больших изображениях скользящим окном.
+        - изображение режется на тайлы tile_size×tile_size с перекрытием overlap (доля тайла);
+        - тайлы прогоняются через GDINO батчами в родном разрешении, боксы переводятся в координаты изображения;
+        - боксы, касающиеся внутренней границы тайла, отбрасываются: объект меньше перекрытия
+          целиком попадает в соседний тайл, а крупные объекты находит общий проход по уменьшенному изображению;
+        - к тайлам добавляется обычный проход detect_boxes_hf по всему изображению — отдельным прогоном,
+          а не в батче с тайлами.
+        Дубликаты между тайлами не сливаются здесь — это делает NmsProcessor у вызывающего.
+        """
+        H, W = image_rgb.shape[:2]
+        tile = int(tile_size)
+        step = max(1, int(round(tile * (1.0 - overlap))))
+        edge = 2.0  # px: бокс «касается» границы тайла
 
-        for label, phrases in self.prompts.items():
-            text = " ".join(self.preprocess_caption(p) for p in phrases)
-
-            if within_limits:
-                # не ресайзим вовсе
-                inputs = self.GPROC(
-                    images=pil_img,
-                    text=text,
-                    return_tensors="pt",
-                    do_resize=False,          # ключевой флаг
-                ).to(self.device)
-            else:
-                # ресайзим вниз до заданных рамок
-                # поддержка обоих вариантов ключей
-                size_arg = {}
-                if target_short is not None:
-                    size_arg["shortest_edge"] = target_short
-                if target_long is not None:
-                    # одновременно передавать оба безопасно: лишний игнорируется
-                    size_arg["longest_edge"] = target_long
-
-                inputs = self.GPROC(
-                    images=pil_img,
-                    text=text,
-                    return_tensors="pt",
-                    do_resize=True,
-                    size=size_arg if size_arg else None,
-                ).to(self.device)
-
-            outputs = self.GDINO(**inputs)
-
-            # ВАЖНО: target_sizes должны быть исходными (H, W),
-            # чтобы боксы вернулись в пиксели оригинала
-            results = self.GPROC.post_process_grounded_object_detection(
-                outputs,
-                threshold=self.box_threshold,
-                target_sizes=[(H, W)],
-                text_threshold=self.text_threshold,
-            )[0]
-
-            for b, s in zip(results["boxes"], results["scores"]):
-                boxes_all.append(b.cpu().numpy().tolist())
+        windows = [
+            (x0, y0, min(x0 + tile, W), min(y0 + tile, H))
+            for y0 in self._tile_starts(H, tile, step)
+            for x0 in self._tile_starts(W, tile, step)
+        ]
+        tiles = [np.ascontiguousarray(image_rgb[y0:y1, x0:x1]) for x0, y0, x1, y1 in windows]
+
+        # общий проход — отдельным вызовом: в одном батче с ним тайлы паддились бы до холста всего изображения
+        boxes_all, labels_all, scores_all = (list(x) for x in self.detect_boxes_hf(image_rgb))
+        # тайлы — своими батчами (detect_boxes_batch группирует их по размеру)
+        detections = self.detect_boxes_batch(tiles)
+
+        for (x0, y0, x1, y1), (boxes, labels, scores) in zip(windows, detections):
+            tw, th = x1 - x0, y1 - y0
+            for (bx1, by1, bx2, by2), label, score in zip(boxes, labels, scores):
+                # внутренние границы тайла (не совпадающие с краем изображения)
+                if (x0 > 0 and bx1 <= edge) or (y0 > 0 and by1 <= edge) \
+                        or (x1 < W and bx2 >= tw - edge) or (y1 < H and by2 >= th - edge):
+                    continue
+                boxes_all.append([bx1 + x0, by1 + y0, bx2 + x0, by2 + y0])
                 labels_all.append(label)
-                scores_all.append(float(s))
+                scores_all.append(score)
+
+        return boxes_all, labels_all, scores_all
+
+    def _detect_chunk(self, images_rgb: List[np.ndarray]):
+        """Один прогон GDINO (или по прогону на группу промптов) для батча изображений."""
+        sizes = [img.shape[:2] for img in images_rgb]
+
+        # ресайз/нормализация изображения — один раз, независимо от числа меток
+        with self.timer.stage("gdino", "preprocess"):
+            image_inputs = self._collate([
+                self._preprocess_image(Image.fromarray(img), self._processor_kwargs(H, W))
+                for img, (H, W) in zip(images_rgb, sizes)
+            ])
+        n = len(images_rgb)
+
+        if self.single_pass:
+            # один прогон GDINO на все метки: токены фраз сопоставляются своим меткам
+            caption, token_masks, labels = self._single_pass_plan
+            with self.timer.stage("gdino", "all"):
+                outputs = self._forward(image_inputs, self._repeat_text(self._encode_text(caption), n))
+                return [
+                    self._decode_by_labels(outputs.logits[b], outputs.pred_boxes[b], token_masks, labels, H, W)
+                    for b, (H, W) in enumerate(sizes)
+                ]
+
+        per_image = [([], [], []) for _ in range(n)]
+
+        # бэкбон считается один раз, каждая группа промптов прогоняет только текст + fusion/декодер
+        with self._shared_backbone(image_inputs):
+            for label, phrases in self.prompts.items():
+                text = " ".join(self.preprocess_caption(p) for p in phrases)
+
+                with self.timer.stage("gdino", label):
+                    outputs = self._forward(image_inputs, self._repeat_text(self._encode_text(text), n))
+
+                    # ВАЖНО: target_sizes должны быть исходными (H, W),
+                    # чтобы боксы вернулись в пиксели оригинала
+                    results = self.GPROC.post_process_grounded_object_detection(
+                        outputs,
+                        threshold=self.box_threshold,
+                        target_sizes=sizes,
+                        text_threshold=self.text_threshold,
+                    )
+
+                for (boxes_all, labels_all, scores_all), res in zip(per_image, results):
+                    for b, s in zip(res["boxes"], res["scores"]):
+                        boxes_all.append(b.cpu().numpy().tolist())
+                        labels_all.append(label)
+                        scores_all.append(float(s))
 
-        return boxes_all, labels_all, scores_all
\ No newline at end of file
+        return per_image
@@ -0,0 +1,83 @@
+"""
+Декодирование изображений для backend_2: один раз и сразу в разрешении анализа
+"""
+import io
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+from PIL import Image, ImageOps
+
+# EXIF-тег Orientation и значения, при которых ширина и высота меняются местами
+_EXIF_ORIENTATION = 0x0112
+_ROTATED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+@dataclass
+class LoadedImage:
+    """
+    Декодированное изображение в разрешении анализа.
+    orig_size — (width, height) исходного изображения с учётом EXIF-ориентации;
+    scale_x / scale_y — множители из координат array в координаты оригинала.
+    """
+    array: np.ndarray
+    orig_size: Tuple[int, int]
+    scale_x: float = 1.0
+    scale_y: float = 1.0
+    num_bytes: int = 0
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        """(width, height) декодированного массива"""
+        return self.array.shape[1], self.array.shape[0]
+
+    def to_original(self, boxes: List[List[float]]) -> List[List[float]]:
+        """Боксы xyxy из координат array в пиксели оригинала"""
+        sx, sy = self.scale_x, self.scale_y
+        return [[float(b[0]) * sx, float(b[1]) * sy, float(b[2]) * sx, float(b[3]) * sy] for b in boxes]
+
+    def to_analysis(self, boxes: List[List[float]]) -> List[List[float]]:
+        """Боксы xyxy из пикселей оригинала в координаты array"""
+        sx, sy = self.scale_x, self.scale_y
+        return [[float(b[0]) / sx, float(b[1]) / sy, float(b[2]) / sx, float(b[3]) / sy] for b in boxes]
+
+
+def decode_image(
+    source: Union[bytes, str],
+    max_short_edge: Optional[int] = None,
+    max_long_edge: Optional[int] = None,
+) -> LoadedImage:
+    """
+    Декодирует изображение (байты или путь) в RGB uint8 с учётом EXIF-ориентации.
+    Если заданы рамки, JPEG декодируется сразу в уменьшенном масштабе (draft mode: 1/2, 1/4, 1/8),
+    но не меньше рамок — дальнейший ресайз до точного размера делает процессор GDINO.
+    Для остальных форматов draft ничего не делает и изображение декодируется целиком.
+    """
+    num_bytes = len(source) if isinstance(source, (bytes, bytearray, memoryview)) else 0
+    img = Image.open(io.BytesIO(source) if num_bytes else source)
+
+    orientation = img.getexif().get(_EXIF_ORIENTATION, 1)
+    w0, h0 = img.size
+    orig_w, orig_h = (h0, w0) if orientation in _ROTATED_ORIENTATIONS else (w0, h0)
+
+    scale = 1.0
+    short, long_ = min(w0, h0), max(w0, h0)
+    if max_short_edge:
+        scale = min(scale, max_short_edge / short)
+    if max_long_edge:
+        scale = min(scale, max_long_edge / long_)
+    if scale < 1.0:
+        # draft выбирает наибольшее уменьшение, при котором размер не меньше запрошенного
+        img.draft("RGB", (math.ceil(w0 * scale), math.ceil(h0 * scale)))
+
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    array = np.asarray(img, dtype=np.uint8)
+    h, w = array.shape[:2]
+    return LoadedImage(
+        array=array,
+        orig_size=(orig_w, orig_h),
+        scale_x=orig_w / w,
+        scale_y=orig_h / h,
+        num_bytes=num_bytes,
+    )
@@ -0,0 +1,101 @@
+import base64
+import numpy as np
+from typing import List
+
+
+class MaskCodec:
+    """
+    Компактное представление бинарных масок для передачи по пайплайну:
+    - "rle": COCO RLE (column-major, сжатая строка counts) — совместимо с pycocotools.mask.decode;
+    - "bitpacked": np.packbits по строкам (row-major) в base64.
+    Маска H×W занимает ~H*W/8 байт в bitpacked и обычно сотни байт в RLE вместо H*W байт.
+    """
+
+    FORMATS = ("array", "rle", "bitpacked")
+
+    @staticmethod
+    def _rle_counts(mask: np.ndarray) -> List[int]:
+        """Длины серий 0/1 в column-major порядке, первая серия — нули (может быть 0)."""
+        flat = np.asarray(mask, dtype=bool).ravel(order="F")
+        if flat.size == 0:
+            return []
+        change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        counts = np.diff(np.concatenate(([0], change, [flat.size])))
+        if flat[0]:
+            counts = np.concatenate(([0], counts))
+        return counts.tolist()
+
+    @staticmethod
+    def _counts_to_string(counts: List[int]) -> str:
+        """Сжатие counts в строку, как rleToString в pycocotools (дельты + 5-битные группы)."""
+        out = []
+        for i, x in enumerate(counts):
+            if i > 2:
+                x -= counts[i - 2]
+            more = True
+            while more:
+                c = x & 0x1F
+                x >>= 5
+                more = (x != -1) if (c & 0x10) else (x != 0)
+                if more:
+                    c |= 0x20
+                out.append(chr(c + 48))
+        return "".join(out)
+
+    @staticmethod
+    def _string_to_counts(s: str) -> List[int]:
+        """Обратное преобразование к _counts_to_string (rleFrString в pycocotools)."""
+        counts: List[int] = []
+        p = 0
+        while p < len(s):
+            x, k, more = 0, 0, True
+            while more:
+                c = ord(s[p]) - 48
+                x |= (c & 0x1F) << (5 * k)
+                more = bool(c & 0x20)
+                p += 1
+                k += 1
+                if not more and (c & 0x10):
+                    x |= -1 << (5 * k)
+            if len(counts) > 2:
+                x += counts[-2]
+            counts.append(x)
+        return counts
+
+    @classmethod
+    def encode_rle(cls, mask: np.ndarray) -> dict:
+        h, w = mask.shape[:2]
+        return {"size": [int(h), int(w)], "counts": cls._counts_to_string(cls._rle_counts(mask))}
+
+    @classmethod
+    def decode_rle(cls, rle: dict) -> np.ndarray:
+        h, w = rle["size"]
+        counts = rle["counts"]
+        if isinstance(counts, str):
+            counts = cls._string_to_counts(counts)
+        values = np.arange(len(counts)) % 2 == 1  # серии чередуются: 0, 1, 0, ...
+        flat = np.repeat(values, counts)
+        return flat.reshape((w, h)).T
+
+    @staticmethod
+    def encode_bitpacked(mask: np.ndarray) -> dict:
+        h, w = mask.shape[:2]
+        bits = np.packbits(np.asarray(mask, dtype=bool), axis=None)
+        return {"size": [int(h), int(w)], "bits": base64.b64encode(bits.tobytes()).decode("ascii")}
+
+    @staticmethod
+    def decode_bitpacked(packed: dict) -> np.ndarray:
+        h, w = packed["size"]
+        bits = np.frombuffer(base64.b64decode(packed["bits"]), dtype=np.uint8)
+        return np.unpackbits(bits, count=h * w).astype(bool).reshape(h, w)
+
+    @classmethod
+    def encode(cls, mask: np.ndarray, fmt: str = "rle"):
+        """Кодирует маску в формат fmt; "array" возвращает маску как есть."""
+        if fmt == "array":
+            return mask
+        if fmt == "rle":
+            return cls.encode_rle(mask)
+        if fmt == "bitpacked":
+            return cls.encode_bitpacked(mask)
+        raise ValueError(f"Unsupported mask format: {fmt}. Use one of {cls.FORMATS}.")
@@ -0,0 +1,157 @@
+import json
+import os
+import shutil
+import struct
+import tempfile
+from typing import Callable, Dict, Optional
+
+import torch
+
+SAM2_META = "sam2.json"
+SAM2_WEIGHTS = "model.safetensors"
+
+# dtype в заголовке safetensors -> torch
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64, "F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16,
+    "I64": torch.int64, "I32": torch.int32, "I16": torch.int16, "I8": torch.int8,
+    "U8": torch.uint8, "BOOL": torch.bool,
+}
+
+
+class ModelStore:
+    """
+    Локальное хранилище моделей (offline-first).
+
+    root/<org>--<name>/ — каталог на модель:
+    - GDINO: save_pretrained модели и процессора (config.json, model.safetensors, файлы токенизатора);
+    - SAM2: model.safetensors (state_dict из .pt чекпойнта) + sam2.json с именем hydra-конфига.
+    Веса в safetensors читаются через mmap, без обращения к HF Hub; на cpu параметры моделей
+    остаются страницами этого mmap (map_weights) — процессы-воркеры пула делят одну копию весов.
+    Если модели в хранилище нет, она один раз скачивается с Hub (или берётся из кэша HF
+    при offline=True) и сохраняется в root; файлы появляются атомарно (os.replace).
+    """
+
+    def __init__(self, root: Optional[str] = None, offline: bool = False) -> None:
+        self.root = root
+        self.offline = offline
+
+    def model_dir(self, model_id: str) -> Optional[str]:
+        if self.root is None:
+            return None
+        return os.path.join(self.root, model_id.replace("/", "--"))
+
+    def has(self, model_id: str, *files: str) -> bool:
+        path = self.model_dir(model_id)
+        return path is not None and all(os.path.exists(os.path.join(path, f)) for f in files)
+
+    def _persist(self, model_id: str, save: Callable[[str], None]) -> None:
+        """save(tmp_dir) пишет файлы во временный каталог, затем они переносятся в каталог модели."""
+        path = self.model_dir(model_id)
+        if path is None:
+            return
+        os.makedirs(path, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=".tmp-")
+        try:
+            save(tmp)
+            for name in os.listdir(tmp):
+                os.replace(os.path.join(tmp, name), os.path.join(path, name))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # Общие веса (cpu)
+
+    @staticmethod
+    def mmap_safetensors(path: str) -> Dict[str, torch.Tensor]:
+        """
+        Тензоры safetensors-файла без копирования: представления поверх mmap всего файла (MAP_PRIVATE).
+        Страницы берутся из page cache и общие для всех процессов, отобразивших тот же файл;
+        своя копия страницы появляется только при записи в неё, а веса при инференсе не меняются.
+        """
+        with open(path, "rb") as f:
+            header_len = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_len))
+        header.pop("__metadata__", None)
+        storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+        data = torch.empty(0, dtype=torch.uint8).set_(storage)
+        start = 8 + header_len
+        tensors = {}
+        for name, info in header.items():
+            dtype = SAFETENSORS_DTYPES[info["dtype"]]
+            begin, end = info["data_offsets"]
+            chunk = data[start + begin:start + end]
+            if (start + begin) % torch.empty(0, dtype=dtype).element_size():
+                chunk = chunk.clone()  # невыровненный тензор не представить как view — копия только его
+            tensors[name] = chunk.view(dtype).view(info["shape"])
+        return tensors
+
+    def map_weights(self, model_id: str, module: torch.nn.Module, filename: str, strict: bool = False) -> int:
+        """
+        Подменяет параметры и буферы module тензорами из mmap файла хранилища (mmap_safetensors)
+        с тем же именем, формой и dtype. Возвращает число подменённых тензоров; 0 — файла в хранилище нет.
+        strict=False — module уже загружен из этого файла, остальные тензоры (например, связанные веса,
+        которые save_pretrained не пишет) остаются копией процесса. Только для cpu.
+        """
+        if not self.has(model_id, filename):
+            return 0
+        state = self.mmap_safetensors(os.path.join(self.model_dir(model_id), filename))
+        if not strict:
+            own = module.state_dict()
+            state = {
+                name: t for name, t in state.items()
+                if name in own and own[name].shape == t.shape and own[name].dtype == t.dtype
+            }
+        module.load_state_dict(state, strict=strict, assign=True)
+        return len(state)
+
+    # GDINO (transformers)
+
+    def gdino_source(self, model_id: str, *files: str) -> str:
+        """Локальный каталог, если в нём есть files, иначе model_id для HF Hub."""
+        return self.model_dir(model_id) if self.has(model_id, *files) else model_id
+
+    def persist_pretrained(self, model_id: str, obj, *files: str) -> None:
+        """Сохраняет модель / процессор transformers (save_pretrained), если их ещё нет в хранилище."""
+        if self.root is None or self.has(model_id, *files):
+            return
+        self._persist(model_id, lambda tmp: obj.save_pretrained(tmp))
+
+    # SAM2
+
+    def load_sam2(self, model_id: str, device: str):
+        """
+        SAM2ImagePredictor из хранилища; при первом запуске — из HF (и сохраняется в хранилище).
+        На cpu веса — страницы mmap файла хранилища (map_weights), без копии в памяти процесса.
+        """
+        from sam2.build_sam import HF_MODEL_ID_TO_FILENAMES, build_sam2
+        from sam2.sam2_image_predictor import SAM2ImagePredictor
+        from safetensors.torch import load_file, save_file
+
+        if self.has(model_id, SAM2_META, SAM2_WEIGHTS):
+            path = self.model_dir(model_id)
+            with open(os.path.join(path, SAM2_META), "r", encoding="utf-8") as f:
+                config_name = json.load(f)["config"]
+            model = build_sam2(config_file=config_name, ckpt_path=None, device=device)
+            if str(device) == "cpu":
+                self.map_weights(model_id, model, SAM2_WEIGHTS, strict=True)
+            else:
+                model.load_state_dict(load_file(os.path.join(path, SAM2_WEIGHTS), device=str(device)))
+            return SAM2ImagePredictor(model)
+
+        from huggingface_hub import hf_hub_download
+
+        config_name, checkpoint_name = HF_MODEL_ID_TO_FILENAMES[model_id]
+        ckpt_path = hf_hub_download(repo_id=model_id, filename=checkpoint_name, local_files_only=self.offline)
+        model = build_sam2(config_file=config_name, ckpt_path=ckpt_path, device=device)
+
+        if self.root is not None:
+            state = torch.load(ckpt_path, map_location="cpu", weights_only=True)["model"]
+
+            def save(tmp: str) -> None:
+                save_file({k: v.contiguous() for k, v in state.items()}, os.path.join(tmp, SAM2_WEIGHTS))
+                with open(os.path.join(tmp, SAM2_META), "w", encoding="utf-8") as f:
+                    json.dump({"model_id": model_id, "config": config_name}, f)
+
+            self._persist(model_id, save)
+            if str(device) == "cpu":
+                self.map_weights(model_id, model, SAM2_WEIGHTS)
+        return SAM2ImagePredictor(model)
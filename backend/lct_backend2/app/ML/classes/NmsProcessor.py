@@ -1,5 +1,5 @@
 import numpy as np
-from typing import List
+from typing import List, Tuple
 
 class NmsProcessor:
 
@@ -7,35 +7,49 @@ class NmsProcessor:
         iou_thr: float = 0.5,
         beta : float = -1.0,
         alpha_all_classes : float = 0.5,
+        backend : str = "numpy", # "numpy" | "torch" (torchvision.ops.batched_nms)
                 ) -> None:
 
+        if backend not in ("numpy", "torch"):
+            raise ValueError("Unsupported NMS backend. Use 'numpy' or 'torch'.")
         self.iou_thr = iou_thr
         self.beta = beta
         self.alpha_all_classes = alpha_all_classes
+        self.backend = backend
 
     @staticmethod
-    def _inter(a: np.ndarray | List[float], b: np.ndarray | List[float]) -> float:
-        x1 = max(a[0], b[0]); y1 = max(a[1], b[1])
-        x2 = min(a[2], b[2]); y2 = min(a[3], b[3])
-        iw = max(0.0, x2 - x1); ih = max(0.0, y2 - y1)
-        return iw * ih
-
-    def _precompute(self, boxes_np: np.ndarray):
-        """предрасчёт площадей и генератор функций IoU / contain_ratio_min по индексам"""
+    def _pairwise(boxes_np: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Матрицы (n, n) попарных IoU и inter / area(min_box) для боксов xyxy.
+        Считаются один раз на весь набор боксов.
+        """
         wh = np.clip(boxes_np[:, 2:4] - boxes_np[:, 0:2], a_min=0, a_max=None)
         areas = wh[:, 0] * wh[:, 1]
 
-        def iou_of(i: int, j: int) -> float:
-            inter = self._inter(boxes_np[i], boxes_np[j])
-            union = areas[i] + areas[j] - inter + 1e-9
-            return inter / union
+        lt = np.maximum(boxes_np[:, None, 0:2], boxes_np[None, :, 0:2])
+        rb = np.minimum(boxes_np[:, None, 2:4], boxes_np[None, :, 2:4])
+        iwh = np.clip(rb - lt, a_min=0, a_max=None)
+        inter = iwh[..., 0] * iwh[..., 1]
 
-        def contain_ratio_min(i: int, j: int) -> float:
-            inter = self._inter(boxes_np[i], boxes_np[j])
-            smaller = min(areas[i], areas[j])
-            return inter / (smaller + 1e-9)
+        iou = inter / (areas[:, None] + areas[None, :] - inter + 1e-9)
+        contain = inter / (np.minimum(areas[:, None], areas[None, :]) + 1e-9)
+        return iou, contain
 
-        return areas, iou_of, contain_ratio_min
+    @staticmethod
+    def _greedy(order: np.ndarray, suppress: np.ndarray) -> List[int]:
+        """
+        Жадный NMS по готовой матрице подавления:
+        идём по order (по убыванию score), оставляем бокс, если его ещё никто не подавил,
+        и гасим всех, кого он подавляет. suppress индексируется позициями в order.
+        """
+        alive = np.ones(len(order), dtype=bool)
+        kept: List[int] = []
+        for k in range(len(order)):
+            if not alive[k]:
+                continue
+            kept.append(int(order[k]))
+            alive[k + 1:] &= ~suppress[k, k + 1:]
+        return kept
 
     def _stage1_classwise_indices(
         self,
@@ -44,37 +58,29 @@ class NmsProcessor:
         labels_np: np.ndarray,
     ) -> List[int]:
         """Внутриклассовый NMS + (опц.) вложенность по боксам (beta)."""
-        _, iou_of, contain_ratio_min = self._precompute(boxes_np)
+        use_iou = self.iou_thr < 1.0
+        use_beta = self.beta is not None and self.beta >= 0.0
+
+        if self.backend == "torch" and not use_beta:
+            # torchvision не умеет правило вложенности — только чистый IoU-NMS
+            return self._torch_nms(boxes_np, scores_np, labels_np, self.iou_thr if use_iou else 1.0)
+
         keep_stage1: List[int] = []
 
         for cls in np.unique(labels_np):
             idxs = np.where(labels_np == cls)[0]
             idxs = idxs[np.argsort(-scores_np[idxs])]  # по убыванию score
-            kept_cls: List[int] = []
-
-            while len(idxs) > 0:
-                i = idxs[0]
-                kept_cls.append(i)
-                if len(idxs) == 1:
-                    break
-                rest = idxs[1:]
-
-                # 1) IoU-подавление
-                if self.iou_thr < 1.0:
-                    keep_mask_iou = np.array([iou_of(i, j) <= self.iou_thr for j in rest], dtype=bool)
-                else:
-                    keep_mask_iou = np.ones(len(rest), dtype=bool)
+            iou, contain = self._pairwise(boxes_np[idxs])
 
-                # 2) правило вложенности: inter / area(min_box) < beta — оставить
-                if self.beta is not None and self.beta >= 0.0:
-                    keep_mask_cont = np.array([contain_ratio_min(i, j) < self.beta for j in rest], dtype=bool)
-                else:
-                    keep_mask_cont = np.ones(len(rest), dtype=bool)
+            suppress = np.zeros((len(idxs), len(idxs)), dtype=bool)
+            # 1) IoU-подавление
+            if use_iou:
+                suppress |= iou > self.iou_thr
+            # 2) правило вложенности: inter / area(min_box) < beta — оставить
+            if use_beta:
+                suppress |= contain >= self.beta
 
-                keep_mask = np.logical_and(keep_mask_iou, keep_mask_cont)
-                idxs = rest[keep_mask]
-
-            keep_stage1.extend(kept_cls)
+            keep_stage1.extend(self._greedy(idxs, suppress))
 
         return keep_stage1
 
@@ -89,26 +95,39 @@ class NmsProcessor:
             # выключено — просто вернуть, отсортировав по score
             return sorted(kept_indices, key=lambda k: -scores_np[k])
 
-        areas, _, _ = self._precompute(boxes_np)
-
-        def iou_pair(i: int, j: int) -> float:
-            inter = self._inter(boxes_np[i], boxes_np[j])
-            return inter / (areas[i] + areas[j] - inter + 1e-9)
-
-        final_keep: List[int] = []
         idxs = np.array(sorted(kept_indices, key=lambda k: -scores_np[k]), dtype=int)
+        if len(idxs) == 0:
+            return []
 
-        while len(idxs) > 0:
-            i = idxs[0]
-            final_keep.append(i)
-            if len(idxs) == 1:
-                break
-            rest = idxs[1:]
-            keep_mask = np.array([iou_pair(i, j) <= self.alpha_all_classes for j in rest], dtype=bool)
-            idxs = rest[keep_mask]
+        if self.backend == "torch":
+            kept = self._torch_nms(boxes_np[idxs], scores_np[idxs], None, self.alpha_all_classes)
+            final_keep = [int(idxs[k]) for k in kept]
+        else:
+            iou, _ = self._pairwise(boxes_np[idxs])
+            final_keep = self._greedy(idxs, iou > self.alpha_all_classes)
 
         return sorted(final_keep, key=lambda k: -scores_np[k])
 
+    @staticmethod
+    def _torch_nms(
+        boxes_np: np.ndarray,
+        scores_np: np.ndarray,
+        labels_np: np.ndarray | None,
+        iou_thr: float,
+    ) -> List[int]:
+        """IoU-NMS через torchvision (batched_nms — по классам, nms — без классов)."""
+        import torch
+        from torchvision.ops import batched_nms, nms
+
+        boxes_t = torch.from_numpy(np.ascontiguousarray(boxes_np, dtype=np.float32))
+        scores_t = torch.from_numpy(np.ascontiguousarray(scores_np, dtype=np.float32))
+        if labels_np is None:
+            keep = nms(boxes_t, scores_t, iou_thr)
+        else:
+            _, class_ids = np.unique(labels_np, return_inverse=True)
+            keep = batched_nms(boxes_t, scores_t, torch.from_numpy(class_ids.astype(np.int64)), iou_thr)
+        return keep.tolist()
+
     def nms_two_stage(
         self,
         boxes: List[List[float]],
@@ -0,0 +1,130 @@
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+import torch
+
+# Состав каталога экспорта (см. app/ML/export.py)
+GDINO_ONNX = "gdino_{h}x{w}.onnx"
+GDINO_CONFIG_DIR = "gdino"
+SAM2_ENCODER_ONNX = "sam2_encoder.onnx"
+SAM2_DECODER_ONNX = "sam2_decoder.onnx"
+META_FILE = "meta.json"
+
+
+def load_meta(onnx_dir: str) -> dict:
+    with open(os.path.join(onnx_dir, META_FILE), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def ort_session(path: str, num_threads: int = 0):
+    """Сессия ONNX Runtime на CPU со всеми графовыми оптимизациями."""
+    import onnxruntime as ort
+
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"ONNX graph not found: {path}. Run `python -m app.ML.export` first.")
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        opts.intra_op_num_threads = num_threads
+    return ort.InferenceSession(path, sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+class OrtGdino:
+    """
+    GroundingDinoForObjectDetection на ONNX Runtime: вызывается с теми же аргументами,
+    что и модель transformers, и возвращает GroundingDinoObjectDetectionOutput (logits, pred_boxes, input_ids),
+    поэтому GdinoModel работает с ним без изменений.
+
+    Трассировка GDINO запекает в граф форму изображения, батч 1 и маски подписи
+    (они строятся питоновскими циклами по токенам), поэтому:
+    - графы экспортируются под несколько холстов (H, W); изображение паддится нулями
+      до наименьшего подходящего холста с pixel_mask=0 на паддинге (как при батчевом прогоне);
+    - батч прогоняется поштучно;
+    - подпись должна совпадать с экспортированной (single-pass подпись промптов).
+    Сессии под холсты создаются лениво — каждая держит свою копию весов.
+    """
+
+    INPUTS = ("pixel_values", "pixel_mask", "input_ids", "attention_mask", "token_type_ids")
+
+    def __init__(self, onnx_dir: str, num_threads: int = 0) -> None:
+        from transformers import GroundingDinoConfig
+
+        meta = load_meta(onnx_dir)
+        self.onnx_dir = onnx_dir
+        self.num_threads = num_threads
+        self.shapes = sorted((tuple(s) for s in meta["gdino_shapes"]), key=lambda s: s[0] * s[1])
+        self.input_ids = meta["gdino_input_ids"]
+        self.sessions = {}
+        self.config = GroundingDinoConfig.from_pretrained(os.path.join(onnx_dir, GDINO_CONFIG_DIR))
+
+    def _session(self, shape: Tuple[int, int]):
+        if shape not in self.sessions:
+            h, w = shape
+            self.sessions[shape] = ort_session(os.path.join(self.onnx_dir, GDINO_ONNX.format(h=h, w=w)), self.num_threads)
+        return self.sessions[shape]
+
+    def _canvas(self, h: int, w: int) -> Tuple[int, int]:
+        for shape in self.shapes:
+            if shape[0] >= h and shape[1] >= w:
+                return shape
+        raise ValueError(f"Image {h}x{w} does not fit any exported GDINO canvas {self.shapes}")
+
+    def __call__(self, **inputs):
+        from transformers.models.grounding_dino.modeling_grounding_dino import GroundingDinoObjectDetectionOutput
+
+        feed_all = {name: inputs[name].cpu().numpy() for name in self.INPUTS}
+        logits_all, boxes_all = [], []
+        for b in range(feed_all["pixel_values"].shape[0]):
+            feed = {name: value[b:b + 1] for name, value in feed_all.items()}
+            if feed["input_ids"][0].tolist() != self.input_ids:
+                raise ValueError("Caption differs from the one baked into the GDINO ONNX graph; re-run export.")
+
+            h, w = feed["pixel_values"].shape[-2:]
+            H, W = self._canvas(h, w)
+            pixel_values = np.zeros((1, 3, H, W), dtype=np.float32)
+            pixel_values[..., :h, :w] = feed["pixel_values"]
+            pixel_mask = np.zeros((1, H, W), dtype=feed["pixel_mask"].dtype)
+            pixel_mask[:, :h, :w] = feed["pixel_mask"]
+            feed["pixel_values"], feed["pixel_mask"] = pixel_values, pixel_mask
+
+            logits, pred_boxes = self._session((H, W)).run(["logits", "pred_boxes"], feed)
+            logits_all.append(logits)
+            boxes_all.append(pred_boxes)
+
+        return GroundingDinoObjectDetectionOutput(
+            logits=torch.from_numpy(np.concatenate(logits_all)),
+            pred_boxes=torch.from_numpy(np.concatenate(boxes_all)),
+            input_ids=inputs["input_ids"],
+        )
+
+
+class OrtSam2:
+    """
+    Энкодер и декодер SAM2 на ONNX Runtime.
+    encode: нормализованное изображение (1, 3, S, S) -> (image_embed, high_res_feat0, high_res_feat1);
+    decode: признаки + боксы в координатах модели (N, 2, 2) -> (low_res_masks (N, 3, 256, 256), iou (N, 3)).
+    Препроцессинг и апскейл масок остаются в Sam2Model (SAM2Transforms).
+    """
+
+    def __init__(self, onnx_dir: str, num_threads: int = 0) -> None:
+        meta = load_meta(onnx_dir)
+        self.image_size = int(meta["sam2_image_size"])
+        self.mask_threshold = float(meta.get("sam2_mask_threshold", 0.0))
+        self.encoder = ort_session(os.path.join(onnx_dir, SAM2_ENCODER_ONNX), num_threads)
+        self.decoder = ort_session(os.path.join(onnx_dir, SAM2_DECODER_ONNX), num_threads)
+
+    def encode(self, image: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        image_embed, feat0, feat1 = self.encoder.run(None, {"image": image.astype(np.float32)})
+        return image_embed, feat0, feat1
+
+    def decode(self, features: Tuple[np.ndarray, np.ndarray, np.ndarray], box_coords: np.ndarray):
+        image_embed, feat0, feat1 = features
+        low_res_masks, iou_predictions = self.decoder.run(None, {
+            "image_embed": image_embed,
+            "high_res_feat0": feat0,
+            "high_res_feat1": feat1,
+            "box_coords": box_coords.astype(np.float32),
+        })
+        return torch.from_numpy(low_res_masks), torch.from_numpy(iou_predictions)
@@ -0,0 +1,29 @@
+from contextlib import nullcontext
+import torch
+
+PRECISIONS = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def check_precision(precision: str, device: str) -> str:
+    """
+    Проверяет точность и возвращает фактическую: autocast есть только для cuda и cpu,
+    на остальных устройствах (mps) — fp32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision: {precision}. Use one of {tuple(PRECISIONS)}.")
+    if precision != "fp32" and device not in ("cuda", "cpu"):
+        print(f"{precision} autocast is not supported on {device}; using fp32")
+        return "fp32"
+    return precision
+
+
+def autocast(device: str, precision: str):
+    """torch.autocast для прямых проходов модели; для fp32 — пустой контекст."""
+    dtype = PRECISIONS[precision]
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=device, dtype=dtype)
@@ -0,0 +1,9 @@
+import torch
+
+
+def quantize_linear_int8(model: torch.nn.Module) -> torch.nn.Module:
+    """
+    Dynamic int8 quantization всех nn.Linear: веса хранятся в int8, активации
+    квантуются на лету. Работает только на CPU (бэкенды fbgemm / qnnpack).
+    """
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
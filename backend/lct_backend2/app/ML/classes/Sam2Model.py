@@ -1,9 +1,13 @@
-from sam2.sam2_image_predictor import SAM2ImagePredictor
 from functools import cached_property
+import threading
 import torch
 from dataclasses import dataclass
 import numpy as np
 from typing import List
+from .OrtModels import OrtSam2
+from .Quantization import quantize_linear_int8
+from .Precision import autocast, check_precision
+from .ModelStore import ModelStore
 
 
 @dataclass
@@ -17,38 +21,154 @@ class Sam2Model:
             _DEVICE,
             SAM2_ID="facebook/sam2.1-hiera-large",
             load_now : bool = True,
+            max_boxes_per_call : int = 32, # сколько боксов за один вызов декодера (ограничение по памяти)
+            runtime : str = "torch", # "torch" | "onnx" (графы из app/ML/export.py, ONNX Runtime на CPU)
+            onnx_dir : str = "models/onnx",
+            ort_threads : int = 0,
+            quantize : bool = False, # int8 dynamic quantization nn.Linear (только cpu + torch)
+            precision : str = "fp32", # "fp32" | "bf16" | "fp16" — autocast энкодера и декодера SAM2
+            store : ModelStore = None, # локальное хранилище весов; None — только HF Hub
             ) -> None:
+        if runtime not in ("torch", "onnx"):
+            raise ValueError("Unsupported SAM2 runtime. Use 'torch' or 'onnx'.")
         self.device = _DEVICE
         self.SAM2_ID = SAM2_ID
+        self.max_boxes_per_call = max(1, int(max_boxes_per_call))
+        self.runtime = runtime
+        self.onnx_dir = onnx_dir
+        self.ort_threads = ort_threads
+        self.quantize = quantize
+        self.precision = check_precision(precision, _DEVICE)
+        self.store = store if store is not None else ModelStore()
+        # Предиктор хранит признаки изображения в себе — set_image и декодер под одним замком
+        self._lock = threading.Lock()
+        self._orig_hw = None
+        self._ort_features = None
 
         if load_now:
-             _ = self.sam2
+             self.load()
 
 
     @cached_property
     def sam2(self):
         print('SAM2 weights are loading...')
-        model = SAM2ImagePredictor.from_pretrained(self.SAM2_ID, device=self.device)
+        model = self.store.load_sam2(self.SAM2_ID, self.device)
         if model is None:
             raise RuntimeError("SAM2 weights not loaded!")
         else:
             print("SAM2 weights are loaded!")
+        if self.quantize:
+            model.model = quantize_linear_int8(model.model)
+            print("SAM2 linear layers are quantized to int8!")
         return model
 
-    # @torch.no_grad()
+    def load(self) -> None:
+        """Загружает веса (torch) или графы (onnx) текущего рантайма."""
+        _ = self.sam2 if self.runtime == "torch" else self.ort
+
+    @cached_property
+    def ort(self) -> OrtSam2:
+        print('SAM2 ONNX graphs are loading...')
+        model = OrtSam2(self.onnx_dir, self.ort_threads)
+        print("SAM2 ONNX graphs are loaded!")
+        return model
+
+    @cached_property
+    def _transforms(self):
+        """Препроцессинг изображения, перевод боксов и апскейл масок — общие для обоих рантаймов."""
+        if self.runtime == "torch":
+            return self.sam2._transforms
+        from sam2.utils.transforms import SAM2Transforms
+        return SAM2Transforms(resolution=self.ort.image_size, mask_threshold=self.ort.mask_threshold)
+
+    @property
+    def mask_threshold(self) -> float:
+        return self.sam2.mask_threshold if self.runtime == "torch" else self.ort.mask_threshold
+
+    def _set_image(self, image_rgb: np.ndarray) -> None:
+        self._orig_hw = image_rgb.shape[:2]
+        if self.runtime == "torch":
+            with autocast(self.device, self.precision):
+                self.sam2.set_image(image_rgb)
+        else:
+            image = self._transforms(image_rgb)[None].numpy()
+            self._ort_features = self.ort.encode(image)
+
+    @torch.no_grad()
     def predict_mask(self, image_rgb: np.ndarray, 
                     boxes_xyxy: List[List[float]]
                     ) -> MaskResult:
         
-        self.sam2.set_image(image_rgb)
         out_masks: List[np.ndarray] = []
-        ok_index: List[int] = [] # индексы боксов, у которых получилось извлечь маску
-
-        for bi, box in enumerate(boxes_xyxy):
-            masks, scores, _ = self.sam2.predict(box=np.array(box, dtype=np.float32))
-            if masks is None or len(masks) == 0:
-                continue
-            best = int(np.argmax(np.array(scores))) if scores is not None else 0
-            out_masks.append(np.array(masks[best]))
-            ok_index.append(bi)
-        return MaskResult(masks=out_masks, indices=ok_index) 
+        if len(boxes_xyxy) == 0:
+            return MaskResult(masks=out_masks, indices=[])
+
+        with self._lock:
+            self._set_image(image_rgb)
+            # все боксы — батчем в декодер (порциями по max_boxes_per_call)
+            for start in range(0, len(boxes_xyxy), self.max_boxes_per_call):
+                chunk = np.asarray(boxes_xyxy[start:start + self.max_boxes_per_call], dtype=np.float32)
+                out_masks.extend(self._predict_best_masks(chunk))
+        return MaskResult(masks=out_masks, indices=list(range(len(boxes_xyxy))))
+
+    def _predict_best_masks(self, boxes: np.ndarray) -> List[np.ndarray]:
+        """
+        Один вызов декодера SAM2 на пачку боксов (N, 4) для уже установленного изображения.
+        Повторяет SAM2ImagePredictor._predict, но из трёх multimask-выходов на устройстве
+        выбирается лучший по iou_predictions, и до исходного разрешения апскейлится только он.
+        Возвращает N бинарных масок (H, W).
+        """
+        if self.runtime == "torch":
+            low_res_masks, iou_predictions = self._decode_torch(boxes)
+        else:
+            box_coords = self._transforms.transform_boxes(torch.as_tensor(boxes), normalize=True, orig_hw=self._orig_hw)
+            low_res_masks, iou_predictions = self.ort.decode(self._ort_features, box_coords.numpy())
+
+        # лучшая маска на бокс — до копирования на хост и до апскейла
+        best = iou_predictions.argmax(dim=1)
+        rows = torch.arange(best.shape[0], device=best.device)
+        low_res_best = low_res_masks[rows, best].unsqueeze(1)  # (N, 1, 256, 256)
+
+        masks = self._transforms.postprocess_masks(low_res_best, self._orig_hw)
+        masks = masks[:, 0] > self.mask_threshold
+        return list(masks.cpu().numpy())
+
+    def _decode_torch(self, boxes: np.ndarray):
+        """Prompt encoder + mask decoder SAM2 (eager PyTorch): (low_res_masks (N, 3, 256, 256), iou (N, 3))."""
+        predictor = self.sam2
+        _, _, _, unnorm_box = predictor._prep_prompts(
+            None, None, boxes, None, normalize_coords=True
+        )
+        box_coords = unnorm_box.reshape(-1, 2, 2)
+        with autocast(self.device, self.precision):
+            low_res_masks, iou_predictions = self.decode_features(predictor.model, predictor._features, box_coords)
+        return low_res_masks.float(), iou_predictions.float()
+
+    @staticmethod
+    def decode_features(model, features: dict, box_coords: torch.Tensor):
+        """
+        Декодер SAM2 по признакам изображения ({"image_embed", "high_res_feats"}) и боксам
+        в координатах модели (N, 2, 2). Этот же граф экспортируется в ONNX (app/ML/export.py).
+        """
+        box_labels = torch.tensor([[2, 3]], dtype=torch.int, device=box_coords.device)
+        box_labels = box_labels.repeat(box_coords.size(0), 1)
+
+        sparse_embeddings, dense_embeddings = model.sam_prompt_encoder(
+            points=(box_coords, box_labels),
+            boxes=None,
+            masks=None,
+        )
+        high_res_features = [
+            feat_level[-1].unsqueeze(0)
+            for feat_level in features["high_res_feats"]
+        ]
+        low_res_masks, iou_predictions, _, _ = model.sam_mask_decoder(
+            image_embeddings=features["image_embed"][-1].unsqueeze(0),
+            image_pe=model.sam_prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings,
+            multimask_output=True,
+            repeat_image=True,
+            high_res_features=high_res_features,
+        )
+        return low_res_masks, iou_predictions
@@ -0,0 +1,49 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Tuple
+
+# (стадия, группа, секунды)
+Timing = Tuple[str, str, float]
+
+
+class StageTimer:
+    """
+    Замер длительности стадий пайплайна: `with timer.stage("nms"): ...`.
+
+    Каждый замер передаётся observer(stage, group, seconds), если он задан, и копится
+    в текущем collect() этого потока — так замеры из воркера пула (поток или процесс)
+    возвращаются вызывающему вместе с результатом.
+    """
+
+    def __init__(self, observer: Optional[Callable[[str, str, float], None]] = None) -> None:
+        self.observer = observer
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name: str, group: str = ""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, group)
+
+    def record(self, name: str, seconds: float, group: str = "") -> None:
+        if self.observer is not None:
+            self.observer(name, group, seconds)
+        collected = getattr(self._local, "collected", None)
+        if collected is not None:
+            collected.append((name, group, seconds))
+
+    @contextmanager
+    def collect(self):
+        """Список замеров, сделанных в этом потоке внутри контекста."""
+        previous = getattr(self._local, "collected", None)
+        collected: List[Timing] = []
+        self._local.collected = collected
+        try:
+            yield collected
+        finally:
+            self._local.collected = previous
+            if previous is not None:
+                previous.extend(collected)
@@ -0,0 +1,287 @@
+"""
+Экспорт моделей backend_2 в ONNX для ImageSegmentator(_runtime="onnx").
+
+    python -m app.ML.export --out models/onnx
+    python -m app.ML.export --out models/onnx --models sam2 --check
+    python -m app.ML.export --out models/onnx --check-only --image samples/forest.jpg
+
+Графы:
+- gdino_{H}x{W}.onnx — GroundingDinoForObjectDetection целиком, батч 1, single-pass подпись
+  промптов ImageSegmentator, по графу на холст --gdino-shape (см. OrtGdino);
+- sam2_encoder.onnx — бэкбон SAM2 (как SAM2ImagePredictor.set_image);
+- sam2_decoder.onnx — prompt encoder + mask decoder для N боксов (Sam2Model.decode_features).
+
+--check сравнивает ONNX Runtime с eager PyTorch на тестовом изображении
+(вероятности и боксы GDINO, IoU масок SAM2) и завершается с кодом 1, если расхождение больше допуска.
+Это проверка графов на одном изображении; паритет детекций и масок на представительном наборе —
+python -m app.ML.benchmark --images data/val --variants fp32 onnx --single-pass --device cpu.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .ImageSegmentatator import ImageSegmentator
+from .classes.GDinoModel import GdinoModel
+from .classes.Sam2Model import Sam2Model
+from .classes.OrtModels import (
+    GDINO_CONFIG_DIR,
+    GDINO_ONNX,
+    META_FILE,
+    SAM2_DECODER_ONNX,
+    SAM2_ENCODER_ONNX,
+    OrtGdino,
+)
+
+
+class GdinoExport(torch.nn.Module):
+    """GDINO с позиционными входами и кортежем (logits, pred_boxes) на выходе."""
+
+    def __init__(self, model) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values, pixel_mask, input_ids, attention_mask, token_type_ids):
+        out = self.model(
+            pixel_values=pixel_values,
+            pixel_mask=pixel_mask,
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+        )
+        return out.logits, out.pred_boxes
+
+
+class Sam2EncoderExport(torch.nn.Module):
+    """Признаки изображения SAM2 — повторяет SAM2ImagePredictor.set_image."""
+
+    def __init__(self, predictor) -> None:
+        super().__init__()
+        self.model = predictor.model
+        self.feat_sizes = predictor._bb_feat_sizes
+
+    def forward(self, image):
+        backbone_out = self.model.forward_image(image)
+        _, vision_feats, _, _ = self.model._prepare_backbone_features(backbone_out)
+        if self.model.directly_add_no_mem_embed:
+            vision_feats[-1] = vision_feats[-1] + self.model.no_mem_embed
+        feats = [
+            feat.permute(1, 2, 0).reshape(1, -1, *feat_size)
+            for feat, feat_size in zip(vision_feats[::-1], self.feat_sizes[::-1])
+        ][::-1]
+        return feats[-1], feats[0], feats[1]
+
+
+class Sam2DecoderExport(torch.nn.Module):
+    """Декодер SAM2 по признакам изображения и боксам в координатах модели (N, 2, 2)."""
+
+    def __init__(self, predictor) -> None:
+        super().__init__()
+        self.model = predictor.model
+
+    def forward(self, image_embed, high_res_feat0, high_res_feat1, box_coords):
+        features = {"image_embed": image_embed, "high_res_feats": [high_res_feat0, high_res_feat1]}
+        return Sam2Model.decode_features(self.model, features, box_coords)
+
+
+def parse_shape(text: str) -> Tuple[int, int]:
+    h, w = text.lower().split("x")
+    return int(h), int(w)
+
+
+def test_image(path: str = None) -> np.ndarray:
+    """Изображение для проверки: файл или детерминированный шум 600x800."""
+    if path:
+        return np.asarray(Image.open(path).convert("RGB"))
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, size=(600, 800, 3), dtype=np.uint8)
+
+
+def export_gdino(gdino: GdinoModel, out_dir: str, shapes: List[Tuple[int, int]], opset: int) -> dict:
+    caption, _, _ = gdino._single_pass_plan
+    text = gdino._encode_text(caption)
+    model = GdinoExport(gdino.GDINO).eval()
+
+    for h, w in shapes:
+        path = os.path.join(out_dir, GDINO_ONNX.format(h=h, w=w))
+        print(f"Exporting GDINO {h}x{w} -> {path}")
+        args = (
+            torch.zeros((1, 3, h, w)),
+            torch.ones((1, h, w), dtype=torch.long),
+            text["input_ids"],
+            text["attention_mask"],
+            text["token_type_ids"],
+        )
+        torch.onnx.export(
+            model, args, path,
+            input_names=list(OrtGdino.INPUTS),
+            output_names=["logits", "pred_boxes"],
+            opset_version=opset,
+        )
+
+    gdino.GDINO.config.save_pretrained(os.path.join(out_dir, GDINO_CONFIG_DIR))
+    return {
+        "gdino_id": gdino.GDINO_ID,
+        "gdino_shapes": [list(s) for s in shapes],
+        "gdino_caption": caption,
+        "gdino_input_ids": text["input_ids"][0].tolist(),
+    }
+
+
+def export_sam2(sam: Sam2Model, out_dir: str, opset: int) -> dict:
+    predictor = sam.sam2
+    size = predictor.model.image_size
+    encoder = Sam2EncoderExport(predictor).eval()
+    decoder = Sam2DecoderExport(predictor).eval()
+
+    path = os.path.join(out_dir, SAM2_ENCODER_ONNX)
+    print(f"Exporting SAM2 encoder -> {path}")
+    image = torch.randn(1, 3, size, size)
+    torch.onnx.export(
+        encoder, (image,), path,
+        input_names=["image"],
+        output_names=["image_embed", "high_res_feat0", "high_res_feat1"],
+        opset_version=opset,
+    )
+
+    path = os.path.join(out_dir, SAM2_DECODER_ONNX)
+    print(f"Exporting SAM2 decoder -> {path}")
+    with torch.no_grad():
+        features = encoder(image)
+    box_coords = torch.tensor([[[0.1, 0.1], [0.5, 0.6]], [[0.3, 0.2], [0.9, 0.9]]]) * size
+    torch.onnx.export(
+        decoder, (*features, box_coords), path,
+        input_names=["image_embed", "high_res_feat0", "high_res_feat1", "box_coords"],
+        output_names=["low_res_masks", "iou_predictions"],
+        dynamic_axes={
+            "box_coords": {0: "boxes"},
+            "low_res_masks": {0: "boxes"},
+            "iou_predictions": {0: "boxes"},
+        },
+        opset_version=opset,
+    )
+    return {
+        "sam2_id": sam.SAM2_ID,
+        "sam2_image_size": int(size),
+        "sam2_mask_threshold": float(predictor.mask_threshold),
+    }
+
+
+@torch.no_grad()
+def check_gdino(eager: GdinoModel, onnx: GdinoModel, image_rgb: np.ndarray) -> dict:
+    """Max |Δ| вероятностей по токенам подписи и координат боксов для одного изображения."""
+    caption, _, _ = eager._single_pass_plan
+    H, W = image_rgb.shape[:2]
+    inputs = eager._preprocess_image(Image.fromarray(image_rgb), eager._processor_kwargs(H, W))
+    inputs.update(eager._encode_text(caption))
+
+    ref = eager.GDINO(**inputs)
+    out = onnx.GDINO(**inputs)
+    tokens = inputs["attention_mask"][0].bool()
+    # за пределами подписи логиты -inf — сравниваем только реальные токены
+    probs_ref = ref.logits[0][:, :tokens.numel()][:, tokens].sigmoid()
+    probs_out = out.logits[0][:, :tokens.numel()][:, tokens].sigmoid()
+    return {
+        "prob_max_abs": float((probs_ref - probs_out).abs().max()),
+        "box_max_abs": float((ref.pred_boxes - out.pred_boxes).abs().max()),
+        "boxes_eager": len(eager.detect_boxes_hf(image_rgb)[0]),
+        "boxes_onnx": len(onnx.detect_boxes_hf(image_rgb)[0]),
+    }
+
+
+def check_sam2(eager: Sam2Model, onnx: Sam2Model, image_rgb: np.ndarray) -> dict:
+    """IoU масок eager / ONNX для трёх боксов (их число отличается от экспортного)."""
+    H, W = image_rgb.shape[:2]
+    boxes = [
+        [0.10 * W, 0.10 * H, 0.50 * W, 0.60 * H],
+        [0.40 * W, 0.30 * H, 0.90 * W, 0.90 * H],
+        [0.00 * W, 0.00 * H, 1.00 * W, 1.00 * H],
+    ]
+    ref = eager.predict_mask(image_rgb, boxes).masks
+    out = onnx.predict_mask(image_rgb, boxes).masks
+    ious = []
+    for a, b in zip(ref, out):
+        union = np.logical_or(a, b).sum()
+        ious.append(1.0 if union == 0 else float(np.logical_and(a, b).sum() / union))
+    return {"mask_iou_min": min(ious), "mask_iou_mean": float(np.mean(ious))}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Export GDINO / SAM2 to ONNX for the onnx runtime of ImageSegmentator")
+    parser.add_argument("--out", default="models/onnx", help="каталог экспорта (settings.onnx_dir)")
+    parser.add_argument("--models", nargs="+", choices=("gdino", "sam2"), default=["gdino", "sam2"])
+    parser.add_argument("--gdino-id", default="IDEA-Research/grounding-dino-base")
+    parser.add_argument("--sam2-id", default="facebook/sam2.1-hiera-large")
+    parser.add_argument("--gdino-shape", action="append", type=parse_shape,
+                        help="холст GDINO HxW, можно несколько (по умолчанию 1200x1900 и 1900x1200)")
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--check", action="store_true", help="после экспорта сравнить ONNX Runtime с PyTorch")
+    parser.add_argument("--check-only", action="store_true", help="только проверка уже экспортированных графов")
+    parser.add_argument("--image", default=None, help="изображение для проверки (по умолчанию — шум 600x800)")
+    parser.add_argument("--prob-tol", type=float, default=1e-2)
+    parser.add_argument("--box-tol", type=float, default=1e-2)
+    parser.add_argument("--iou-tol", type=float, default=0.98)
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    shapes = args.gdino_shape or [(1200, 1900), (1900, 1200)]
+    # промпты и рамки ресайза — те же, что у сервиса
+    eager = ImageSegmentator(
+        _DEVICE="cpu",
+        _GDINO_ID=args.gdino_id,
+        _SAM2_ID=args.sam2_id,
+        _gdino_load_now=False,
+        _sam2_load_now=False,
+        use_sam="sam2" in args.models,
+        _gdino_single_pass=True,
+    )
+
+    if not args.check_only:
+        meta_path = os.path.join(args.out, META_FILE)
+        meta = {}
+        if os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        meta["opset"] = args.opset
+        if "gdino" in args.models:
+            meta.update(export_gdino(eager.gdino, args.out, shapes, args.opset))
+        if "sam2" in args.models:
+            meta.update(export_sam2(eager.sam2, args.out, args.opset))
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2)
+        print(f"Saved {meta_path}")
+
+    if not (args.check or args.check_only):
+        return 0
+
+    onnx = ImageSegmentator(
+        _GDINO_ID=args.gdino_id,
+        _SAM2_ID=args.sam2_id,
+        _gdino_load_now=False,
+        _sam2_load_now=False,
+        use_sam="sam2" in args.models,
+        _gdino_single_pass=True,
+        _runtime="onnx",
+        _onnx_dir=args.out,
+    )
+    image_rgb = test_image(args.image)
+    ok = True
+    if "gdino" in args.models:
+        report = check_gdino(eager.gdino, onnx.gdino, image_rgb)
+        print(f"GDINO parity: {report}")
+        ok &= report["prob_max_abs"] <= args.prob_tol and report["box_max_abs"] <= args.box_tol
+    if "sam2" in args.models:
+        report = check_sam2(eager.sam2, onnx.sam2, image_rgb)
+        print(f"SAM2 parity: {report}")
+        ok &= report["mask_iou_min"] >= args.iou_tol
+    print("Parity check passed" if ok else "Parity check FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,183 +2,287 @@
 FastAPI приложение backend_2 с консьюмером RabbitMQ
 """
 import asyncio
-import io
-import json
 import logging
-import os
 import time
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
-import aio_pika
-from aio_pika import Message, DeliveryMode
-from fastapi import FastAPI
-import httpx
-import numpy as np
-from PIL import Image
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import BaseModel
 
 from .core.config import settings
 from .ML.ImageSegmentatator import ImageSegmentator
+from .services import BlobCache, ConsumerService, HttpDownloader, InferencePool, ResultCache, ResultSink, metrics
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Backend 2 - Image Processor", version="1.0.0")
-segmentator = ImageSegmentator(
-    _box_thr=0.10080074890084499,
-    _text_thr=0.2693266367707789,
-    _iou_thr=0.8527497557418572,
-    _beta=0.9457256509335716,
-    _alpha_all_classes=0.7412089719658128,
+
+PIPELINE_PROFILES = ("detect", "detect_mask", "mask_on_demand")
+if settings.pipeline_profile not in PIPELINE_PROFILES:
+    raise ValueError(f"Unsupported pipeline_profile: {settings.pipeline_profile}. Use one of {PIPELINE_PROFILES}.")
+# графы ONNX экспортируются только с single-pass подписью (app/ML/export.py)
+if settings.runtime == "onnx" and not settings.gdino_single_pass:
+    raise ValueError("runtime=onnx requires gdino_single_pass=true (set GDINO_SINGLE_PASS=true or RUNTIME=torch).")
+# маски уходят в JSON-результат: "array" (numpy) не сериализуется, и результат терялся бы при публикации
+MASK_FORMATS = ("rle", "bitpacked")
+if settings.mask_format not in MASK_FORMATS:
+    raise ValueError(f"Unsupported mask_format: {settings.mask_format}. Use one of {MASK_FORMATS}.")
+
+downloader = HttpDownloader(
+    timeout=settings.http_timeout_s,
+    max_connections=settings.http_max_connections,
+    retries=settings.http_retries,
+    backoff=settings.http_backoff_s,
 )
 
-# Флаг готовности моделей
+# Исходные байты из S3 для backend3 на том же узле (общий том); выключен, если каталог не задан
+blob_cache: Optional[BlobCache] = BlobCache(
+    settings.blob_cache_dir,
+    max_bytes=settings.blob_cache_max_mb * 2**20,
+) if settings.blob_cache_dir else None
+
+# Модели создаются не при импорте, а в фоне после старта (см. initialize):
+# HTTP (/health) отвечает сразу, пока веса грузятся
+segmentator: Optional[ImageSegmentator] = None
+pool: Optional[InferencePool] = None
+consumer: Optional[ConsumerService] = None
+cache: Optional[ResultCache] = None
+sink: Optional[ResultSink] = None
+
+# Время стадий запуска, с
+startup_timings: Dict[str, float] = {}
+
+
+def segmentator_config() -> dict:
+    """Аргументы ImageSegmentator: для сегментатора сервиса и процессов-воркеров пула"""
+    return dict(
+        _box_thr=0.10080074890084499,
+        _text_thr=0.2693266367707789,
+        _iou_thr=0.8527497557418572,
+        _beta=0.9457256509335716,
+        _alpha_all_classes=0.7412089719658128,
+        _gdino_single_pass=settings.gdino_single_pass,
+        _gdino_batch_size=settings.gdino_batch_size,
+        _nms_backend=settings.nms_backend,
+        _mask_format=settings.mask_format,
+        use_sam=settings.pipeline_profile == "detect_mask",
+        _mask_on_demand=settings.pipeline_profile == "mask_on_demand",
+        _tiling=settings.tiling_enabled,
+        _tile_size=settings.tile_size,
+        _tile_overlap=settings.tile_overlap,
+        _runtime=settings.runtime,
+        _onnx_dir=settings.onnx_dir,
+        _ort_threads=settings.ort_threads,
+        _quantize=settings.quantize_int8,
+        _precision=settings.precision,
+        _model_store_dir=settings.model_store_dir,
+        _offline=settings.hf_offline,
+        _parallel_load=settings.parallel_model_loading,
+    )
+
+
+def build_segmentator() -> ImageSegmentator:
+    # без загрузки весов: где их держать (этот процесс или воркеры пула), решает initialize
+    return ImageSegmentator(**segmentator_config(), _gdino_load_now=False, _sam2_load_now=False)
+
+
+class MaskRequest(BaseModel):
+    # только URL: локальные пути от клиента не принимаются (открыли бы любой файл процесса)
+    s3_url: str
+    boxes: List[List[float]]  # [[x1, y1, x2, y2], ...] в пикселях исходного изображения
+
+# Готовность: очередь читается только после загрузки моделей, пула и прогрева.
+# stage: loading_models -> starting_pool -> warming_up -> ready | failed | consumer_stopped
+readiness: Dict[str, object] = {"ready": False, "stage": "starting", "error": None}
 models_warmed_up = False
 
 
+def parse_shapes(text: str) -> List[Tuple[int, int]]:
+    """'1200x1600,640x640' -> [(1200, 1600), (640, 640)] (H x W)"""
+    shapes = []
+    for item in text.split(","):
+        if item.strip():
+            h, w = item.strip().lower().split("x")
+            shapes.append((int(h), int(w)))
+    return shapes
+
+
+def set_stage(stage: str, error: Optional[str] = None) -> None:
+    readiness.update(stage=stage, ready=stage == "ready", error=error)
+    logger.info(f"Стадия запуска: {stage}")
+
+
 async def warmup_models() -> None:
     """
-    Прогревает ML модели при старте сервиса
-    Выполняет dummy inference для инициализации CUDA и загрузки весов в память GPU
+    Прогрев на представительных формах settings.warmup_shapes (см. ImageSegmentator.warmup):
+    GDINO на реальных размерах батча и холстов, NMS и SAM2 с пачкой боксов.
+    В режиме process каждый воркер прогревается при старте пула.
     """
     global models_warmed_up
-    
-    if models_warmed_up:
-        logger.info("Модели уже прогреты, пропускаем")
+    timings = await pool.warmup()
+    for pid, worker_timings in timings.items():
+        name = f"pid={pid}" if pid else "threads"
+        logger.info(f"🔥 Прогрев ({name}): " + ", ".join(f"{k}={v:.2f}s" for k, v in worker_timings.items()))
+    models_warmed_up = True
+
+
+def on_consumer_done(task: asyncio.Task) -> None:
+    """Консьюмер упал — сервис больше не готов"""
+    if task.cancelled():
         return
-    
+    if task.exception() is not None:
+        logger.error(f"❌ Консьюмер остановлен: {task.exception()!r}")
+        set_stage("consumer_stopped", repr(task.exception()))
+
+
+async def initialize() -> None:
+    """
+    Загрузка моделей, пул инференса, прогрев и запуск консьюмера.
+    Консьюмер стартует только в состоянии ready (/ready); время стадий — в лог и startup_timings (/health).
+    """
+    global segmentator, pool, consumer, cache, sink
+    started = time.perf_counter()
     try:
-        logger.info("🔥 Начинаем прогрев моделей (GroundingDINO + SAM2)...")
-        start_time = time.time()
-        
-        # Создаем dummy изображение для прогрева
-        dummy_image = np.zeros((640, 640, 3), dtype=np.uint8)
-        
-        # Выполняем dummy inference
-        masks, boxes, labels, scores = segmentator.predict_with_array(dummy_image)
-        
-        elapsed = time.time() - start_time
-        device = segmentator.device
-        
-        logger.info(f"✅ Модели прогреты за {elapsed:.2f}s на устройстве: {device}")
-        logger.info(f"   - Найдено объектов: {len(boxes)} (ожидается 0 для пустого изображения)")
-        
-        models_warmed_up = True
-        
+        # сегментатор без весов: устройство, версия и decode_limits; режим пула зависит от устройства
+        segmentator = build_segmentator()
+        pool = InferencePool(
+            segmentator,
+            processes=settings.inference_processes,
+            threads_per_worker=settings.inference_threads_per_worker,
+            thread_workers=settings.inference_workers,
+            warmup_shapes=parse_shapes(settings.warmup_shapes),
+            warmup_batch_size=settings.batch_max_size,
+            config=segmentator_config(),
+        )
+
+        # веса грузятся в потоке: GDINO, процессор GDINO и SAM2 — параллельно (ImageSegmentator.load)
+        set_stage("loading_models")
+        stage_start = time.perf_counter()
+        await asyncio.to_thread(segmentator.load)
+        startup_timings["models"] = time.perf_counter() - stage_start
+        startup_timings.update({f"models.{name}": t for name, t in segmentator.load_timings.items()})
+        if pool.mode == "process":
+            # хранилище заполнено; модели держат только воркеры (веса — общий mmap хранилища)
+            segmentator.release()
+
+        # Процессы-воркеры (forkserver) загружают модели из хранилища и прогреваются в инициализаторе
+        set_stage("starting_pool")
+        stage_start = time.perf_counter()
+        await pool.start()
+        startup_timings["inference_pool"] = time.perf_counter() - stage_start
+        if settings.result_cache_size > 0:
+            cache = ResultCache(
+                segmentator.version,
+                max_entries=settings.result_cache_size,
+                path=settings.result_cache_path or None,
+                max_distance=settings.result_cache_max_distance,
+                persist_max_entries=settings.result_cache_persist_max,
+            )
+        if settings.result_sink_path or settings.result_sink_queue:
+            sink = ResultSink(
+                path=settings.result_sink_path or None,
+                queue_name=settings.result_sink_queue or None,
+                sample_rate=settings.result_sink_sample_rate,
+                max_bytes=settings.result_sink_max_mb * 2**20,
+                backups=settings.result_sink_backups,
+            )
+        consumer = ConsumerService(segmentator, downloader, pool, cache, sink, blob_cache)
+
+        set_stage("warming_up")
+        stage_start = time.perf_counter()
+        try:
+            await warmup_models()
+        except Exception as e:
+            if settings.warmup_required:
+                raise
+            logger.warning(f"⚠️ Ошибка прогрева ({e}), продолжаем без него: первая обработка будет медленной")
+        startup_timings["warmup"] = time.perf_counter() - stage_start
     except Exception as e:
-        logger.error(f"❌ Ошибка при прогреве моделей: {e}")
-        logger.warning("⚠️ Продолжаем работу без прогрева, первая обработка будет медленной")
-
-
-async def start_consumer() -> None:
-    connection: aio_pika.abc.AbstractRobustConnection = await aio_pika.connect_robust(settings.rabbitmq_url)
-    channel = await connection.channel()
-    await channel.set_qos(prefetch_count=10)
-
-    queue = await channel.declare_queue(settings.rabbitmq_queue_image_tasks, durable=True)
-
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            async with message.process():
-                try:
-                    start_time = time.time()
-                    payload = json.loads(message.body.decode("utf-8"))
-                    image_id = payload.get("image_id")
-                    image_path = payload.get("image_path")
-                    s3_url = payload.get("s3_url")
-
-                    logger.info(f"📥 Начата обработка image_id={image_id}")
-
-                    # Получаем изображение либо по локальному пути, либо по URL
-                    download_start = time.time()
-                    if image_path and os.path.exists(image_path):
-                        img = Image.open(image_path).convert("RGB")
-                        logger.info(f"   ✓ Загружено из локального пути за {time.time() - download_start:.2f}s")
-                    elif s3_url:
-                        async with httpx.AsyncClient(timeout=60.0) as client:
-                            resp = await client.get(s3_url)
-                            resp.raise_for_status()
-                            img = Image.open(io.BytesIO(resp.content)).convert("RGB")
-                            download_time = time.time() - download_start
-                            size_mb = len(resp.content) / (1024 * 1024)
-                            logger.info(f"   ✓ Загружено из S3: {size_mb:.2f} MB за {download_time:.2f}s")
-                    else:
-                        logger.error("❌ Нет ни локального пути, ни URL для изображения; пропускаю сообщение")
-                        continue
-
-                    # Сегментация изображения
-                    image_rgb = np.array(img, dtype=np.uint8)
-                    logger.info(f"   🖼️ Размер изображения: {img.size[0]}x{img.size[1]}")
-                    
-                    segment_start = time.time()
-                    masks, boxes, labels, scores = segmentator.predict_with_array(image_rgb)
-                    segment_time = time.time() - segment_start
-                    logger.info(f"   ✓ Сегментация завершена за {segment_time:.2f}s, найдено объектов: {len(boxes)}")
-
-                    # Формируем результат с координатами для Backend3
-                    result = {
-                        "image_id": image_id,
-                        "image_url": s3_url,  # URL исходного изображения
-                        "image_width": img.size[0],  # Ширина исходного изображения
-                        "image_height": img.size[1],  # Высота исходного изображения
-                        "detected_objects": [
-                            {
-                                "bbox": box.tolist() if hasattr(box, 'tolist') else list(box),  # [x1, y1, x2, y2] координаты для обрезки
-                                "label": label,
-                                "confidence": float(score)
-                            } for box, label, score in zip(boxes, labels, scores)
-                        ],
-                    }
-
-                    # Сохраняем detected_objects в JSON-файл (output.json)
-                    try:
-                        qq = result.get("detected_objects", [])
-                        # Если у объектов есть строковое поле description, пробуем распарсить как JSON
-                        for obj in qq:
-                            desc = obj.get("description")
-                            if isinstance(desc, str):
-                                s = desc.replace("\n", "").replace("  ", "")
-                                try:
-                                    obj["description"] = json.loads(s)
-                                except Exception:
-                                    pass
-                        with open("output.json", "w", encoding="utf-8") as f:
-                            json.dump(qq, f, ensure_ascii=False)
-                    except Exception as e:
-                        logger.warning("Не удалось сохранить output.json: %s", e)
-
-                    # Публикация результата в очередь результатов
-                    result_body = json.dumps(result).encode("utf-8")
-                    await channel.default_exchange.publish(
-                        Message(
-                            result_body,
-                            content_type="application/json",
-                            delivery_mode=DeliveryMode.PERSISTENT,
-                        ),
-                        routing_key=settings.rabbitmq_queue_image_results,
-                    )
-                    
-                    total_time = time.time() - start_time
-                    logger.info(f"✅ Обработка image_id={image_id} завершена за {total_time:.2f}s (найдено {len(boxes)} объектов)")
-                    
-                except Exception as e:
-                    logger.exception(f"❌ Ошибка обработки сообщения image_id={image_id}: %s", e)
+        logger.exception(f"❌ Ошибка запуска backend_2: {e}")
+        set_stage("failed", repr(e))
+        return
+    finally:
+        startup_timings["total"] = time.perf_counter() - started
+        logger.info("⏱️ Стадии запуска: " + ", ".join(f"{k}={v:.2f}s" for k, v in startup_timings.items()))
+
+    set_stage("ready")
+    # Запускаем consumer в фоновом режиме
+    app.state.consumer_task = asyncio.create_task(consumer.start_consumer())
+    app.state.consumer_task.add_done_callback(on_consumer_done)
 
 
 @app.on_event("startup")
 async def on_startup():
-    # Прогреваем модели перед началом обработки
-    await warmup_models()
-    # Запускаем consumer в фоновом режиме
-    asyncio.create_task(start_consumer())
+    app.state.init_task = asyncio.create_task(initialize())
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    if pool is not None:
+        pool.shutdown()
+    if cache is not None:
+        cache.close()
+    if sink is not None:
+        sink.close()
+    await downloader.aclose()
+
+
+@app.post("/masks")
+async def masks_on_demand(request: MaskRequest):
+    """
+    Маски SAM2 для переданных боксов (профили mask_on_demand и detect_mask).
+    Возвращает маски в формате settings.mask_format в порядке боксов (null — SAM2 отбросил бокс),
+    в разрешении анализа mask_width×mask_height (боксы — в пикселях оригинала).
+    """
+    if segmentator is None or consumer is None:
+        raise HTTPException(status_code=503, detail="Модели ещё загружаются")
+    if segmentator.sam2 is None:
+        raise HTTPException(status_code=409, detail=f"SAM2 отключён в профиле {settings.pipeline_profile}")
+    img = await consumer.load_image({"s3_url": request.s3_url})
+    if img is None:
+        raise HTTPException(status_code=400, detail="Нужен s3_url")
+    # боксы приходят в пикселях оригинала, маски считаются в разрешении анализа
+    # в режиме process — в воркере пула: в родителе весов нет
+    masks, timings = await pool.predict_masks(img.array, img.to_analysis(request.boxes))
+    metrics.observe_timings(timings)
+    return {"masks": masks, "count": len(masks), "mask_width": img.size[0], "mask_height": img.size[1]}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики Prometheus: стадии пайплайна, объекты на изображение, очередь, in-flight"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness: 200, когда модели загружены и прогреты и очередь читается; иначе 503 со стадией запуска"""
+    if not readiness["ready"]:
+        return JSONResponse(status_code=503, content=readiness)
+    return readiness
 
 
 @app.get("/health")
 async def health():
+    """Liveness: процесс жив и отвечает; готовность к обработке — /ready"""
     return {
         "status": "ok",
+        "models_loaded": "models" in startup_timings,
         "models_warmed_up": models_warmed_up,
-        "device": segmentator.device,
-        "cuda_available": segmentator.device == "cuda"
+        "ready": readiness["ready"],
+        "stage": readiness["stage"],
+        "pipeline_profile": settings.pipeline_profile,
+        "startup_timings": startup_timings,
+        "in_flight": consumer.in_flight if consumer is not None else 0,
+        "result_cache": cache.stats() if cache is not None else None,
+        "blob_cache": blob_cache.stats() if blob_cache is not None else None,
+        "inference_pool": {"mode": pool.mode, "workers": pool.workers} if pool is not None else None,
+        "runtime": segmentator.runtime if segmentator is not None else settings.runtime,
+        "quantized": segmentator.quantize if segmentator is not None else None,
+        "precision": segmentator.precision if segmentator is not None else settings.precision,
+        "device": segmentator.device if segmentator is not None else None,
+        "cuda_available": segmentator is not None and segmentator.device == "cuda"
     }
-
-
@@ -0,0 +1,12 @@
+"""
+Сервисы backend_2
+"""
+from ..ML.classes.ImageLoader import LoadedImage, decode_image
+from .http_client import HttpDownloader
+from .inference_pool import InferencePool
+from .result_cache import ResultCache
+from .result_sink import ResultSink
+from .blob_cache import BlobCache
+from .consumer_service import ConsumerService
+
+__all__ = ["LoadedImage", "decode_image", "HttpDownloader", "InferencePool", "ResultCache", "ResultSink", "BlobCache", "ConsumerService"]
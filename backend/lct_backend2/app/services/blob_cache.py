@@ -0,0 +1,127 @@
+"""
+Общий дисковый кэш исходных изображений по s3_key (backend2 пишет, backend3 читает).
+
+backend2 уже скачал исходный файл из S3; если каталог кэша — общий том сервисов на одном узле,
+backend3 берёт байты отсюда по s3_key из результата, а не скачивает тот же объект повторно.
+Файла нет (другой узел, вытеснен, кэш выключен) — вызывающий идёт в S3 как раньше.
+
+- s3_key уникален для загрузки (uuid в имени), содержимое по ключу не меняется — инвалидация не нужна;
+- запись атомарна: временный файл в том же каталоге + os.replace, читатель не видит недописанный файл;
+- LRU по mtime: чтение обновляет mtime, писатель при превышении max_bytes удаляет самые старые файлы.
+
+backend3 читает кэш через BlobReader (lct_backend3/app/services/blob_reader.py): имя файла (path) менять
+только вместе с ним.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Optional, Union
+
+_TMP_PREFIX = ".tmp-"
+
+
+class BlobCache:
+    """Файлы по sha256(s3_key) в каталоге root; потокобезопасен, несколько процессов — через файловую систему"""
+
+    def __init__(
+            self,
+            root: str,
+            max_bytes: int = 2 * 2**30, # 0 — этот процесс не вытесняет (только читает)
+            low_watermark: float = 0.9, # вытеснение до этой доли max_bytes
+            ) -> None:
+        self.root = root
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._size = self._scan()[1] if max_bytes > 0 else 0  # оценка; уточняется при вытеснении
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # недавно прочитанные вытесняются последними
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: Union[bytes, bytearray, memoryview]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=_TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)  # читатель может работать под другим пользователем
+            os.replace(tmp, self.path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.writes += 1
+            self._size += len(data)
+            over = 0 < self.max_bytes < self._size
+        if over:
+            self._evict()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "writes": self.writes,
+            "evicted": self.evicted,
+            "bytes": self._size,
+        }
+
+    def _scan(self):
+        """(файлы [(mtime, size, path)], суммарный размер); брошенные временные файлы удаляются"""
+        entries, total = [], 0
+        stale = time.time() - 3600
+        for entry in os.scandir(self.root):
+            try:
+                if not entry.is_file():
+                    continue
+                st = entry.stat()
+                if entry.name.startswith(_TMP_PREFIX):
+                    if st.st_mtime < stale:
+                        os.unlink(entry.path)
+                    continue
+            except FileNotFoundError:  # удалён другим процессом
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        return entries, total
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries, total = self._scan()
+            target = int(self.max_bytes * self.low_watermark)
+            for _, size, path in sorted(entries):
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                else:
+                    self.evicted += 1
+                total -= size
+            self._size = total
@@ -0,0 +1,326 @@
+"""
+Consumer задач на сегментацию из RabbitMQ.
+
+Конвейер из трёх стадий, чтобы инференс не блокировал event loop
+(health-пробы, heartbeats AMQP) и скачивание следующих изображений шло
+параллельно с инференсом текущих:
+
+    inbox (AMQP) -> загрузка/декодирование (async) -> ограниченная очередь
+    -> инференс в пуле потоков/процессов (InferencePool) -> публикация (async)
+
+Если изображение уже сегментировалось (ResultCache), оно публикуется сразу после
+загрузки, минуя очередь и инференс. Скачанные из S3 байты кладутся в общий BlobCache
+по s3_key — backend3 на том же узле читает их оттуда, а не из S3.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import aio_pika
+from aio_pika import Message, DeliveryMode
+
+from ..core.config import settings
+from ..ML.ImageSegmentatator import ImageSegmentator
+from ..ML.classes.StageTimer import StageTimer
+from . import metrics
+from .blob_cache import BlobCache
+from .http_client import HttpDownloader
+from ..ML.classes.ImageLoader import LoadedImage, decode_image
+from .inference_pool import InferencePool
+from .result_cache import CacheKey, ResultCache
+from .result_sink import ResultSink
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ImageJob:
+    """Сообщение из очереди вместе с уже загруженным изображением"""
+    message: aio_pika.abc.AbstractIncomingMessage
+    payload: dict
+    image: LoadedImage
+    received_at: float = field(default_factory=time.time)
+    cache_key: Optional[CacheKey] = None  # задан — результат инференса кладётся в кэш
+    from_cache: bool = False
+    queued_at: float = 0.0  # perf_counter постановки в очередь на инференс
+
+
+async def collect_batch(inbox: asyncio.Queue, max_size: int, max_wait_ms: int) -> list:
+    """
+    Ждёт первый элемент, затем добирает батч до max_size элементов,
+    но не дольше max_wait_ms с момента получения первого.
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await inbox.get()]
+    deadline = loop.time() + max_wait_ms / 1000.0
+    while len(batch) < max_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(inbox.get(), timeout=timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+def build_result(payload: dict, img: LoadedImage, masks, boxes, labels, scores) -> dict:
+    """
+    Формирует результат с координатами (и масками, если они посчитаны) для Backend3.
+    Боксы переводятся в пиксели исходного изображения; маски остаются в разрешении анализа
+    mask_width×mask_height — для наложения на оригинал их растягивают до image_width×image_height.
+    """
+    result = {
+        "image_id": payload.get("image_id"),
+        "image_url": payload.get("s3_url"),  # URL исходного изображения
+        "s3_key": payload.get("s3_key"),  # ключ исходного изображения в S3 и в общем BlobCache
+        "image_width": img.orig_size[0],  # Ширина исходного изображения
+        "image_height": img.orig_size[1],  # Высота исходного изображения
+        "detected_objects": [
+            {
+                "bbox": box,  # [x1, y1, x2, y2] координаты для обрезки
+                "label": label,
+                "confidence": float(score)
+            } for box, label, score in zip(img.to_original(boxes), labels, scores)
+        ],
+    }
+    # Маски в компактном виде (RLE / bitpacked), по одной на объект
+    if masks:
+        result["mask_width"], result["mask_height"] = img.size
+        for obj, mask in zip(result["detected_objects"], masks):
+            obj["mask"] = mask
+    return result
+
+
+class ConsumerService:
+    """Консьюмер задач на сегментацию: загрузка -> инференс -> публикация"""
+
+    def __init__(
+            self,
+            segmentator: ImageSegmentator,
+            downloader: HttpDownloader,
+            pool: InferencePool,
+            cache: Optional[ResultCache] = None,
+            sink: Optional[ResultSink] = None,
+            blob_cache: Optional[BlobCache] = None,
+            ):
+        self.amqp_url = settings.rabbitmq_url
+        self.queue_tasks = settings.rabbitmq_queue_image_tasks
+        self.queue_results = settings.rabbitmq_queue_image_results
+        self.segmentator = segmentator
+        self.downloader = downloader
+        # Инференс — в потоках или процессах пула, event loop остаётся свободным
+        self.pool = pool
+        self.cache = cache
+        self.sink = sink  # отладочная запись результатов (выборочно)
+        self.blob_cache = blob_cache  # исходные байты для backend3 (общий том)
+        self.in_flight = 0  # сообщений получено, но ещё не подтверждено
+        metrics.IN_FLIGHT.set_function(lambda: self.in_flight)
+        # download / decode / publish — сразу в метрики
+        self.timer = StageTimer(observer=metrics.observe_stage)
+        self._tasks: set = set()  # ссылки на фоновые задачи, чтобы их не собрал GC
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def load_image(self, payload: dict) -> Optional[LoadedImage]:
+        """
+        Загружает изображение либо по локальному пути, либо по URL,
+        и декодирует его один раз — сразу в разрешении анализа (см. decode_image)
+        """
+        image_path = payload.get("image_path")
+        s3_url = payload.get("s3_url")
+        max_short, max_long = self.segmentator.decode_limits() if settings.decode_downscale else (None, None)
+
+        download_start = time.time()
+        if image_path and os.path.exists(image_path):
+            source = image_path
+            logger.info(f"   ✓ Загружено из локального пути за {time.time() - download_start:.2f}s")
+        elif s3_url:
+            with self.timer.stage("download"):
+                source = await self.downloader.download(s3_url)
+            download_time = time.time() - download_start
+            size_mb = len(source) / (1024 * 1024)
+            logger.info(f"   ✓ Загружено из S3: {size_mb:.2f} MB за {download_time:.2f}s")
+            s3_key = payload.get("s3_key")
+            if self.blob_cache is not None and s3_key:
+                # до публикации результата — backend3 не должен опередить запись
+                try:
+                    await asyncio.to_thread(self.blob_cache.put, s3_key, source)
+                except OSError as e:
+                    logger.warning(f"Не удалось записать {s3_key} в BlobCache: {e}")
+        else:
+            logger.error("❌ Нет ни локального пути, ни URL для изображения; пропускаю сообщение")
+            return None
+
+        # Декодирование — в потоке, чтобы не блокировать event loop
+        decode_start = time.time()
+        with self.timer.stage("decode"):
+            loaded = await asyncio.to_thread(decode_image, source, max_short, max_long)
+        logger.info(
+            f"   ✓ Декодировано {loaded.orig_size[0]}x{loaded.orig_size[1]} -> "
+            f"{loaded.size[0]}x{loaded.size[1]} за {time.time() - decode_start:.2f}s"
+        )
+        return loaded
+
+    async def _ack(self, message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        """Подтверждает сообщение; ошибки обработки не возвращают его в очередь (как message.process())"""
+        try:
+            await message.ack()
+        except Exception as e:
+            logger.warning("Не удалось подтвердить сообщение: %s", e)
+        finally:
+            self.in_flight -= 1
+
+    async def _prepare(
+            self,
+            channel: aio_pika.abc.AbstractChannel,
+            message: aio_pika.abc.AbstractIncomingMessage,
+            ready: asyncio.Queue,
+            ) -> None:
+        """
+        Стадия 1: разбор сообщения и загрузка изображения; готовая задача кладётся в ready.
+        Если результат уже есть в кэше — публикуется сразу, без инференса.
+        """
+        try:
+            payload = json.loads(message.body.decode("utf-8"))
+        except Exception as e:
+            logger.exception("❌ Не удалось разобрать сообщение: %s", e)
+            await self._ack(message)
+            return
+
+        image_id = payload.get("image_id")
+        logger.info(f"📥 Начата обработка image_id={image_id}")
+        try:
+            img = await self.load_image(payload)
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки image_id={image_id}: {e}")
+            img = None
+        if img is None:
+            await self._ack(message)
+            return
+
+        job = ImageJob(message=message, payload=payload, image=img)
+        if self.cache is not None:
+            try:
+                # хэши и sqlite — в потоке
+                key = await asyncio.to_thread(self.cache.key, img.array)
+                output = await asyncio.to_thread(self.cache.get, key)
+            except Exception as e:
+                logger.warning(f"Кэш результатов недоступен для image_id={image_id}: {e}")
+                key = output = None
+            if output is not None:
+                logger.info(f"   ✓ Результат image_id={image_id} взят из кэша, инференс пропущен")
+                job.from_cache = True
+                await self._publish(channel, job, *output)
+                return
+            job.cache_key = key
+
+        # Очередь ограничена: если инференс не успевает, загрузка ждёт здесь
+        job.queued_at = time.perf_counter()
+        await ready.put(job)
+
+    async def _download_stage(
+            self,
+            channel: aio_pika.abc.AbstractChannel,
+            inbox: asyncio.Queue,
+            ready: asyncio.Queue,
+            ) -> None:
+        """Забирает сообщения из inbox и загружает изображения параллельно (не больше prefetch)"""
+        while True:
+            message = await inbox.get()
+            self.in_flight += 1
+            self._spawn(self._prepare(channel, message, ready))
+
+    async def _inference_stage(self, channel: aio_pika.abc.AbstractChannel, ready: asyncio.Queue) -> None:
+        """Стадия 2: батч готовых изображений -> сегментатор в потоке -> публикация в фоне"""
+        while True:
+            jobs: List[ImageJob] = await collect_batch(ready, settings.batch_max_size, settings.batch_max_wait_ms)
+            now = time.perf_counter()
+            for job in jobs:
+                metrics.QUEUE_LAG_SECONDS.observe(now - job.queued_at)
+
+            segment_start = time.time()
+            try:
+                outputs, timings = await self.pool.predict_batch([job.image.array for job in jobs])
+                metrics.observe_timings(timings)
+            except Exception as e:
+                logger.exception(f"❌ Ошибка сегментации батча из {len(jobs)} изображений: %s", e)
+                for job in jobs:
+                    await self._ack(job.message)
+                continue
+            segment_time = time.time() - segment_start
+            logger.info(f"   ✓ Сегментация батча из {len(jobs)} изображений завершена за {segment_time:.2f}s")
+
+            # Публикация не задерживает следующий батч
+            for job, output in zip(jobs, outputs):
+                self._spawn(self._publish(channel, job, *output))
+
+    async def _publish(self, channel: aio_pika.abc.AbstractChannel, job: ImageJob, masks, boxes, labels, scores) -> None:
+        """Стадия 3: публикация результата в очередь результатов и ack исходного сообщения"""
+        image_id = job.payload.get("image_id")
+        try:
+            result = build_result(job.payload, job.image, masks, boxes, labels, scores)
+
+            with self.timer.stage("publish"):
+                result_body = json.dumps(result).encode("utf-8")
+                await channel.default_exchange.publish(
+                    Message(
+                        result_body,
+                        content_type="application/json",
+                        delivery_mode=DeliveryMode.PERSISTENT,
+                    ),
+                    routing_key=self.queue_results,
+                )
+            metrics.BOXES_PER_IMAGE.observe(len(boxes))
+            metrics.IMAGES.labels("cache" if job.from_cache else "inference").inc()
+            if self.sink is not None and self.sink.sampled():
+                self.sink.write(result)
+                if self.sink.queue_name:
+                    await channel.default_exchange.publish(
+                        Message(result_body, content_type="application/json"),
+                        routing_key=self.sink.queue_name,
+                    )
+
+            if self.cache is not None and job.cache_key is not None:
+                try:
+                    await asyncio.to_thread(self.cache.put, job.cache_key, (masks, boxes, labels, scores))
+                except Exception as e:
+                    logger.warning(f"Не удалось сохранить результат image_id={image_id} в кэш: {e}")
+
+            total_time = time.time() - job.received_at
+            logger.info(f"✅ Обработка image_id={image_id} завершена за {total_time:.2f}s (найдено {len(boxes)} объектов)")
+        except Exception as e:
+            logger.exception(f"❌ Ошибка обработки сообщения image_id={image_id}: %s", e)
+        finally:
+            await self._ack(job.message)
+
+    async def start_consumer(self):
+        """Запускает консьюмер: стадии загрузки и инференса работают параллельно"""
+        connection: aio_pika.abc.AbstractRobustConnection = await aio_pika.connect_robust(self.amqp_url)
+        try:
+            channel = await connection.channel()
+            await channel.set_qos(prefetch_count=max(settings.rabbitmq_prefetch_count, settings.batch_max_size))
+
+            queue = await channel.declare_queue(self.queue_tasks, durable=True)
+            if self.sink is not None and self.sink.queue_name:
+                # отладочная очередь не переживает рестарт брокера и не копит сообщения без читателя
+                await channel.declare_queue(self.sink.queue_name, durable=False, arguments={"x-max-length": 1000})
+
+            inbox: asyncio.Queue = asyncio.Queue()
+            ready: asyncio.Queue = asyncio.Queue(maxsize=max(1, settings.pipeline_queue_size))
+            await queue.consume(inbox.put)
+            metrics.READY_QUEUE.set_function(ready.qsize)
+
+            stages = [self._download_stage(channel, inbox, ready)]
+            # по одной стадии инференса на воркер пула
+            stages += [self._inference_stage(channel, ready) for _ in range(self.pool.workers)]
+            await asyncio.gather(*stages)
+        finally:
+            await connection.close()
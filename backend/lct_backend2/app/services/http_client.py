@@ -0,0 +1,91 @@
+"""
+Общий HTTP-клиент backend_2 для скачивания изображений из S3/MinIO
+"""
+import asyncio
+import logging
+import random
+from typing import Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+try:  # HTTP/2 доступен только с установленным пакетом h2 (httpx[http2])
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Ответы, после которых имеет смысл повторить запрос
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class HttpDownloader:
+    """
+    Один httpx.AsyncClient на процесс: пул keep-alive соединений, HTTP/2 при наличии h2,
+    повторы с экспоненциальной задержкой и джиттером на временных ошибках,
+    потоковое чтение тела в заранее выделенный буфер (по Content-Length).
+    """
+
+    def __init__(
+        self,
+        timeout: float = 60.0,
+        max_connections: int = 20,
+        retries: int = 3,
+        backoff: float = 0.5,
+    ):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.retries = retries
+        self.backoff = backoff
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Клиент создаётся лениво, внутри работающего event loop"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+            )
+        return self._client
+
+    async def _fetch(self, url: str) -> bytearray:
+        async with self.client.stream("GET", url) as resp:
+            resp.raise_for_status()
+            # Content-Length описывает тело до распаковки — доверяем ему только без Content-Encoding
+            length = 0 if "content-encoding" in resp.headers else int(resp.headers.get("content-length") or 0)
+            buf = bytearray(length)
+            pos = 0
+            async for chunk in resp.aiter_bytes():
+                end = pos + len(chunk)
+                if end > len(buf):
+                    buf.extend(b"\0" * (end - len(buf)))
+                buf[pos:end] = chunk
+                pos = end
+            del buf[pos:]
+            return buf
+
+    async def download(self, url: str) -> bytearray:
+        """Скачивает тело ответа целиком; повторяет запрос на сетевых ошибках и 429/5xx"""
+        attempt = 0
+        while True:
+            try:
+                return await self._fetch(url)
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                transient = isinstance(e, httpx.TransportError) or e.response.status_code in RETRY_STATUS_CODES
+                if not transient or attempt >= self.retries:
+                    raise
+                delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+                attempt += 1
+                logger.warning(f"   ⚠️ Ошибка скачивания ({e!r}), повтор {attempt}/{self.retries} через {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
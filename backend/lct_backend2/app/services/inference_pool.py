@@ -0,0 +1,183 @@
+"""
+Пул инференса backend_2.
+
+- thread: ImageSegmentator в потоках текущего процесса (GPU и по умолчанию);
+- process: N процессов-воркеров для CPU-узлов, у каждого свой бюджет потоков torch.
+  Воркеры запускаются через forkserver, а не fork: к старту пула в родителе уже есть потоки
+  (загрузка моделей в asyncio.to_thread и ThreadPoolExecutor, intra-op потоки torch/OpenMP),
+  и fork такого процесса может зависнуть на унаследованных блокировках. Каждый воркер сам
+  загружает модели из локального хранилища (ModelStore: safetensors, без HF Hub) — родитель
+  к этому моменту заполнил хранилище и выгрузил модели (ImageSegmentator.release).
+  Веса на cpu — страницы mmap файлов хранилища (ModelStore.map_weights): в памяти узла одна
+  копия на всех воркеров, а не по копии на процесс (кроме int8: quantize_dynamic копирует модель).
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from ..ML.ImageSegmentatator import ImageSegmentator
+
+logger = logging.getLogger(__name__)
+
+# Сегментатор процесса-воркера (создаётся в _init_worker)
+_SEGMENTATOR: Optional[ImageSegmentator] = None
+# Время прогрева этого процесса-воркера, с, и ошибка прогрева (repr), если он не удался
+_WARMUP_TIMINGS: Dict[str, float] = {}
+_WARMUP_ERROR: Optional[str] = None
+# Барьер старта: каждый воркер отвечает ровно на один _worker_info
+_STARTED = None
+
+
+def _init_worker(config: dict, num_threads: int, shapes: List[Tuple[int, int]], batch_size: int, started) -> None:
+    """
+    Инициализация процесса-воркера: бюджет потоков, загрузка моделей и прогрев на формах shapes.
+    Ошибка прогрева не ломает пул (BrokenProcessPool) — она возвращается в _worker_info,
+    а решение по warmup_required принимает вызывающий InferencePool.warmup.
+    """
+    global _SEGMENTATOR, _WARMUP_ERROR, _STARTED
+    torch.set_num_threads(num_threads)
+    _STARTED = started
+    _SEGMENTATOR = ImageSegmentator(**config)
+    try:
+        _WARMUP_TIMINGS.update(_SEGMENTATOR.warmup(shapes, batch_size))
+    except Exception as e:
+        _WARMUP_ERROR = repr(e)
+        logger.exception(f"Ошибка прогрева воркера инференса pid={os.getpid()}: {e}")
+    logger.info(f"Воркер инференса pid={os.getpid()} готов ({num_threads} потоков torch)")
+
+
+def _worker_info() -> Tuple[int, Dict[str, float], Optional[str]]:
+    # ждём остальных: иначе быстрый воркер ответил бы и за тех, кто ещё грузит модели
+    _STARTED.wait()
+    return os.getpid(), dict(_WARMUP_TIMINGS), _WARMUP_ERROR
+
+
+def _predict_batch(images: List[np.ndarray]):
+    """
+    Выполняется в процессе-воркере; маски возвращаются уже закодированными (mask_format),
+    замеры стадий — вместе с результатом (метрики собирает родитель)
+    """
+    return _SEGMENTATOR.predict_batch_timed(images)
+
+
+def _predict_masks(image: np.ndarray, boxes: List[List[float]]):
+    """Маски по запросу в процессе-воркере: (masks, [(stage, group, seconds), ...])"""
+    return _SEGMENTATOR.predict_masks_timed(image, boxes)
+
+
+class InferencePool:
+    """Исполнитель ImageSegmentator.predict_batch для консьюмера"""
+
+    MODES = ("thread", "process")
+
+    def __init__(
+            self,
+            segmentator: ImageSegmentator,
+            processes: int = 0, # > 0 — процессы-воркеры (только на cpu)
+            threads_per_worker: int = 0, # 0 — поровну ядер на процесс
+            thread_workers: int = 1, # потоков инференса в режиме thread
+            warmup_shapes: Optional[List[Tuple[int, int]]] = None, # формы (H, W) для прогрева
+            warmup_batch_size: int = 1,
+            config: Optional[dict] = None, # аргументы ImageSegmentator для процессов-воркеров
+            ) -> None:
+        self.segmentator = segmentator
+        self.config = dict(config or {})
+        self.warmup_shapes = list(warmup_shapes or [])
+        self.warmup_batch_size = warmup_batch_size
+        # pid процесса-воркера (0 — потоки) -> время прогрева / ошибка прогрева
+        self.warmup_timings: Dict[int, Dict[str, float]] = {}
+        self.warmup_errors: Dict[int, str] = {}
+        self.mode = "process" if processes > 0 else "thread"
+        if self.mode == "process" and segmentator.device != "cpu":
+            # GPU и так загружен одним процессом; копия моделей на воркер ему не по памяти
+            logger.warning(f"Пул процессов доступен только на cpu (устройство: {segmentator.device}); использую потоки")
+            self.mode = "thread"
+        if self.mode == "process" and segmentator.runtime != "torch":
+            # ORT и так параллелит граф (ort_threads)
+            logger.warning("Пул процессов доступен только для runtime=torch; использую потоки")
+            self.mode = "thread"
+        if self.mode == "process" and config is None:
+            # воркеры создают свой сегментатор — нужны его аргументы
+            logger.warning("Пулу процессов не переданы аргументы ImageSegmentator; использую потоки")
+            self.mode = "thread"
+
+        self.workers = max(1, processes if self.mode == "process" else thread_workers)
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.workers)
+        self.executor: Optional[Executor] = None
+
+    async def start(self) -> None:
+        """
+        Создаёт исполнитель. В режиме process поднимает все процессы-воркеры (forkserver) и ждёт,
+        пока каждый загрузит модели и прогреется на warmup_shapes, не блокируя event loop.
+        """
+        if self.executor is not None:
+            return
+        if self.mode == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+            return
+
+        ctx = multiprocessing.get_context("forkserver")
+        # forkserver — чистый однопоточный процесс; torch и модели импортируются в нём один раз
+        ctx.set_forkserver_preload([ImageSegmentator.__module__])
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(
+                {**self.config, "_DEVICE": self.segmentator.device},
+                self.threads_per_worker,
+                self.warmup_shapes,
+                self.warmup_batch_size,
+                ctx.Barrier(self.workers),
+            ),
+        )
+        # Поднимаем все процессы сразу, а не по первым задачам
+        futures = [self.executor.submit(_worker_info) for _ in range(self.workers)]
+        infos = await asyncio.gather(*(asyncio.wrap_future(f) for f in futures))
+        self.warmup_timings = {pid: timings for pid, timings, _ in infos}
+        self.warmup_errors = {pid: error for pid, _, error in infos if error}
+        logger.info(f"Пул инференса: {len(self.warmup_timings)} процессов по {self.threads_per_worker} потоков torch")
+
+    async def warmup(self) -> Dict[int, Dict[str, float]]:
+        """
+        Прогрев на warmup_shapes. Потоки делят один сегментатор — достаточно одного прогона;
+        процессы-воркеры прогреваются в инициализаторе (start), здесь возвращается их время.
+        Ошибки прогрева воркеров поднимаются здесь, как и в режиме thread (см. warmup_required).
+        """
+        if self.warmup_errors:
+            raise RuntimeError(f"Прогрев не удался в воркерах: {self.warmup_errors}")
+        if self.mode == "thread" and self.warmup_shapes:
+            loop = asyncio.get_running_loop()
+            timings = await loop.run_in_executor(
+                self.executor, self.segmentator.warmup, self.warmup_shapes, self.warmup_batch_size
+            )
+            self.warmup_timings = {0: timings}
+        return self.warmup_timings
+
+    async def predict_batch(self, images: List[np.ndarray]):
+        """
+        ImageSegmentator.predict_batch_timed в воркере пула, не блокируя event loop:
+        (outputs, [(stage, group, seconds), ...])
+        """
+        loop = asyncio.get_running_loop()
+        if self.mode == "process":
+            return await loop.run_in_executor(self.executor, _predict_batch, images)
+        return await loop.run_in_executor(self.executor, self.segmentator.predict_batch_timed, images)
+
+    async def predict_masks(self, image: np.ndarray, boxes: List[List[float]]):
+        """ImageSegmentator.predict_masks_timed там же, где модели: (masks, [(stage, group, seconds), ...])"""
+        loop = asyncio.get_running_loop()
+        if self.mode == "process":
+            return await loop.run_in_executor(self.executor, _predict_masks, image, boxes)
+        return await loop.run_in_executor(self.executor, self.segmentator.predict_masks_timed, image, boxes)
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
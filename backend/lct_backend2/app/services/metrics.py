@@ -0,0 +1,41 @@
+"""
+Метрики backend_2 в формате Prometheus (GET /metrics).
+
+Длительности стадий приходят из StageTimer: download / decode / publish — из консьюмера,
+gdino (по группам промптов) / nms / sam2 — из ImageSegmentator.predict_batch_timed
+(в режиме process — вместе с результатом из воркера). Метрики живут в процессе консьюмера.
+"""
+from typing import Iterable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from ..ML.classes.StageTimer import Timing
+
+STAGE_SECONDS = Histogram(
+    "backend2_stage_seconds",
+    "Длительность стадии пайплайна сегментации",
+    ["stage", "group"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0),
+)
+BOXES_PER_IMAGE = Histogram(
+    "backend2_boxes_per_image",
+    "Объектов в опубликованном результате",
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500),
+)
+QUEUE_LAG_SECONDS = Histogram(
+    "backend2_queue_lag_seconds",
+    "Ожидание загруженного изображения в очереди на инференс",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+IN_FLIGHT = Gauge("backend2_in_flight_messages", "Сообщений получено, но ещё не подтверждено")
+READY_QUEUE = Gauge("backend2_ready_queue_size", "Загруженных изображений ждут инференса")
+IMAGES = Counter("backend2_images_total", "Обработанных изображений", ["source"])  # inference | cache
+
+
+def observe_stage(stage: str, group: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage, group).observe(seconds)
+
+
+def observe_timings(timings: Iterable[Timing]) -> None:
+    for stage, group, seconds in timings:
+        observe_stage(stage, group, seconds)
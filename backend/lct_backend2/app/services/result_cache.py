@@ -0,0 +1,203 @@
+"""
+Кэш результатов сегментации backend_2: повторная загрузка того же фото и /reprocess
+не гоняют GDINO + SAM2 заново.
+
+Ключ — хэши декодированного изображения (в разрешении анализа):
+- sha256 пикселей — точное совпадение;
+- dHash 16x16 (256 бит) — то же фото, пережатое или пересохранённое
+  (совпадение при той же форме массива и расстоянии Хэмминга <= max_distance); только при
+  max_distance > 0: у почти однородных кадров (ночь, пересвет, небо) dHash совпадает и у разных фото;
+и версия моделей / порогов (ImageSegmentator.version): при её смене старые записи не используются.
+
+Хранение: LRU в памяти; опционально — sqlite-файл (переживает рестарт, ограничен persist_max_entries).
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class CacheKey:
+    """Хэши декодированного изображения"""
+    sha256: str
+    dhash: str  # hex, 256 бит
+    shape: Tuple[int, int]  # (H, W) массива анализа
+
+
+def content_hash(array: np.ndarray) -> str:
+    """sha256 пикселей вместе с формой массива"""
+    h = hashlib.sha256(str(array.shape).encode("ascii"))
+    h.update(np.ascontiguousarray(array).data)
+    return h.hexdigest()
+
+
+def dhash(array: np.ndarray, size: int = 16) -> str:
+    """Difference hash: знаки разностей соседних пикселей уменьшенного серого изображения"""
+    gray = Image.fromarray(array).convert("L").resize((size + 1, size), Image.BILINEAR)
+    pixels = np.asarray(gray, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return np.packbits(bits).tobytes().hex()
+
+
+def hamming(a: str, b: str) -> int:
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+
+def _to_jsonable(output) -> list:
+    """(masks, boxes, labels, scores) с numpy-типами -> обычные списки и float"""
+    masks, boxes, labels, scores = output
+    return [
+        list(masks),
+        [[float(v) for v in box] for box in boxes],
+        [str(label) for label in labels],
+        [float(s) for s in scores],
+    ]
+
+
+class ResultCache:
+    """LRU-кэш выходов ImageSegmentator.predict_batch по CacheKey; потокобезопасен"""
+
+    def __init__(
+            self,
+            version: str,
+            max_entries: int = 512,
+            path: Optional[str] = None, # sqlite-файл; None — только память
+            max_distance: int = 0, # допустимое расстояние Хэмминга dHash; <= 0 — только точный sha256
+            persist_max_entries: int = 10000,
+            ) -> None:
+        self.version = version
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.persist_max_entries = persist_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # sha256 -> (CacheKey, output)
+        self._entries: "OrderedDict[str, Tuple[CacheKey, list]]" = OrderedDict()
+        self._by_dhash: Dict[Tuple[str, Tuple[int, int]], str] = {}
+        self._puts = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "sha256 TEXT, version TEXT, dhash TEXT, h INTEGER, w INTEGER, output TEXT, used REAL, "
+                "PRIMARY KEY (sha256, version))"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_dhash ON results (version, dhash, h, w)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            self._db.commit()
+
+    def key(self, array: np.ndarray) -> CacheKey:
+        return CacheKey(sha256=content_hash(array), dhash=dhash(array), shape=tuple(array.shape[:2]))
+
+    def get(self, key: CacheKey) -> Optional[list]:
+        """Сохранённый выход (masks, boxes, labels, scores) или None"""
+        with self._lock:
+            sha = self._find(key)
+            if sha is not None:
+                self._entries.move_to_end(sha)
+                self.hits += 1
+                return self._entries[sha][1]
+            output = self._load(key)
+            if output is not None:
+                self._remember(key, output)
+                self.hits += 1
+                return output
+            self.misses += 1
+            return None
+
+    def put(self, key: CacheKey, output) -> None:
+        output = _to_jsonable(output)
+        with self._lock:
+            self._remember(key, output)
+            if self._db is not None:
+                self._store(key, output)
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    # память
+
+    def _find(self, key: CacheKey) -> Optional[str]:
+        if key.sha256 in self._entries:
+            return key.sha256
+        if self.max_distance <= 0:
+            return None
+        sha = self._by_dhash.get((key.dhash, key.shape))
+        if sha is not None:
+            return sha
+        for sha, (other, _) in reversed(self._entries.items()):
+            if other.shape == key.shape and hamming(other.dhash, key.dhash) <= self.max_distance:
+                return sha
+        return None
+
+    def _remember(self, key: CacheKey, output: list) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key.sha256] = (key, output)
+        self._entries.move_to_end(key.sha256)
+        self._by_dhash[(key.dhash, key.shape)] = key.sha256
+        while len(self._entries) > self.max_entries:
+            _, (old, _) = self._entries.popitem(last=False)
+            if self._by_dhash.get((old.dhash, old.shape)) == old.sha256:
+                del self._by_dhash[(old.dhash, old.shape)]
+
+    # sqlite
+
+    def _load(self, key: CacheKey) -> Optional[list]:
+        if self._db is None:
+            return None
+        if self.max_distance <= 0:
+            row = self._db.execute(
+                "SELECT sha256, output FROM results WHERE version = ? AND sha256 = ?", (self.version, key.sha256)
+            ).fetchone()
+        else:
+            # из sqlite — точный sha256 или тот же dHash; поиск по расстоянию — только среди записей в памяти
+            row = self._db.execute(
+                "SELECT sha256, output FROM results WHERE version = ? AND (sha256 = ? OR (dhash = ? AND h = ? AND w = ?)) "
+                "ORDER BY sha256 = ? DESC LIMIT 1",
+                (self.version, key.sha256, key.dhash, *key.shape, key.sha256),
+            ).fetchone()
+        if row is None:
+            return None
+        self._db.execute(
+            "UPDATE results SET used = ? WHERE sha256 = ? AND version = ?", (time.time(), row[0], self.version)
+        )
+        self._db.commit()
+        return json.loads(row[1])
+
+    def _store(self, key: CacheKey, output: list) -> None:
+        try:
+            body = json.dumps(output)
+        except TypeError:
+            # маски mask_format="array" не сериализуются — такие результаты только в памяти
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key.sha256, self.version, key.dhash, *key.shape, body, time.time()),
+        )
+        self._puts += 1
+        if self._puts % 100 == 0:
+            # вытесняем давно не использованные записи (и записи старых версий моделей)
+            self._db.execute(
+                "DELETE FROM results WHERE rowid NOT IN (SELECT rowid FROM results ORDER BY used DESC LIMIT ?)",
+                (self.persist_max_entries,),
+            )
+        self._db.commit()
@@ -0,0 +1,85 @@
+"""
+Отладочный приёмник результатов backend_2 (вместо перезаписи output.json на каждое сообщение).
+
+Выключен по умолчанию. Результаты отбираются с вероятностью sample_rate и пишутся:
+- в JSONL-файл с ротацией — сериализация и запись в фоновом потоке (QueueHandler / QueueListener),
+  event loop только кладёт ссылку в очередь;
+- и/или в отладочную очередь RabbitMQ (публикует ConsumerService).
+В пути файла можно использовать {host} и {pid}, чтобы реплики в одном каталоге не писали в один файл.
+"""
+import json
+import logging
+import os
+import queue
+import random
+import socket
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Кладёт запись в очередь как есть: форматирование — в потоке QueueListener"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class _JsonLineFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(record.msg, ensure_ascii=False, default=str)
+
+
+class ResultSink:
+    """Выборочная запись опубликованных результатов в JSONL-файл и/или отладочную очередь"""
+
+    def __init__(
+            self,
+            path: Optional[str] = None, # JSONL-файл; None — без файла
+            queue_name: Optional[str] = None, # отладочная очередь RabbitMQ; None — без очереди
+            sample_rate: float = 1.0, # доля записываемых результатов
+            max_bytes: int = 50 * 2**20, # размер файла до ротации
+            backups: int = 3, # сколько ротированных файлов хранить
+            max_pending: int = 1000, # очередь на запись; при переполнении записи отбрасываются
+            ) -> None:
+        self.queue_name = queue_name
+        self.sample_rate = sample_rate
+        self.dropped = 0
+        self.path: Optional[str] = None
+        self._listener: Optional[QueueListener] = None
+        if path:
+            self.path = path.format(host=socket.gethostname(), pid=os.getpid())
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            handler = RotatingFileHandler(self.path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+            handler.setFormatter(_JsonLineFormatter())
+            self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+            self._logger = logging.getLogger(f"{__name__}.{id(self)}")
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            self._logger.addHandler(_DeferredQueueHandler(self._queue))
+            self._listener = QueueListener(self._queue, handler)
+            self._listener.start()
+            logger.info(f"Результаты пишутся в {self.path} (доля {sample_rate})")
+
+    def sampled(self) -> bool:
+        """Записывать ли очередной результат"""
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def write(self, result: dict) -> None:
+        """Ставит результат в очередь на запись в файл; не блокирует"""
+        if self._listener is None:
+            return
+        if self._queue.full():
+            self.dropped += 1
+            return
+        self._logger.info({"ts": time.time(), **result})
+
+    def close(self) -> None:
+        """Дописывает очередь и закрывает файл"""
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
@@ -3,6 +3,7 @@ FastAPI приложение backend3: читает результаты backend
 """
 import asyncio
 import base64
+import hashlib
 import io
 import os
 import json
@@ -15,17 +16,53 @@ import httpx
 from aio_pika import Message, DeliveryMode
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from pydantic import BaseModel
-from PIL import Image
+from PIL import Image, ImageOps
 
 from .core.config import settings
+from .services import BlobReader, CropEncoder, VlmCache, VlmDispatcher, VlmError, cache_key
+from .services.vlm_batch import BATCH_MODES, describe_batch
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Backend 3 - Image Describer", version="1.0.0")
 
-# Endpoint NVIDIA Integrate API
-NVIDIA_INTEGRATE_URL = "https://integrate.api.nvidia.com/v1/chat/completions"
+if settings.vlm_batch_mode not in BATCH_MODES:
+    raise ValueError(f"Unsupported vlm_batch_mode: {settings.vlm_batch_mode}. Use one of {BATCH_MODES}.")
+
+# Все запросы к VLM (консьюмер и HTTP-эндпоинты) идут через общий диспетчер:
+# лимит конкурентности и темпа, повторы с учётом Retry-After, мелкие кропы — первыми
+dispatcher = VlmDispatcher(
+    url=settings.nvidia_invoke_url,
+    api_key=settings.nvidia_api_key,
+    model=settings.vlm_model,
+    max_concurrency=settings.vlm_max_concurrency,
+    requests_per_minute=settings.vlm_requests_per_minute,
+    burst=settings.vlm_burst,
+    max_retries=settings.vlm_max_retries,
+    backoff_s=settings.vlm_backoff_s,
+    backoff_max_s=settings.vlm_backoff_max_s,
+    timeout_s=settings.vlm_timeout_s,
+)
+
+# Кропы для VLM: уменьшение до рабочего разрешения модели и подбор качества JPEG под бюджет байтов
+crop_encoder = CropEncoder(
+    max_side=settings.crop_max_side,
+    max_bytes=settings.crop_max_bytes,
+    margin=settings.crop_margin,
+    quality_max=settings.crop_quality_max,
+    quality_min=settings.crop_quality_min,
+)
+
+# Исходные изображения, уже скачанные backend2 (общий том на одном узле); пусто — всегда из S3
+blob_cache: Optional[BlobReader] = BlobReader(settings.blob_cache_dir) if settings.blob_cache_dir else None
+
+# Описания одинаковых кропов берутся из кэша (повторные загрузки, /reprocess)
+vlm_cache: Optional[VlmCache] = VlmCache(
+    ttl_s=settings.vlm_cache_ttl_s,
+    max_entries=settings.vlm_cache_size,
+    path=settings.vlm_cache_path or None,
+) if settings.vlm_cache_size > 0 else None
 
 
 class ImageAnalysisRequest(BaseModel):
@@ -160,185 +197,250 @@ Armillaria; Phytophthora; древоточцы; комлевая гниль; с
 (В финальном ответе выводи ТОЛЬКО JSON по схеме; без примеров и дополнительного текста.)'''
     return a
 
+
+def prompt_version() -> str:
+    """Версия промпта для ключа кэша описаний: текст промпта и режим пакетного описания"""
+    mode = f"batch:{settings.vlm_batch_mode}:{settings.vlm_mosaic_cell}" if settings.vlm_batch_size > 1 else "single"
+    return hashlib.sha256(f"{get_prompt_text()}|{mode}".encode("utf-8")).hexdigest()[:16]
+
+
+PROMPT_VERSION = prompt_version()
+
 async def start_consumer() -> None:
     connection: aio_pika.abc.AbstractRobustConnection = await aio_pika.connect_robust(settings.rabbitmq_url)
     channel = await connection.channel()
-    await channel.set_qos(prefetch_count=10)
+    await channel.set_qos(prefetch_count=settings.rabbitmq_prefetch_count)
 
     queue = await channel.declare_queue(settings.rabbitmq_queue_image_results, durable=True)
 
-    async with queue.iterator() as queue_iter:
-        async for message in queue_iter:
-            async with message.process():
-                try:
-                    start_time = time.time()
-                    payload = json.loads(message.body.decode("utf-8"))
-                    image_id = payload.get("image_id")
-                    image_url = payload.get("image_url")
-                    detected_objects = payload.get("detected_objects", [])
-
-                    logger.info(f"📥 Backend3: Начата обработка image_id={image_id}, объектов: {len(detected_objects)}")
-
-                    if not image_url:
-                        logger.error(f"❌ Нет URL изображения для image_id={image_id}")
-                        continue
-
-                    if not detected_objects:
-                        # Если объекты не найдены, анализируем целое изображение и возвращаем как единичный объект
-                        result_text = await call_nvidia_api_by_url(image_url)
-                        
-                        # Проверяем overall_confidence
-                        should_include = check_confidence_threshold(result_text)
-                        
-                        if should_include:
-                            result = {
-                                "image_id": image_id,
-                                "detected_objects": [
-                                    {
-                                        "bbox": [],
-                                        "label": "изображение целиком",
-                                        "confidence": 1.0,
-                                        "fragment_url": image_url,
-                                        "description": result_text,
-                                    }
-                                ],
-                            }
-                        else:
-                            # Если уверенность низкая, возвращаем пустой список объектов
-                            logger.info(f"Изображение целиком для image_id={image_id} отфильтровано по low confidence (<=20%)")
-                            result = {
-                                "image_id": image_id,
-                                "detected_objects": [],
-                            }
+    async def handle_message(message: aio_pika.abc.AbstractIncomingMessage) -> None:
+        async with message.process():
+            try:
+                start_time = time.time()
+                payload = json.loads(message.body.decode("utf-8"))
+                image_id = payload.get("image_id")
+                image_url = payload.get("image_url")
+                s3_key = payload.get("s3_key")
+                detected_objects = payload.get("detected_objects", [])
+
+                logger.info(f"📥 Backend3: Начата обработка image_id={image_id}, объектов: {len(detected_objects)}")
+
+                if not image_url:
+                    logger.error(f"❌ Нет URL изображения для image_id={image_id}")
+                    return
+
+                if not detected_objects:
+                    # Если объекты не найдены, анализируем целое изображение и возвращаем как единичный объект
+                    result_text = await describe_whole_image(image_url, await read_blob(s3_key))
+                    
+                    # Проверяем overall_confidence
+                    should_include = check_confidence_threshold(result_text)
+                    
+                    if should_include:
+                        result = {
+                            "image_id": image_id,
+                            "detected_objects": [
+                                {
+                                    "bbox": [],
+                                    "label": "изображение целиком",
+                                    "confidence": 1.0,
+                                    "fragment_url": image_url,
+                                    "description": result_text,
+                                }
+                            ],
+                        }
                     else:
-                        # ОПТИМИЗАЦИЯ: Скачиваем изображение ОДИН РАЗ для всех фрагментов
-                        download_start = time.time()
-                        logger.info(f"   📥 Скачивание изображения из S3...")
-                        
-                        try:
+                        # Если уверенность низкая, возвращаем пустой список объектов
+                        logger.info(f"Изображение целиком для image_id={image_id} отфильтровано по low confidence (<=20%)")
+                        result = {
+                            "image_id": image_id,
+                            "detected_objects": [],
+                        }
+                else:
+                    # ОПТИМИЗАЦИЯ: Загружаем изображение ОДИН РАЗ для всех фрагментов —
+                    # из общего BlobCache (байты, уже скачанные backend2), иначе из S3
+                    download_start = time.time()
+
+                    try:
+                        image_data = await read_blob(s3_key)
+                        source = "BlobCache"
+                        if image_data is None:
+                            logger.info(f"   📥 Скачивание изображения из S3...")
                             async with httpx.AsyncClient(timeout=60.0) as client:
                                 resp = await client.get(image_url)
                                 resp.raise_for_status()
                                 image_data = resp.content
-                                img = Image.open(io.BytesIO(image_data)).convert("RGB")
-                                
-                            download_time = time.time() - download_start
-                            size_mb = len(image_data) / (1024 * 1024)
-                            logger.info(f"   ✓ Изображение загружено: {size_mb:.2f} MB за {download_time:.2f}s")
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка загрузки изображения: {e}")
-                            continue
-                        
-                        # ПАРАЛЛЕЛЬНАЯ обработка фрагментов через asyncio.gather()
-                        logger.info(f"   🚀 Начинаем ПАРАЛЛЕЛЬНУЮ обработку {len(detected_objects)} фрагментов...")
-                        
-                        # Создаём ОБЩИЙ httpx клиент для всех параллельных запросов
-                        async with httpx.AsyncClient(timeout=120.0, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)) as shared_client:
-                            
-                            async def process_single_fragment(i: int, obj: dict, img_pil: Image.Image, client: httpx.AsyncClient) -> Optional[dict]:
-                                """Обрабатывает один фрагмент: обрезка, анализ VLM, сохранение"""
-                                try:
-                                    fragment_start = time.time()
-                                    bbox = obj.get("bbox", [])  # [x1, y1, x2, y2]
-                                    label = obj.get("label", "объект")
-                                    confidence = obj.get("confidence", 0.0)
-                                    
-                                    logger.info(f"      🔍 [{i+1}] Обработка фрагмента (label={label}, conf={confidence:.2f})")
-                                    
-                                    if len(bbox) != 4:
-                                        return None
-                                    
-                                    # Обрезаем изображение по координатам (БЕЗ повторной загрузки!)
-                                    x1, y1, x2, y2 = bbox
-                                    cropped_img = img_pil.crop((int(x1), int(y1), int(x2), int(y2)))
-                                    
-                                    # Конвертируем в base64
-                                    buffer = io.BytesIO()
-                                    cropped_img.save(buffer, format='JPEG', quality=95)
-                                    cropped_image_b64 = base64.b64encode(buffer.getvalue()).decode()
-                                    
-                                    crop_time = time.time() - fragment_start
-                                    logger.info(f"         ✓ [{i+1}] Обрезка: {crop_time:.2f}s")
-                                    
-                                    # Анализируем обрезанный фрагмент через NVIDIA API (РЕАЛЬНО параллельно с общим клиентом!)
-                                    api_start = time.time()
-                                    fragment_description = await call_nvidia_api_with_base64_shared(cropped_image_b64, client)
-                                    api_time = time.time() - api_start
-                                    logger.info(f"         ✓ [{i+1}] NVIDIA VLM API: {api_time:.2f}s")
-                                    
-                                    # Проверяем overall_confidence
-                                    should_include = check_confidence_threshold(fragment_description)
-                                    
-                                    if not should_include:
-                                        logger.info(f"         ⚠️ [{i+1}] Фильтр: low confidence (<=20%)")
-                                        return None
-                                    
-                                    # Сохраняем обрезанное изображение в S3 (параллельно!)
-                                    save_start = time.time()
-                                    fragment_url = await save_cropped_image_shared(cropped_image_b64, image_id, i, label, client)
-                                    save_time = time.time() - save_start
-                                    logger.info(f"         ✓ [{i+1}] S3 save: {save_time:.2f}s")
-                                    
-                                    fragment_time = time.time() - fragment_start
-                                    logger.info(f"      ✅ [{i+1}] ГОТОВО за {fragment_time:.2f}s")
-                                    
-                                    return {
-                                        "bbox": bbox,
-                                        "label": label,
-                                        "confidence": confidence,
-                                        "fragment_url": fragment_url,
-                                        "description": fragment_description
-                                    }
-                                    
-                                except Exception as e:
-                                    logger.error(f"         ❌ [{i+1}] Ошибка: {e}")
-                                    return None
-                            
-                            # Запускаем ВСЕ фрагменты РЕАЛЬНО ПАРАЛЛЕЛЬНО с общим HTTP клиентом
-                            parallel_start = time.time()
-                            tasks = [
-                                process_single_fragment(i, obj, img, shared_client) 
-                                for i, obj in enumerate(detected_objects)
-                            ]
-                            results = await asyncio.gather(*tasks, return_exceptions=True)
-                            parallel_time = time.time() - parallel_start
-                        
-                        # Фильтруем успешные результаты
-                        processed_objects = [r for r in results if r is not None and not isinstance(r, Exception)]
-                        
-                        # Возвращаем список объектов без комбинированного текста
-                        result = {
-                            "image_id": image_id,
-                            "detected_objects": processed_objects
-                        }
-                        
-                        logger.info(f"   ⚡ Параллельная обработка: {len(processed_objects)}/{len(detected_objects)} за {parallel_time:.2f}s")
-
-                    await channel.default_exchange.publish(
-                        Message(
-                            json.dumps(result).encode("utf-8"),
-                            content_type="application/json",
-                            delivery_mode=DeliveryMode.PERSISTENT,
-                        ),
-                        routing_key=settings.rabbitmq_queue_image_descriptions,
-                    )
+                            source = "S3"
+                        img = await asyncio.to_thread(open_image, image_data)
+
+                        download_time = time.time() - download_start
+                        size_mb = len(image_data) / (1024 * 1024)
+                        logger.info(f"   ✓ Изображение загружено из {source}: {size_mb:.2f} MB за {download_time:.2f}s")
+                    except Exception as e:
+                        logger.error(f"❌ Ошибка загрузки изображения: {e}")
+                        return
                     
-                    total_time = time.time() - start_time
-                    obj_count = len(result.get("detected_objects", []))
-                    logger.info(f"✅ Backend3: Обработка image_id={image_id} завершена за {total_time:.2f}s (возвращено {obj_count} объектов)")
-                    
-                except Exception as e:
-                    logger.exception(f"❌ Backend3: Ошибка обработки image_id={image_id}: %s", e)
+                    # Обработка фрагментов: обрезка -> описание VLM (по одному или пакетами) -> фильтр и сохранение
+                    logger.info(f"   🚀 Начинаем обработку {len(detected_objects)} фрагментов...")
+                    parallel_start = time.time()
+
+                    def crop_fragment(i: int, obj: dict, img_pil: Image.Image):
+                        """
+                        Обрезка фрагмента по bbox (без повторной загрузки): JPEG в base64 для сохранения
+                        (полное разрешение) и компактный кроп для VLM (crop_encoder)
+                        """
+                        fragment_start = time.time()
+                        bbox = obj.get("bbox", [])  # [x1, y1, x2, y2]
+                        label = obj.get("label", "объект")
+                        confidence = obj.get("confidence", 0.0)
+
+                        logger.info(f"      🔍 [{i+1}] Обработка фрагмента (label={label}, conf={confidence:.2f})")
+
+                        if len(bbox) != 4:
+                            return None
+
+                        x1, y1, x2, y2 = bbox
+                        cropped_img = img_pil.crop((int(x1), int(y1), int(x2), int(y2)))
+
+                        # Конвертируем в base64
+                        buffer = io.BytesIO()
+                        cropped_img.save(buffer, format='JPEG', quality=95)
+                        cropped_image_b64 = base64.b64encode(buffer.getvalue()).decode()
+
+                        vlm_crop = crop_encoder.encode(img_pil, bbox)
+                        crop_encoder.record(buffer.tell(), vlm_crop)
+
+                        crop_time = time.time() - fragment_start
+                        logger.info(
+                            f"         ✓ [{i+1}] Обрезка: {crop_time:.2f}s, в VLM {vlm_crop.size[0]}x{vlm_crop.size[1]} "
+                            f"q{vlm_crop.quality}: {len(vlm_crop.data) / 1024:.0f} KB вместо {buffer.tell() / 1024:.0f} KB"
+                        )
+                        return cropped_image_b64, vlm_crop.b64
+
+                    # Создаём ОБЩИЙ httpx клиент для сохранения фрагментов
+                    async with httpx.AsyncClient(timeout=120.0, limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)) as shared_client:
+
+                        async def finish_fragment(i: int, obj: dict, cropped_image_b64: str, fragment_description: str, client: httpx.AsyncClient) -> Optional[dict]:
+                            """Фильтр по уверенности VLM и сохранение фрагмента"""
+                            try:
+                                label = obj.get("label", "объект")
+
+                                # Проверяем overall_confidence
+                                should_include = check_confidence_threshold(fragment_description)
+
+                                if not should_include:
+                                    logger.info(f"         ⚠️ [{i+1}] Фильтр: low confidence (<=20%)")
+                                    return None
+
+                                # Сохраняем обрезанное изображение в S3 (параллельно!)
+                                save_start = time.time()
+                                fragment_url = await save_cropped_image_shared(cropped_image_b64, image_id, i, label, client)
+                                save_time = time.time() - save_start
+                                logger.info(f"         ✓ [{i+1}] S3 save: {save_time:.2f}s")
+
+                                fragment = {
+                                    "bbox": obj.get("bbox", []),
+                                    "label": label,
+                                    "confidence": obj.get("confidence", 0.0),
+                                    "fragment_url": fragment_url,
+                                    "description": fragment_description
+                                }
+                                # Маска от backend2 (RLE / bitpacked) передаётся дальше без изменений
+                                if obj.get("mask") is not None:
+                                    fragment["mask"] = obj["mask"]
+                                return fragment
+
+                            except Exception as e:
+                                logger.error(f"         ❌ [{i+1}] Ошибка: {e}")
+                                return None
+
+                        # обрезка и кодирование — в потоках, event loop остаётся свободным
+                        crops = []
+                        cropped = await asyncio.gather(
+                            *(asyncio.to_thread(crop_fragment, i, obj, img) for i, obj in enumerate(detected_objects)),
+                            return_exceptions=True,
+                        )
+                        for i, (obj, res) in enumerate(zip(detected_objects, cropped)):
+                            if isinstance(res, Exception):
+                                logger.error(f"         ❌ [{i+1}] Ошибка: {res}")
+                            elif res is not None:
+                                crops.append((i, obj, *res))
+
+                        # Описания всех кропов: запросы к VLM ограничивает диспетчер; приоритет —
+                        # общий для изображения (суммарный размер кропов), чтобы небольшие изображения
+                        # завершались первыми, а не делили очередь с кропами крупных
+                        api_start = time.time()
+                        crops_b64 = [c[3] for c in crops]
+                        descriptions = await describe_fragments(crops_b64, priority=sum(len(c) for c in crops_b64))
+                        logger.info(f"         ✓ NVIDIA VLM API: {len(crops)} фрагментов за {time.time() - api_start:.2f}s")
+
+                        tasks = [
+                            finish_fragment(i, obj, cropped_image_b64, description, shared_client)
+                            for (i, obj, cropped_image_b64, _), description in zip(crops, descriptions)
+                        ]
+                        results = await asyncio.gather(*tasks, return_exceptions=True)
+                        parallel_time = time.time() - parallel_start
+
+                    # Фильтруем успешные результаты
+                    processed_objects = [r for r in results if r is not None and not isinstance(r, Exception)]
+
+                    # Возвращаем список объектов без комбинированного текста
+                    result = {
+                        "image_id": image_id,
+                        "detected_objects": processed_objects
+                    }
+
+                    logger.info(f"   ⚡ Обработка фрагментов: {len(processed_objects)}/{len(detected_objects)} за {parallel_time:.2f}s")
+
+                await channel.default_exchange.publish(
+                    Message(
+                        json.dumps(result).encode("utf-8"),
+                        content_type="application/json",
+                        delivery_mode=DeliveryMode.PERSISTENT,
+                    ),
+                    routing_key=settings.rabbitmq_queue_image_descriptions,
+                )
+                
+                total_time = time.time() - start_time
+                obj_count = len(result.get("detected_objects", []))
+                logger.info(f"✅ Backend3: Обработка image_id={image_id} завершена за {total_time:.2f}s (возвращено {obj_count} объектов)")
+                
+            except Exception as e:
+                logger.exception(f"❌ Backend3: Ошибка обработки image_id={image_id}: %s", e)
+
+    # Сообщения обрабатываются параллельно — не больше prefetch_count неподтверждённых.
+    # Запросы к VLM всех изображений идут через общий диспетчер с приоритетом по изображению
+    # (суммарный размер его кропов), поэтому небольшие изображения публикуются первыми.
+    handlers: set = set()  # ссылки на задачи, чтобы их не собрал GC
+    async with queue.iterator() as queue_iter:
+        async for message in queue_iter:
+            task = asyncio.create_task(handle_message(message))
+            handlers.add(task)
+            task.add_done_callback(handlers.discard)
 
 
 @app.on_event("startup")
 async def on_startup():
+    dispatcher.start()
     asyncio.create_task(start_consumer())
 
 
+@app.on_event("shutdown")
+async def on_shutdown():
+    await dispatcher.aclose()
+    if vlm_cache is not None:
+        vlm_cache.close()
+
+
 @app.get("/health")
 async def health():
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "vlm": dispatcher.stats(),
+        "vlm_cache": vlm_cache.stats() if vlm_cache is not None else None,
+        "crop_encoder": crop_encoder.stats(),
+        "blob_cache": blob_cache.stats() if blob_cache is not None else None,
+    }
 
 
 async def crop_image_from_url(image_url: str, bbox: list) -> Optional[str]:
@@ -359,7 +461,7 @@ async def crop_image_from_url(image_url: str, bbox: list) -> Optional[str]:
             resp.raise_for_status()
             
             # Открываем изображение
-            img = Image.open(io.BytesIO(resp.content)).convert("RGB")
+            img = ImageOps.exif_transpose(Image.open(io.BytesIO(resp.content))).convert("RGB")
             
             # Обрезаем по координатам [x1, y1, x2, y2]
             x1, y1, x2, y2 = bbox
@@ -377,54 +479,142 @@ async def crop_image_from_url(image_url: str, bbox: list) -> Optional[str]:
         return None
 
 
-async def call_nvidia_api_with_base64_shared(image_b64: str, client: httpx.AsyncClient) -> str:
+async def call_nvidia_api_with_base64_shared(image_b64: str, priority: Optional[float] = None) -> str:
     """
-    Вызывает NVIDIA API с base64 изображением используя общий HTTP клиент
+    Вызывает NVIDIA API с base64 изображением через общий диспетчер.
     
     Args:
         image_b64: base64 изображения
-        client: Общий httpx.AsyncClient для параллельных запросов
+        priority: приоритет в диспетчере (меньше — раньше); по умолчанию — размер изображения
         
     Returns:
         str: Описание изображения
     """
     try:
-        prompt_text = get_prompt_text()
-        headers = {
-            "Authorization": f"Bearer {settings.nvidia_api_key}" if settings.nvidia_api_key else "",
-            "Accept": "application/json",
-        }
-        payload = {
-            "model": "meta/llama-3.2-90b-vision-instruct",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
-                    ],
-                }
+        text = await dispatcher.chat(
+            [
+                {"type": "text", "text": get_prompt_text()},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
             ],
-            "max_tokens": 512,
-            "temperature": 1.0,
-            "top_p": 1.0,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0,
-            "stream": False,
-        }
-        
-        resp = await client.post(NVIDIA_INTEGRATE_URL, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        if "choices" in data and data["choices"]:
-            return data["choices"][0]["message"]["content"]
-        return "Не удалось получить описание"
+            max_tokens=512,
+            priority=len(image_b64) if priority is None else priority,
+        )
+        return text if text is not None else "Не удалось получить описание"
             
     except Exception as e:
         logger.error(f"Ошибка при вызове NVIDIA API: {e}")
         return f"Ошибка анализа: {str(e)}"
 
 
+def open_image(image_data: bytes) -> Image.Image:
+    """RGB с учётом EXIF-ориентации, как в backend2 — bbox приходят в этих координатах"""
+    return ImageOps.exif_transpose(Image.open(io.BytesIO(image_data))).convert("RGB")
+
+
+async def read_blob(s3_key: Optional[str]) -> Optional[bytes]:
+    """Исходные байты из общего BlobCache (их уже скачал backend2); None — кэша нет или промах"""
+    if blob_cache is None or not s3_key:
+        return None
+    try:
+        return await asyncio.to_thread(blob_cache.get, s3_key)
+    except OSError as e:
+        logger.warning(f"BlobCache недоступен для {s3_key}: {e}")
+        return None
+
+
+async def describe_whole_image(image_url: str, image_data: Optional[bytes]) -> str:
+    """
+    Описание изображения целиком. Если байты есть локально — отправляются инлайн (base64,
+    уменьшенные crop_encoder), и провайдеру не нужно скачивать исходник по presigned URL.
+    """
+    if image_data is None:
+        return await call_nvidia_api_by_url(image_url)
+    img = await asyncio.to_thread(open_image, image_data)
+    encoded = await asyncio.to_thread(crop_encoder.encode, img)
+    crop_encoder.record(len(image_data), encoded)
+    text = await dispatcher.chat(
+        [
+            {"type": "text", "text": get_prompt_text()},
+            {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded.b64}"}},
+        ],
+        max_tokens=1024,
+        priority=len(encoded.b64),  # как у кропов: суммарный размер изображений запроса
+    )
+    return text or ""
+
+
+def is_vlm_json(text: str) -> bool:
+    """Ответ VLM — валидный JSON (ошибки и пустые ответы в кэш не попадают)"""
+    try:
+        json.loads(text)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+async def describe_fragments(crops_b64: List[str], priority: float = 0.0) -> List[str]:
+    """
+    Описания кропов в порядке входа: сначала кэш описаний (vlm_cache),
+    остальные — запросами к VLM (describe_uncached) с приоритетом priority; валидные ответы сохраняются в кэш.
+    """
+    if vlm_cache is None:
+        return await describe_uncached(crops_b64, priority)
+
+    keys = [cache_key(base64.b64decode(c), PROMPT_VERSION, settings.vlm_model) for c in crops_b64]
+    results = [await asyncio.to_thread(vlm_cache.get, key) for key in keys]
+    missing = [i for i, text in enumerate(results) if text is None]
+    if len(missing) < len(crops_b64):
+        logger.info(f"   ✓ Описания из кэша: {len(crops_b64) - len(missing)}/{len(crops_b64)}")
+
+    fresh = await describe_uncached([crops_b64[i] for i in missing], priority)
+    for i, text in zip(missing, fresh):
+        results[i] = text
+        if is_vlm_json(text):
+            await asyncio.to_thread(vlm_cache.put, keys[i], text)
+    return results
+
+
+async def describe_uncached(crops_b64: List[str], priority: float = 0.0) -> List[str]:
+    """
+    Описания кропов запросами к VLM, в порядке входа. При vlm_batch_size > 1 — пакетами по vlm_batch_size кропов
+    на запрос (services.vlm_batch): промпт уходит один раз на пакет. Пакет, ответ на который
+    не разобрался, описывается по одному кропу.
+    """
+    k = settings.vlm_batch_size
+    if k <= 1 or len(crops_b64) <= 1:
+        return list(await asyncio.gather(*(call_nvidia_api_with_base64_shared(c, priority) for c in crops_b64)))
+
+    # близкие по размеру кропы — в один пакет (ячейки мозаики одного масштаба)
+    order = sorted(range(len(crops_b64)), key=lambda i: len(crops_b64[i]))
+    chunks = [order[start:start + k] for start in range(0, len(order), k)]
+
+    async def describe_chunk(chunk: List[int]) -> List[str]:
+        batch = [crops_b64[i] for i in chunk]
+        if len(batch) > 1:
+            try:
+                descriptions = await describe_batch(
+                    dispatcher,
+                    get_prompt_text(),
+                    batch,
+                    mode=settings.vlm_batch_mode,
+                    tokens_per_crop=settings.vlm_batch_tokens_per_crop,
+                    cell=settings.vlm_mosaic_cell,
+                    priority=priority,
+                )
+            except Exception as e:
+                logger.warning(f"Пакетный запрос к VLM не удался ({e}), описываем по одному")
+                descriptions = None
+            if descriptions is not None:
+                return descriptions
+        return list(await asyncio.gather(*(call_nvidia_api_with_base64_shared(c, priority) for c in batch)))
+
+    results: List[str] = [""] * len(crops_b64)
+    for chunk, descriptions in zip(chunks, await asyncio.gather(*(describe_chunk(c) for c in chunks))):
+        for i, description in zip(chunk, descriptions):
+            results[i] = description
+    return results
+
+
 async def call_nvidia_api_with_base64(image_b64: str) -> str:
     """
     Вызывает NVIDIA API с base64 изображением (legacy версия для обратной совместимости)
@@ -435,42 +625,7 @@ async def call_nvidia_api_with_base64(image_b64: str) -> str:
     Returns:
         str: Описание изображения
     """
-    try:
-        prompt_text = get_prompt_text()
-        headers = {
-            "Authorization": f"Bearer {settings.nvidia_api_key}" if settings.nvidia_api_key else "",
-            "Accept": "application/json",
-        }
-        payload = {
-            "model": "meta/llama-3.2-90b-vision-instruct",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
-                    ],
-                }
-            ],
-            "max_tokens": 512,
-            "temperature": 1.0,
-            "top_p": 1.0,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0,
-            "stream": False,
-        }
-        
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            resp = await client.post(NVIDIA_INTEGRATE_URL, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            if "choices" in data and data["choices"]:
-                return data["choices"][0]["message"]["content"]
-            return "Не удалось получить описание"
-            
-    except Exception as e:
-        logger.error(f"Ошибка при вызове NVIDIA API: {e}")
-        return f"Ошибка анализа: {str(e)}"
+    return await call_nvidia_api_with_base64_shared(image_b64)
 
 
 async def save_cropped_image_shared(image_b64: str, image_id: int, fragment_index: int, label: str, client: httpx.AsyncClient) -> str:
@@ -556,36 +711,14 @@ async def save_cropped_image(image_b64: str, image_id: int, fragment_index: int,
 
 async def call_nvidia_api_by_url(image_url: str) -> str:
     # Читаем промпт через хелпер
-    prompt_text = get_prompt_text()
-    headers = {
-        "Authorization": f"Bearer {settings.nvidia_api_key}" if settings.nvidia_api_key else "",
-        "Accept": "application/json",
-    }
-    payload = {
-        "model": "meta/llama-3.2-90b-vision-instruct",
-        "messages": [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt_text},
-                    {"type": "image_url", "image_url": {"url": image_url}},
-                ],
-            }
+    text = await dispatcher.chat(
+        [
+            {"type": "text", "text": get_prompt_text()},
+            {"type": "image_url", "image_url": {"url": image_url}},
         ],
-        "max_tokens": 1024,
-        "temperature": 1.0,
-        "top_p": 1.0,
-        "frequency_penalty": 0.0,
-        "presence_penalty": 0.0,
-        "stream": False,
-    }
-    async with httpx.AsyncClient(timeout=120.0) as client:
-        resp = await client.post(NVIDIA_INTEGRATE_URL, headers=headers, json=payload)
-        resp.raise_for_status()
-        data = resp.json()
-        if "choices" in data and data["choices"]:
-            return data["choices"][0]["message"]["content"]
-        return ""
+        max_tokens=1024,
+    )
+    return text or ""
 
 
 @app.get("/")
@@ -608,7 +741,7 @@ async def analyze_image_by_url(request: ImageAnalysisRequest):
     try:
         text = await call_nvidia_api_by_url(request.image_url)
         return ImageAnalysisResponse(success=True, result=text)
-    except httpx.HTTPError as e:
+    except (httpx.HTTPError, VlmError) as e:
         return ImageAnalysisResponse(success=False, result="", error=f"Ошибка при обращении к NVIDIA API: {str(e)}")
     except Exception as e:
         return ImageAnalysisResponse(success=False, result="", error=f"Внутренняя ошибка сервера: {str(e)}")
@@ -625,40 +758,22 @@ async def analyze_uploaded_image(
         raise HTTPException(status_code=400, detail="Файл должен быть изображением")
     try:
         file_content = await file.read()
-        image_b64 = base64.b64encode(file_content).decode()
+        # Изображение целиком — через тот же кодировщик, что и кропы (разрешение и бюджет байтов VLM)
+        img = ImageOps.exif_transpose(Image.open(io.BytesIO(file_content)))
+        encoded = await asyncio.to_thread(crop_encoder.encode, img)
         # Всегда используем промпт из файла, игнорируя пришедший text_prompt
-        prompt_text = get_prompt_text()
-
-        headers = {
-            "Authorization": f"Bearer {settings.nvidia_api_key}" if settings.nvidia_api_key else "",
-            "Accept": "application/json",
-        }
-        payload = {
-            "model": "meta/llama-3.2-90b-vision-instruct",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {"type": "image_url", "image_url": {"url": f"data:{file.content_type};base64,{image_b64}"}},
-                    ],
-                }
+        text = await dispatcher.chat(
+            [
+                {"type": "text", "text": get_prompt_text()},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{encoded.b64}"}},
             ],
-            "max_tokens": max_tokens,
-            "temperature": temperature,
-            "top_p": 1.0,
-            "frequency_penalty": 0.0,
-            "presence_penalty": 0.0,
-            "stream": False,
-        }
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            resp = await client.post(NVIDIA_INTEGRATE_URL, headers=headers, json=payload)
-            resp.raise_for_status()
-            data = resp.json()
-            if "choices" in data and data["choices"]:
-                return ImageAnalysisResponse(success=True, result=data["choices"][0]["message"]["content"])
-            return ImageAnalysisResponse(success=False, result="", error="Не удалось получить результат анализа")
-    except httpx.HTTPError as e:
+            max_tokens=max_tokens,
+            temperature=temperature,
+        )
+        if text is not None:
+            return ImageAnalysisResponse(success=True, result=text)
+        return ImageAnalysisResponse(success=False, result="", error="Не удалось получить результат анализа")
+    except (httpx.HTTPError, VlmError) as e:
         return ImageAnalysisResponse(success=False, result="", error=f"Ошибка при обращении к NVIDIA API: {str(e)}")
     except Exception as e:
         return ImageAnalysisResponse(success=False, result="", error=f"Внутренняя ошибка сервера: {str(e)}")
@@ -0,0 +1,9 @@
+"""
+Сервисы backend3
+"""
+from .vlm_dispatcher import VlmDispatcher, VlmError
+from .vlm_cache import VlmCache, cache_key
+from .crop_encoder import CropEncoder, EncodedCrop
+from .blob_reader import BlobReader
+
+__all__ = ["VlmDispatcher", "VlmError", "VlmCache", "cache_key", "CropEncoder", "EncodedCrop", "BlobReader"]
@@ -0,0 +1,44 @@
+"""
+Чтение общего дискового кэша исходных изображений, который пишет backend2 (app/services/blob_cache.py).
+
+backend3 только читает: запись, атомарность и вытеснение — на стороне backend2. Отсюда берётся
+лишь схема имён (файл sha256(s3_key) в каталоге кэша) — она должна совпадать с BlobCache.path backend2.
+Файла нет (другой узел, вытеснен, кэш выключен) — вызывающий идёт в S3.
+"""
+import hashlib
+import os
+import threading
+from typing import Optional
+
+
+class BlobReader:
+    """Только чтение файлов BlobCache backend2 по s3_key; потокобезопасен"""
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(path)  # LRU backend2 по mtime: прочитанный файл вытесняется последним
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses}
@@ -0,0 +1,118 @@
+"""
+Подготовка кропа для VLM: не больше, чем модель реально использует, и не больше бюджета байтов.
+
+- bbox расширяется на margin (доля стороны бокса с каждой стороны) — контекст вокруг объекта,
+  в пределах изображения;
+- кроп уменьшается до max_side по длинной стороне (llama-3.2-vision режет вход на тайлы 560 px,
+  не больше 2×2 — детали мельче всё равно теряются);
+- качество JPEG подбирается двоичным поиском: наибольшее в [quality_min, quality_max],
+  при котором кроп укладывается в max_bytes; если не укладывается и на quality_min —
+  кроп уменьшается ещё. Бюджет по умолчанию — чтобы base64 поместился в инлайн-лимит
+  NVIDIA API (~180 KB).
+"""
+import base64
+import io
+import threading
+from dataclasses import dataclass
+from typing import Optional, Sequence, Tuple
+
+from PIL import Image
+
+
+@dataclass
+class EncodedCrop:
+    data: bytes
+    size: Tuple[int, int]  # (width, height) после уменьшения
+    quality: int
+
+    @property
+    def b64(self) -> str:
+        return base64.b64encode(self.data).decode()
+
+
+class CropEncoder:
+    """JPEG-кропы для VLM с ограничением разрешения и размера; считает сэкономленные байты"""
+
+    def __init__(
+            self,
+            max_side: int = 1120,
+            max_bytes: int = 135_000, # 0 — без бюджета (quality_max)
+            margin: float = 0.0,
+            quality_max: int = 90,
+            quality_min: int = 40,
+            ) -> None:
+        self.max_side = max_side
+        self.max_bytes = max_bytes
+        self.margin = margin
+        self.quality_max = quality_max
+        self.quality_min = min(quality_min, quality_max)
+        # суммарно: байты, ушедшие в VLM, и байты тех же кропов в прежнем виде (полное разрешение, q95)
+        self.crops = 0
+        self.bytes_sent = 0
+        self.bytes_baseline = 0
+        self._lock = threading.Lock()  # encode вызывается из потоков
+
+    def expand(self, bbox: Sequence[float], width: int, height: int) -> Tuple[int, int, int, int]:
+        """bbox [x1, y1, x2, y2], расширенный на margin и обрезанный по границам изображения"""
+        x1, y1, x2, y2 = (float(v) for v in bbox)
+        dx, dy = (x2 - x1) * self.margin, (y2 - y1) * self.margin
+        return (
+            max(0, int(x1 - dx)),
+            max(0, int(y1 - dy)),
+            min(width, int(x2 + dx)),
+            min(height, int(y2 + dy)),
+        )
+
+    def encode(self, img: Image.Image, bbox: Optional[Sequence[float]] = None) -> EncodedCrop:
+        """Кроп img по bbox (None — всё изображение), уменьшенный и сжатый под бюджет"""
+        crop = img.crop(self.expand(bbox, *img.size)) if bbox is not None else img
+        if crop.mode != "RGB":
+            crop = crop.convert("RGB")
+        if self.max_side and max(crop.size) > self.max_side:
+            crop = crop.copy()
+            crop.thumbnail((self.max_side, self.max_side), Image.LANCZOS, reducing_gap=2.0)
+
+        while True:
+            encoded = self._fit_quality(crop)
+            if not self.max_bytes or len(encoded.data) <= self.max_bytes or min(crop.size) <= 64:
+                return encoded
+            # даже quality_min не помещается — уменьшаем разрешение
+            crop = crop.resize((max(1, int(crop.width * 0.75)), max(1, int(crop.height * 0.75))), Image.LANCZOS)
+
+    def record(self, baseline_bytes: int, encoded: EncodedCrop) -> None:
+        with self._lock:
+            self.crops += 1
+            self.bytes_sent += len(encoded.data)
+            self.bytes_baseline += baseline_bytes
+
+    def stats(self) -> dict:
+        return {
+            "crops": self.crops,
+            "bytes_sent": self.bytes_sent,
+            "bytes_baseline": self.bytes_baseline,
+            "bytes_saved": self.bytes_baseline - self.bytes_sent,
+        }
+
+    @staticmethod
+    def _jpeg(img: Image.Image, quality: int) -> bytes:
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+    def _fit_quality(self, img: Image.Image) -> EncodedCrop:
+        """Наибольшее качество в [quality_min, quality_max], укладывающееся в max_bytes (или quality_min)"""
+        data = self._jpeg(img, self.quality_max)
+        if not self.max_bytes or len(data) <= self.max_bytes:
+            return EncodedCrop(data, img.size, self.quality_max)
+        lo, hi = self.quality_min, self.quality_max - 1
+        best = None
+        while lo <= hi:
+            q = (lo + hi) // 2
+            candidate = self._jpeg(img, q)
+            if len(candidate) <= self.max_bytes:
+                best, lo = EncodedCrop(candidate, img.size, q), q + 1
+            else:
+                hi = q - 1
+        if best is None:
+            best = EncodedCrop(self._jpeg(img, self.quality_min), img.size, self.quality_min)
+        return best
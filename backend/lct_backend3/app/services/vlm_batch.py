@@ -0,0 +1,123 @@
+"""
+Пакетное описание фрагментов: K кропов в одном запросе к VLM вместо K запросов.
+
+Режимы:
+- mosaic — контактный лист: кропы в сетке пронумерованных ячеек на одном изображении
+  (для моделей, которые принимают одно изображение на запрос, как llama-3.2-vision);
+- images — K изображений по порядку в одном сообщении.
+Системный промпт отправляется один раз на пакет; модель возвращает JSON-массив
+описаний с полем index. Если ответ не разобрался — вызывающий описывает кропы по одному.
+"""
+import base64
+import io
+import json
+import logging
+import math
+from typing import List, Optional
+
+from PIL import Image, ImageDraw, ImageFont
+
+from .vlm_dispatcher import VlmDispatcher
+
+logger = logging.getLogger(__name__)
+
+BATCH_MODES = ("mosaic", "images")
+
+
+def batch_prompt(prompt_text: str, k: int, mode: str) -> str:
+    """Промпт одиночного описания + инструкция пакетного режима"""
+    if mode == "mosaic":
+        source = (f"Изображение — контактный лист из {k} пронумерованных ячеек (номер в левом верхнем углу ячейки), "
+                  f"в каждой ячейке crop одного объекта.")
+    else:
+        source = f"Передано {k} изображений по порядку, номера 1..{k}; на каждом crop одного объекта."
+    return f"""{prompt_text}
+
+ПАКЕТНЫЙ РЕЖИМ
+{source}
+Проанализируй каждый объект отдельно по инструкции выше, не смешивая признаки соседних объектов.
+Верни JSON-МАССИВ ровно из {k} объектов по схеме выше, в порядке номеров; в каждый объект добавь поле "index" — номер объекта.
+Никакого текста вне массива. Ответ должен завершаться закрывающей квадратной скобкой."""
+
+
+def contact_sheet(crops_jpeg: List[bytes], cell: int = 448, quality: int = 90) -> bytes:
+    """Кропы, вписанные в ячейки cell×cell сетки ~sqrt(K)×sqrt(K), с номерами 1..K; JPEG"""
+    k = len(crops_jpeg)
+    cols = math.ceil(math.sqrt(k))
+    rows = math.ceil(k / cols)
+    sheet = Image.new("RGB", (cols * cell, rows * cell), "white")
+    draw = ImageDraw.Draw(sheet)
+    try:
+        font = ImageFont.load_default(size=max(12, cell // 12))
+    except TypeError:  # Pillow < 10.1: только растровый шрифт фиксированного размера
+        font = ImageFont.load_default()
+    pad = max(2, cell // 64)
+
+    for n, data in enumerate(crops_jpeg):
+        crop = Image.open(io.BytesIO(data)).convert("RGB")
+        crop.thumbnail((cell - 2 * pad, cell - 2 * pad))
+        x0, y0 = (n % cols) * cell, (n // cols) * cell
+        sheet.paste(crop, (x0 + (cell - crop.width) // 2, y0 + (cell - crop.height) // 2))
+        draw.rectangle((x0, y0, x0 + cell - 1, y0 + cell - 1), outline="black", width=pad)
+        label = str(n + 1)
+        box = draw.textbbox((0, 0), label, font=font)
+        w, h = box[2] - box[0], box[3] - box[1]
+        draw.rectangle((x0 + pad, y0 + pad, x0 + 3 * pad + w, y0 + 3 * pad + h), fill="black")
+        draw.text((x0 + 2 * pad - box[0], y0 + 2 * pad - box[1]), label, fill="white", font=font)
+
+    buffer = io.BytesIO()
+    sheet.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def parse_batch_response(text: Optional[str], k: int) -> Optional[List[str]]:
+    """
+    JSON-массив из k описаний -> k JSON-строк в порядке номеров (как ответ одиночного запроса).
+    None — если ответ не массив из k объектов или номера index не 1..k.
+    """
+    if not text:
+        return None
+    start, end = text.find("["), text.rfind("]")
+    if start < 0 or end <= start:
+        return None
+    try:
+        items = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list) or len(items) != k or not all(isinstance(item, dict) for item in items):
+        return None
+
+    indices = [item.get("index") for item in items]
+    if all(isinstance(i, int) for i in indices):
+        if sorted(indices) != list(range(1, k + 1)):
+            return None
+        items = sorted(items, key=lambda item: item["index"])
+    return [json.dumps({key: v for key, v in item.items() if key != "index"}, ensure_ascii=False) for item in items]
+
+
+async def describe_batch(
+        dispatcher: VlmDispatcher,
+        prompt_text: str,
+        crops_b64: List[str],
+        mode: str = "mosaic",
+        tokens_per_crop: int = 512, # max_tokens запроса — на каждый кроп, как у одиночного описания
+        cell: int = 448,
+        priority: Optional[float] = None, # приоритет в диспетчере; None — средний размер кропа
+        ) -> Optional[List[str]]:
+    """Описания K кропов одним запросом; None — если ответ не прошёл проверку"""
+    k = len(crops_b64)
+    if mode == "mosaic":
+        sheet = contact_sheet([base64.b64decode(c) for c in crops_b64], cell=cell)
+        images = [base64.b64encode(sheet).decode()]
+    else:
+        images = crops_b64
+    content = [{"type": "text", "text": batch_prompt(prompt_text, k, mode)}]
+    content += [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{b64}"}} for b64 in images]
+
+    if priority is None:
+        priority = sum(len(b) for b in images) / k
+    text = await dispatcher.chat(content, max_tokens=tokens_per_crop * k, priority=priority)
+    descriptions = parse_batch_response(text, k)
+    if descriptions is None:
+        logger.warning(f"VLM: пакетный ответ на {k} кропов не разобран, описываем по одному")
+    return descriptions
@@ -0,0 +1,100 @@
+"""
+Кэш описаний VLM: одинаковые кропы (/reprocess, повторная загрузка) не описываются заново.
+
+Ключ — sha256 байтов кропа + версия промпта + id модели. Значение — сырой JSON-ответ модели.
+Записи живут ttl_s секунд; в памяти — LRU на max_entries записей, опционально — sqlite-файл
+(переживает рестарт, ограничен persist_max_entries).
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+
+def cache_key(crop_bytes: bytes, prompt_version: str, model: str) -> str:
+    h = hashlib.sha256(crop_bytes)
+    h.update(f"|{prompt_version}|{model}".encode("utf-8"))
+    return h.hexdigest()
+
+
+class VlmCache:
+    """TTL + LRU кэш описаний по cache_key; потокобезопасен (sqlite вызывается из потоков)"""
+
+    def __init__(
+            self,
+            ttl_s: float = 7 * 24 * 3600,
+            max_entries: int = 2048,
+            path: Optional[str] = None, # sqlite-файл; None — только память
+            persist_max_entries: int = 50000,
+            ) -> None:
+        self.ttl_s = ttl_s
+        self.max_entries = max_entries
+        self.persist_max_entries = persist_max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key -> (created, text)
+        self._puts = 0
+        self._db: Optional[sqlite3.Connection] = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS descriptions (key TEXT PRIMARY KEY, text TEXT, created REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS descriptions_created ON descriptions (created)")
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] > self.ttl_s:
+                del self._entries[key]
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute(
+                    "SELECT created, text FROM descriptions WHERE key = ? AND created >= ?", (key, now - self.ttl_s)
+                ).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1])
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, text: str) -> None:
+        entry = (time.time(), text)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is None:
+                return
+            self._db.execute("INSERT OR REPLACE INTO descriptions VALUES (?, ?, ?)", (key, text, entry[0]))
+            self._puts += 1
+            if self._puts % 100 == 0:
+                # просроченные и самые старые сверх лимита
+                self._db.execute("DELETE FROM descriptions WHERE created < ?", (entry[0] - self.ttl_s,))
+                self._db.execute(
+                    "DELETE FROM descriptions WHERE key NOT IN (SELECT key FROM descriptions ORDER BY created DESC LIMIT ?)",
+                    (self.persist_max_entries,),
+                )
+            self._db.commit()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, key: str, entry: Tuple[float, str]) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
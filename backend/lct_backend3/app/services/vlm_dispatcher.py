@@ -0,0 +1,231 @@
+"""
+Общий диспетчер запросов к VLM (chat completions) для backend3.
+
+Все вызовы модели идут через одну очередь с приоритетом:
+- не больше max_concurrency запросов одновременно (по воркеру на слот, один пул соединений);
+- темп запросов ограничен token bucket (requests_per_minute, burst);
+- 429 / 5xx / сетевые ошибки повторяются с экспоненциальной задержкой и джиттером;
+  Retry-After (секунды или HTTP-дата) ставит на паузу все воркеры — лимит у провайдера общий;
+- меньший priority уходит раньше: консьюмер обрабатывает сообщения параллельно, и все кропы
+  изображения передают общий приоритет — их суммарный размер; небольшие изображения
+  завершаются (и публикуются) первыми, а не ждут за крупными.
+Так пропускная способность упирается в лимит провайдера, а не разваливается в ошибки.
+"""
+import asyncio
+import email.utils
+import itertools
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class VlmError(Exception):
+    """Запрос к VLM не удался после всех повторов"""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After в секундах: число секунд или HTTP-дата"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Не больше rate запросов в секунду в среднем, всплеск до burst"""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass(order=True)
+class _Job:
+    priority: float
+    seq: int
+    payload: dict = field(compare=False)
+    future: asyncio.Future = field(compare=False)
+
+
+class VlmDispatcher:
+    """Очередь запросов к chat completions с ограничением конкурентности и темпа"""
+
+    def __init__(
+            self,
+            url: str,
+            api_key: Optional[str],
+            model: str,
+            max_concurrency: int = 8,
+            requests_per_minute: float = 40.0, # 0 — без ограничения темпа
+            burst: int = 4,
+            max_retries: int = 4,
+            backoff_s: float = 1.0,
+            backoff_max_s: float = 30.0,
+            timeout_s: float = 120.0,
+            ) -> None:
+        self.url = url
+        self.api_key = api_key
+        self.model = model
+        self.max_concurrency = max(1, max_concurrency)
+        self.bucket = TokenBucket(requests_per_minute / 60.0, burst)
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.backoff_max_s = backoff_max_s
+        self.timeout_s = timeout_s
+
+        self.active = 0  # запросов сейчас у провайдера (с учётом повторов)
+        self.retries = 0
+        self.throttled = 0  # ответов 429
+        self.failed = 0
+        self._seq = itertools.count()
+        self._paused_until = 0.0  # time.monotonic(): пауза по Retry-After
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._workers: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Создаёт клиент и воркеры; вызывать внутри работающего event loop"""
+        if self._workers:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._client = httpx.AsyncClient(
+            timeout=self.timeout_s,
+            limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+        )
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def aclose(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            "active": self.active,
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "max_concurrency": self.max_concurrency,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "failed": self.failed,
+        }
+
+    async def chat(
+            self,
+            content: List[dict],
+            max_tokens: int = 512,
+            temperature: float = 1.0,
+            priority: float = 0.0,
+            ) -> Optional[str]:
+        """
+        Один запрос chat completions с сообщением пользователя content.
+        Возвращает текст первого варианта ответа (None, если вариантов нет);
+        VlmError — если запрос не удался после всех повторов.
+        """
+        self.start()
+        payload = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": content}],
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "top_p": 1.0,
+            "frequency_penalty": 0.0,
+            "presence_penalty": 0.0,
+            "stream": False,
+        }
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Job(priority, next(self._seq), payload, future))
+        data = await future
+        if "choices" in data and data["choices"]:
+            return data["choices"][0]["message"]["content"]
+        return None
+
+    async def _worker(self) -> None:
+        while True:
+            job: _Job = await self._queue.get()
+            if job.future.done():  # вызывающий уже отменил ожидание
+                continue
+            self.active += 1
+            try:
+                result = await self._send(job.payload)
+            except Exception as e:
+                self.failed += 1
+                if not job.future.done():
+                    job.future.set_exception(e)
+            else:
+                if not job.future.done():
+                    job.future.set_result(result)
+            finally:
+                self.active -= 1
+
+    async def _send(self, payload: dict) -> dict:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}" if self.api_key else "",
+            "Accept": "application/json",
+        }
+        error = ""
+        for attempt in range(self.max_retries + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self.bucket.acquire()
+
+            retry_after = None
+            try:
+                resp = await self._client.post(self.url, headers=headers, json=payload)
+            except httpx.TransportError as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if resp.status_code not in RETRY_STATUSES:
+                    resp.raise_for_status()
+                    return resp.json()
+                error = f"HTTP {resp.status_code}"
+                retry_after = parse_retry_after(resp.headers.get("Retry-After"))
+
+            if error == "HTTP 429":
+                self.throttled += 1
+            if attempt == self.max_retries:
+                break
+            delay = min(self.backoff_max_s, self.backoff_s * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if retry_after is not None or error == "HTTP 429":
+                # лимит провайдера общий — притормаживаем все воркеры, а не только этот
+                pause = retry_after if retry_after is not None else delay
+                self._paused_until = max(self._paused_until, time.monotonic() + pause)
+            self.retries += 1
+            logger.warning(f"VLM: {error}, повтор {attempt + 1}/{self.max_retries} через {max(delay, retry_after or 0):.1f}s")
+            await asyncio.sleep(max(delay, retry_after or 0))
+        raise VlmError(f"VLM недоступна после {self.max_retries + 1} попыток: {error}")